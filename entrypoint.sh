@@ -12,4 +12,9 @@ echo "PostgreSQL started"
 # Run database migrations
 python manage.py migrate
 
+# Download the assets of the survey pages before the first request
+if [ "${ROWO_MIRROR_PREWARM:-}" = "1" ]; then
+  python manage.py prewarm_mirror || echo "Prewarming the mirror failed"
+fi
+
 exec "$@"
\ No newline at end of file
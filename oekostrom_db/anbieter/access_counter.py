@@ -0,0 +1,204 @@
+"""
+Write-behind counter for the survey accesses
+
+Instead of updating the SurveyAccess row on every request, accesses are counted in
+the cache and written to the database in bulk, with one UPDATE per batch.
+The accesses counted since the last flush are logged in the cache, so the flush only
+reads and writes those. It runs in a background thread of the process,
+SURVEY_ACCESS_FLUSH_INTERVAL seconds after the first buffered access, and when the
+process exits. The survey requests never flush.
+The survey_access cache is local to the process, every process flushes its own counts.
+"""
+
+import atexit
+import logging
+import threading
+from datetime import datetime
+from typing import TYPE_CHECKING
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from django.db.models import Case, F, IntegerField, Value, When
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from .models import SurveyAccess
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "survey-access"
+# number of the last entry of the log of accessed pks
+SEQUENCE_KEY = f"{KEY_PREFIX}:sequence"
+# number of the last log entry that was flushed
+FLUSHED_KEY = f"{KEY_PREFIX}:flushed"
+BATCH_SIZE = 500
+
+# only one flush at a time, and at most one scheduled
+flush_lock = threading.Lock()
+timer_lock = threading.Lock()
+flush_timer: threading.Timer | None = None
+exit_flush_registered = False
+
+
+def get_counter_cache():
+    return caches[settings.SURVEY_ACCESS_BUFFER_ALIAS]
+
+
+def count_key(pk: int) -> str:
+    return f"{KEY_PREFIX}:count:{pk}"
+
+
+def last_key(pk: int) -> str:
+    return f"{KEY_PREFIX}:last:{pk}"
+
+
+def dirty_key(pk: int) -> str:
+    return f"{KEY_PREFIX}:dirty:{pk}"
+
+
+def log_key(number: int) -> str:
+    return f"{KEY_PREFIX}:log:{number}"
+
+
+def buffer_access(access: "SurveyAccess") -> None:
+    """
+    Count an access in the cache, the flush is scheduled in the background
+    """
+    cache = get_counter_cache()
+    cache.add(count_key(access.pk), 0, timeout=None)
+    cache.incr(count_key(access.pk))
+    cache.set(last_key(access.pk), access.last_access, timeout=None)
+    # log the access once per flush, the flush only reads the logged pks
+    if cache.add(dirty_key(access.pk), 1, timeout=None):
+        cache.add(SEQUENCE_KEY, 0, timeout=None)
+        cache.set(log_key(cache.incr(SEQUENCE_KEY)), access.pk, timeout=None)
+    schedule_flush()
+
+
+def schedule_flush() -> None:
+    global flush_timer, exit_flush_registered  # noqa: PLW0603
+    with timer_lock:
+        if flush_timer is not None and flush_timer.is_alive():
+            return
+        if not exit_flush_registered:
+            # the counts of this process would be lost otherwise
+            atexit.register(run_flush)
+            exit_flush_registered = True
+        flush_timer = threading.Timer(settings.SURVEY_ACCESS_FLUSH_INTERVAL, run_flush)
+        flush_timer.name = "survey-access-flush"
+        flush_timer.daemon = True
+        flush_timer.start()
+
+
+def run_flush() -> None:
+    global flush_timer  # noqa: PLW0603
+    with timer_lock:
+        # accesses during the flush are written by the next one, let them schedule it
+        if flush_timer is threading.current_thread():
+            flush_timer = None
+    try:
+        flush_access_counts()
+    except Exception:
+        logger.exception("Flushing the survey access counts failed")
+    finally:
+        # the connections of this thread would never be closed otherwise
+        connections.close_all()
+
+
+def pending_access_counts(
+    pks: "Iterable[int]",
+) -> dict[int, tuple[int, datetime | None]]:
+    """
+    Counts and last access not written to the database yet
+    """
+    pks = list(pks)
+    cache = get_counter_cache()
+    values = cache.get_many(
+        [count_key(pk) for pk in pks] + [last_key(pk) for pk in pks]
+    )
+    pending: dict[int, tuple[int, datetime | None]] = {}
+    for pk in pks:
+        count = values.get(count_key(pk), 0)
+        if count:
+            pending[pk] = (count, values.get(last_key(pk)))
+    return pending
+
+
+def merge_pending_counts(accesses: "Iterable[SurveyAccess]") -> None:
+    """
+    Add the counts that are not flushed yet to the loaded accesses
+    """
+    accesses = list(accesses)
+    pending = pending_access_counts(access.pk for access in accesses)
+    for access in accesses:
+        if access.pk not in pending:
+            continue
+        count, last_access = pending[access.pk]
+        access.access_count += count
+        if last_access and (not access.last_access or last_access > access.last_access):
+            access.last_access = last_access
+
+
+def logged_pks() -> tuple[list[int], int, int]:
+    """
+    Pks logged since the last flush, the number of the first and the last entry read
+    """
+    cache = get_counter_cache()
+    first = cache.get(FLUSHED_KEY, 0) + 1
+    numbers = range(first, cache.get(SEQUENCE_KEY, 0) + 1)
+    logged = cache.get_many([log_key(number) for number in numbers])
+    pks: list[int] = []
+    last = first - 1
+    for number in numbers:
+        if log_key(number) not in logged:
+            # the request that got the number didn't store the pk yet
+            break
+        pks.append(logged[log_key(number)])
+        last = number
+    return pks, first, last
+
+
+def flush_access_counts() -> int:
+    """
+    Write the buffered counts to the database, returns the number of updated accesses
+    """
+    from .models import SurveyAccess
+
+    with flush_lock:
+        cache = get_counter_cache()
+        pks, first_number, last_number = logged_pks()
+        if not pks:
+            return 0
+        # accesses from now on are logged again and written by the next flush
+        cache.delete_many([dirty_key(pk) for pk in pks])
+        pending = pending_access_counts(pks)
+        pending_items = list(pending.items())
+        for start in range(0, len(pending_items), BATCH_SIZE):
+            batch = pending_items[start : start + BATCH_SIZE]
+            SurveyAccess.objects.filter(pk__in=[pk for pk, _ in batch]).update(
+                access_count=F("access_count")
+                + Case(
+                    *(When(pk=pk, then=Value(count)) for pk, (count, _) in batch),
+                    default=Value(0),
+                    output_field=IntegerField(),
+                ),
+                last_access=Case(
+                    *(When(pk=pk, then=Value(last)) for pk, (_, last) in batch if last),
+                    default=F("last_access"),
+                ),
+            )
+            # accesses counted during the flush stay in the cache for the next flush
+            for pk, (count, _) in batch:
+                try:
+                    cache.decr(count_key(pk), count)
+                except ValueError:
+                    logger.warning(f"Access count of {pk=} vanished from cache")
+        cache.delete_many(
+            [log_key(number) for number in range(first_number, last_number + 1)]
+        )
+        cache.set(FLUSHED_KEY, last_number, timeout=None)
+    if pending:
+        logger.info(f"Flushed access counts of {len(pending)} survey accesses")
+    return len(pending)
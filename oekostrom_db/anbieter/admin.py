@@ -1,28 +1,56 @@
 import copy
-import json
 import logging
-import traceback
+from collections.abc import Iterator
 from typing import Any, Final
 from urllib.parse import urlparse
 
 from django import forms
 from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
 from django.contrib.admin.utils import unquote
+from django.contrib.admin.views.main import ORDER_VAR
 from django.contrib.admin.widgets import AutocompleteSelect
-from django.core.mail import send_mail
-from django.db.models import QuerySet
+from django.core.exceptions import PermissionDenied
+from django.db.models import Case, IntegerField, QuerySet, Value, When
 from django.db.models.fields import TextField
 from django.forms.widgets import Textarea
-from django.http import HttpRequest, HttpResponse, HttpResponseRedirect
+from django.http import (
+    HttpRequest,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseRedirect,
+    HttpResponseServerError,
+    JsonResponse,
+)
 from django.template.response import TemplateResponse
 from django.urls import path, reverse
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.html import format_html
 from django.utils.safestring import SafeString, mark_safe
-from jinja2 import Template as JinjaTemplate
 
+from .access_counter import merge_pending_counts
+from .export import (
+    EXPORT_CHUNK_SIZE,
+    ExportData,
+    RenderException,
+    get_homepage_export_delta,
+    iter_export_records,
+    render_records,
+    update_homepage_export,
+)
+from .facets import FacetCountsMixin
 from .filter import EmpfohlenFilter, SurveyStatusFilter
+from .keyset import KeysetChangeList
+from .mail_dispatch import (
+    SurveyMailTemplates,
+    dispatch_progress,
+    dispatch_running,
+    queue_survey_emails,
+    resume_dispatch,
+    start_dispatch,
+)
 from .models import (
     STATUS_CHOICES,
     Anbieter,
@@ -33,60 +61,52 @@ from .models import (
     Rowo2019,
     Stromauskunft,
     SurveyAccess,
+    SurveyRevisionDelta,
     Template,
     TemplateNames,
     UmfrageVersendung2024,
     Verivox,
 )
+from .search import search_anbieter
+from .streaming import iter_json_list, streaming_response
 
 NUMBER_ATTR: Final[str] = "_running_number"
+# matches ranked by the search, one CASE branch each, the rest is ordered by name
+SEARCH_RANKED: Final[int] = 100
 
 logger = logging.getLogger(__name__)
 
 
-class RenderException(Exception):
-    def __init__(self, anbieter: Anbieter, exc: Exception) -> None:
-        self._anbieter = anbieter
-        self.exc = exc
-        super().__init__(
-            f"Failed to render template for {anbieter.name}: {type(self.exc).__name__}: {self.exc}"
+def get_homepage_export_data(
+    template: str, include_pre: bool = False, qs=None, workers: int = 1
+) -> list[ExportData]:
+    if workers > 1:
+        return list(
+            iter_homepage_export_data_parallel(template, include_pre, qs, workers)
         )
+    return list(iter_homepage_export_data(template, include_pre, qs))
 
 
-def get_homepage_export_data(
-    template: str, include_pre: bool = False, qs=None
-) -> list[dict[str, str | list[str]]]:
-    data: dict[str, str | list[str]] = []
+def iter_homepage_export_data(
+    template: str,
+    include_pre: bool = False,
+    qs=None,
+    chunk_size: int = EXPORT_CHUNK_SIZE,
+) -> Iterator[ExportData]:
+    records = iter_export_records(qs, chunk_size)
+    for _, data in render_records(template, records, include_pre):
+        yield data
 
-    if qs is None:
-        qs = Anbieter.objects.filter(active=True)
 
-    qs = qs.order_by("name")
-    qs = qs.select_related("survey_access", "mutter", "sells_from")
-
-    for obj in qs:
-        # Get related names from AnbieterNames
-        related_names = obj.names.all().values_list("name", flat=True)
-
-        # Render the Jinja2 template content using current Anbieter as context
-        context = {"obj": obj, "anbieter": obj, "related_names": related_names}
-        jinja_template = JinjaTemplate(template)
-        try:
-            rendered_content = jinja_template.render(context)
-        except Exception as e:
-            raise RenderException(anbieter=obj, exc=e)
-        if include_pre:
-            rendered_content = f"<pre>{rendered_content}</pre>"
-        # Construct the JSON data
-        data.append(
-            {
-                "title": obj.name,
-                "id": obj.slug_id,
-                "names": list(related_names),
-                "content": rendered_content,
-            }
-        )
-    return data
+def iter_homepage_export_data_parallel(
+    template: str, include_pre: bool = False, qs=None, workers: int = 2
+) -> Iterator[ExportData]:
+    """
+    Render the export in worker processes, see anbieter/export.py
+    """
+    records = iter_export_records(qs)
+    for _, data in render_records(template, records, include_pre, workers):
+        yield data
 
 
 class ViewOnlyAdmin(admin.ModelAdmin):
@@ -113,6 +133,21 @@ class SurveyAccessAdmin(ViewOnlyAdmin):
         "last_access",
     )
 
+    def get_changelist_instance(self, request: HttpRequest):
+        changelist = super().get_changelist_instance(request)
+        if settings.SURVEY_ACCESS_BUFFER:
+            # result_list caches the accesses, so the template shows the merged ones
+            merge_pending_counts(changelist.result_list)
+        return changelist
+
+    def get_object(
+        self, request: HttpRequest, object_id: str, from_field: str | None = None
+    ) -> SurveyAccess | None:
+        obj = super().get_object(request, object_id, from_field)
+        if obj is not None and settings.SURVEY_ACCESS_BUFFER:
+            merge_pending_counts([obj])
+        return obj
+
     @admin.display(description="Anbieter", ordering="anbieter__name")
     def anbieter_name(self, obj: SurveyAccess) -> str:
         url = reverse("admin:anbieter_anbieter_change", args=[obj.anbieter.id])
@@ -130,6 +165,12 @@ class SurveyAdmin(ViewOnlyAdmin):
     list_display = ("anbieter", "revision", "created")
 
 
+@admin.register(SurveyRevisionDelta)
+class SurveyRevisionDeltaAdmin(ViewOnlyAdmin):
+    search_fields = ("anbieter__name",)
+    list_display = ("anbieter", "revision")
+
+
 @admin.register(OkPower, Oekotest, Rowo2019, Stromauskunft, Verivox)
 class ScraperAdmin(ViewOnlyAdmin):
     search_fields = ("name",)
@@ -303,6 +344,12 @@ class AnbieterForm(forms.ModelForm):
         }
 
 
+class AnbieterChangeList(FacetCountsMixin, KeysetChangeList):
+    """
+    Rows loaded while scrolling and facet counts from the cache
+    """
+
+
 @admin.register(Anbieter)
 class AnbieterAdmin(admin.ModelAdmin):
     search_fields = ("name",)
@@ -342,7 +389,10 @@ class AnbieterAdmin(admin.ModelAdmin):
     change_list_template = "admin/rowo_changelist.html"
 
     inlines = (AnbieterNameInline,)
-    list_per_page = 1500
+    # the following rows are loaded while scrolling, see anbieter/keyset.py
+    list_per_page = 100
+    # counts next to the filter options, cached by anbieter/facets.py
+    show_facets = admin.ShowFacets.ALWAYS
     ordering = ("name",)
 
     form = AnbieterForm
@@ -350,6 +400,38 @@ class AnbieterAdmin(admin.ModelAdmin):
 
     actions = ["init_survey_email", "homepage_preview"]
 
+    def get_queryset(self, request: HttpRequest) -> QuerySet:
+        return super().get_queryset(request).with_empfehlung()
+
+    def get_search_results(
+        self, request: HttpRequest, queryset: QuerySet, search_term: str
+    ) -> tuple[QuerySet, bool]:
+        """
+        Fuzzy search over all names, see anbieter/search.py
+
+        Without a sort order selected, as in the autocomplete, the best matches come first.
+        Only the first SEARCH_RANKED matches are ranked, the others follow by name.
+        """
+        if not search_term.strip():
+            return queryset, False
+        ids = search_anbieter(search_term)
+        if not ids:
+            return queryset.none(), False
+        ranked = ids[:SEARCH_RANKED]
+        queryset = queryset.filter(pk__in=ids).annotate(
+            search_rank=Case(
+                *(When(pk=pk, then=Value(index)) for index, pk in enumerate(ranked)),
+                default=Value(len(ranked)),
+                output_field=IntegerField(),
+            )
+        )
+        if ORDER_VAR not in request.GET:
+            queryset = queryset.order_by("search_rank", *queryset.query.order_by)
+        return queryset, False
+
+    def get_changelist(self, request: HttpRequest, **kwargs):  # noqa: ARG002
+        return AnbieterChangeList
+
     # Add custom URL and buttons
     def get_urls(self):
         urls = super().get_urls()
@@ -359,9 +441,26 @@ class AnbieterAdmin(admin.ModelAdmin):
                 self.export_for_homepage_view,
                 name="export_homepage",
             ),
+            path(
+                "rows/",
+                self.admin_site.admin_view(self.changelist_rows_view),
+                name=f"{self.opts.app_label}_{self.opts.model_name}_changelist_rows",
+            ),
         ]
         return custom_urls + urls
 
+    def changelist_rows_view(self, request: HttpRequest) -> HttpResponse:
+        """
+        Rows of the changelist after the keyset in ?after= as JSON
+        """
+        if not self.has_view_or_change_permission(request):
+            raise PermissionDenied
+        try:
+            cl = self.get_changelist_instance(request)
+        except IncorrectLookupParameters as e:
+            return HttpResponseBadRequest(str(e))
+        return JsonResponse({"rows": cl.rendered_rows(), "after": cl.next_keyset})
+
     def export_for_homepage_view(self, request: HttpRequest) -> HttpResponse:
         # Retrieve the template for "HOMEPAGE_TEXT_EXPORT"
         try:
@@ -374,32 +473,56 @@ class AnbieterAdmin(admin.ModelAdmin):
             )
             return HttpResponseRedirect(reverse("admin:anbieter_anbieter_changelist"))
 
-        data = get_homepage_export_data(homepage_template.template)
+        if "since" in request.GET:
+            return self.export_delta(request, homepage_template)
 
-        # Convert the data to JSON
-        response_content = json.dumps(data, indent=4)
+        if settings.HOMEPAGE_EXPORT_WORKERS > 1:
+            data = iter_homepage_export_data_parallel(
+                homepage_template.template, workers=settings.HOMEPAGE_EXPORT_WORKERS
+            )
+        else:
+            data = iter_homepage_export_data(homepage_template.template)
 
-        # Create the HTTP response with the JSON content as a file download
-        response = HttpResponse(response_content, content_type="application/json")
+        # Stream the data as JSON file download, rendered while sending
+        response = streaming_response(
+            request, iter_json_list(data), content_type="application/json"
+        )
         response["Content-Disposition"] = "attachment; filename=anbieter_export.json"
 
         return response
 
+    def export_delta(self, request: HttpRequest, homepage_template: Template):
+        """
+        Only the Anbieter changed after ?since=<timestamp>, all current ones without value
+
+        The "until" of the response is the since for the next request.
+        """
+        since = None
+        if request.GET["since"]:
+            since = parse_datetime(request.GET["since"])
+            if since is None:
+                return HttpResponseBadRequest("since ist kein gültiger Zeitpunkt")
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+        try:
+            update = update_homepage_export(
+                homepage_template.template, workers=settings.HOMEPAGE_EXPORT_WORKERS
+            )
+        except RenderException as e:
+            return HttpResponseServerError(str(e))
+        logger.info(
+            f"Updated homepage export updated={update.updated} removed={update.removed}"
+        )
+        return JsonResponse(
+            get_homepage_export_delta(since, update.timestamp),
+            json_dumps_params={"indent": 4},
+        )
+
     @admin.action(description="Init Umfrageversendung")
     def init_survey_email(self, request: HttpRequest, queryset) -> None:
-        obj: Anbieter
-        created = 0
-        already_existed = 0
-        for obj in queryset:
-            try:
-                UmfrageVersendung2024.objects.get(anbieter=obj)
-            except UmfrageVersendung2024.DoesNotExist:
-                # Create the instance only if it does not exist, without copying all defaults
-                new = UmfrageVersendung2024(anbieter=obj)
-                new.save_base(raw=True, force_insert=True)
-                created += 1
-            else:
-                already_existed += 1
+        created, already_existed = UmfrageVersendung2024.create_for(
+            queryset.values_list("pk", flat=True)
+        )
         self.message_user(
             request, f"Umfrageversendungen initiiert {created=} {already_existed=}"
         )
@@ -452,11 +575,11 @@ class AnbieterAdmin(admin.ModelAdmin):
 
     @admin.display(description="Mutter", ordering="mutter", boolean=True)
     def has_mutter(self, obj: Anbieter) -> bool:
-        return bool(obj.mutter)
+        return obj.mutter_id is not None
 
     @admin.display(description="Reseller", ordering="sells_from", boolean=True)
     def has_sells_from(self, obj: Anbieter) -> bool:
-        return bool(obj.sells_from)
+        return obj.sells_from_id is not None
 
     @admin.display(description="ℹ️", ordering="begruendung_extern")
     def hp_text(self, obj: Anbieter) -> str:
@@ -482,7 +605,7 @@ class AnbieterAdmin(admin.ModelAdmin):
     def no_bad_money(self, obj: Anbieter) -> bool:
         return obj.money_for_ee_only
 
-    @admin.display(description="📬", boolean=True)
+    @admin.display(description="📬", ordering="beantwortet", boolean=True)
     def survey_answered(self, obj: Anbieter) -> bool:
         return obj.survey_answered
 
@@ -499,7 +622,7 @@ class AnbieterAdmin(admin.ModelAdmin):
             )
         return "📭 Umfrage nicht beantwortet"
 
-    @admin.display(description="👍", boolean=True)
+    @admin.display(description="👍", ordering="empfohlen", boolean=True)
     def ist_empfohlen(self, obj: Anbieter) -> bool:
         return obj.ist_empfohlen
 
@@ -653,6 +776,7 @@ class UmfrageVersendung2024Admin(AnbieterAdmin):
         "has_mutter",
         "has_sells_from",
         "mail_status",
+        "mail_queued",
         "mail",
         "ee_only",
         "additional",
@@ -674,23 +798,8 @@ class UmfrageVersendung2024Admin(AnbieterAdmin):
 
     @admin.action(description="Sende Mail")
     def send_survey_email(self, request: HttpRequest, queryset):
-        obj: UmfrageVersendung2024
-        queryset = queryset.select_related("anbieter__survey_access")
-        already_sent = 0
-        retried = 0
-        sent = 0
-        failed = 0
-
         try:
-            subject_template = JinjaTemplate(
-                Template.objects.get(name=TemplateNames.SURVEY2024_SUBJECT).template
-            )
-            text_template = JinjaTemplate(
-                Template.objects.get(name=TemplateNames.SURVEY2024_TXT).template
-            )
-            html_template = JinjaTemplate(
-                Template.objects.get(name=TemplateNames.SURVEY2024_HTML).template
-            )
+            SurveyMailTemplates.load()
         except Exception as e:
             self.message_user(
                 request,
@@ -699,45 +808,37 @@ class UmfrageVersendung2024Admin(AnbieterAdmin):
             )
             return
 
-        for obj in queryset:
-            if obj.mail_status is True:
-                already_sent += 1
-                continue
-
-            try:
-                subject = subject_template.render(obj=obj)
-                message = text_template.render(obj=obj)
-                html = html_template.render(obj=obj)
-                send_mail(
-                    subject,
-                    message,
-                    None,  # Uses DEFAULT_FROM_EMAIL
-                    [obj.mail],
-                    fail_silently=False,
-                    html_message=html,
-                )
-            except Exception as e:
-                failed += 1
-                obj.mail_status = False
-                obj.mail_details = (
-                    f"{type(e).__name__}: {e}\n\n{traceback.format_exc()}"
-                )
-            else:
-                if obj.mail_status is None:
-                    sent += 1
-                else:
-                    retried += 1
-                obj.mail_status = True
-                obj.sent_date = timezone.now()
-                obj.mail_details = ""
-            obj.save()
-
+        queued, already_sent = queue_survey_emails(queryset)
+        if settings.SURVEY_MAIL_BACKGROUND:
+            start_dispatch()
+            started = "Versand gestartet"
+        else:
+            started = "Versand mit manage.py send_survey_emails"
         self.message_user(
             request,
-            f"Finished sending: {already_sent=} {sent=} {retried=} {failed=}",
+            f"Mails in Warteschlange {queued=} {already_sent=}, {started}",
             level="info",
         )
 
+    def changelist_view(self, request, extra_context=None):
+        progress = dispatch_progress()
+        if progress["queued"]:
+            if dispatch_running() or resume_dispatch():
+                self.message_user(
+                    request,
+                    f"Mailversand läuft, noch {progress['queued']} in der Warteschlange "
+                    f"(gesendet {progress['sent']}, fehlgeschlagen {progress['failed']})",
+                    level="warning",
+                )
+            else:
+                self.message_user(
+                    request,
+                    f"{progress['queued']} Mails warten in der Warteschlange, "
+                    "Versand mit manage.py send_survey_emails",
+                    level="warning",
+                )
+        return super().changelist_view(request, extra_context)
+
     @admin.display(ordering="survey_access__survey___fill_status")
     def filled(self, obj: UmfrageVersendung2024) -> str:
         return f"{obj.survey_access.survey._fill_status} %"
@@ -1,6 +1,29 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class AnbieterConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "anbieter"
+
+    def ready(self) -> None:
+        from .facets import invalidate_on_change
+        from .models import Anbieter, SurveyAccess, UmfrageVersendung2024
+        from .search import NAME_MODELS, invalidate_index
+
+        # the cached facet counts of the admin list filters depend on these models
+        self.connect_changes(
+            invalidate_on_change, (Anbieter, UmfrageVersendung2024, SurveyAccess)
+        )
+        # the in-memory search index holds their names
+        self.connect_changes(invalidate_index, (*NAME_MODELS, UmfrageVersendung2024))
+
+    @staticmethod
+    def connect_changes(receiver, models) -> None:
+        for model in models:
+            for signal in (post_save, post_delete):
+                signal.connect(
+                    receiver,
+                    sender=model,
+                    dispatch_uid=f"{receiver.__module__}-{model._meta.label}-{signal}",
+                )
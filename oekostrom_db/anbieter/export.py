@@ -0,0 +1,275 @@
+"""
+Rendering of the homepage export, optionally in parallel worker processes
+
+Rendering the template is pure Python and takes most of the export time.
+For the parallel export the Anbieter are loaded once in the main process and sent to
+the workers as ExportRecord. The instances are pickled with their annotations and
+related objects, so the template doesn't need to query the database in the workers.
+
+The incremental export stores the rendered content of every Anbieter as
+HomepageExportEntry together with a hash of its inputs: the Anbieter, its mutter,
+sells_from and root Anbieter, the survey revisions, the names and the template.
+Only Anbieter with a different hash are rendered again, a change of a parent or of
+the template therefore updates all dependent Anbieter.
+"""
+
+import hashlib
+import json
+import multiprocessing
+import pickle
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from functools import partial
+from typing import Any, Final
+
+import django
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
+from django.db.models import Prefetch
+from django.utils import timezone
+
+from .models import Anbieter, AnbieterName, HomepageExportEntry
+from .templating import content_hash, get_template
+
+ExportData = dict[str, str | list[str]]
+
+# Anbieter fetched from the database at once for the homepage export
+EXPORT_CHUNK_SIZE: Final[int] = 100
+# chunks per worker, so a slow chunk doesn't keep the other workers waiting
+CHUNKS_PER_WORKER = 4
+
+
+class RenderException(Exception):
+    def __init__(self, anbieter: Anbieter, exc: Exception) -> None:
+        self._anbieter = anbieter
+        self.exc = exc
+        super().__init__(
+            f"Failed to render template for {anbieter.name}: {type(self.exc).__name__}: {self.exc}"
+        )
+
+
+@dataclass
+class ExportRecord:
+    anbieter: Anbieter
+    names: list[str]
+
+
+@dataclass
+class ExportUpdate:
+    timestamp: datetime
+    updated: int
+    removed: int
+
+
+def iter_export_records(
+    qs=None, chunk_size: int = EXPORT_CHUNK_SIZE
+) -> Iterator[ExportRecord]:
+    if qs is None:
+        qs = Anbieter.objects.filter(active=True)
+
+    qs = qs.order_by("name").with_empfehlung()
+    # everything the template may touch, the parent chain is resolved in root_anbieter
+    qs = qs.select_related(
+        "survey_access",
+        "mutter",
+        "sells_from",
+        "root_anbieter",
+        "root_anbieter__survey_access",
+    )
+    # the names of each chunk are loaded in one query
+    qs = qs.prefetch_related(
+        Prefetch(
+            "names",
+            queryset=AnbieterName.objects.only("anbieter", "name").order_by("pk"),
+        )
+    )
+
+    for obj in qs.iterator(chunk_size=chunk_size):
+        yield ExportRecord(anbieter=obj, names=[name.name for name in obj.names.all()])
+
+
+def render_record(template: str, record: ExportRecord, include_pre: bool) -> ExportData:
+    obj = record.anbieter
+    # Render the Jinja2 template content using current Anbieter as context
+    context = {"obj": obj, "anbieter": obj, "related_names": record.names}
+    # compiled on the first call only
+    rendered_content = get_template(template).render(context)
+    if include_pre:
+        rendered_content = f"<pre>{rendered_content}</pre>"
+    return {
+        "title": obj.name,
+        "id": obj.slug_id,
+        "names": record.names,
+        "content": rendered_content,
+    }
+
+
+def render_in_worker(
+    template: str, include_pre: bool, record: ExportRecord
+) -> ExportData | Exception:
+    """
+    Render the record, errors are returned to be reported together with the Anbieter
+    """
+    try:
+        return render_record(template, record, include_pre)
+    except Exception as e:
+        try:
+            pickle.dumps(e)
+        except Exception:
+            return RuntimeError(f"{type(e).__name__}: {e}")
+        return e
+
+
+def render_parallel(
+    template: str, records: list[ExportRecord], include_pre: bool, workers: int
+) -> Iterator[tuple[ExportRecord, ExportData | Exception]]:
+    """
+    Render the records in worker processes, the results are in the order of the records
+    """
+    chunksize = max(1, len(records) // (workers * CHUNKS_PER_WORKER))
+    # spawn instead of fork, forked processes would share the database connections
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=django.setup,
+    ) as executor:
+        results = executor.map(
+            partial(render_in_worker, template, include_pre),
+            records,
+            chunksize=chunksize,
+        )
+        yield from zip(records, results, strict=True)
+
+
+def render_records(
+    template: str,
+    records: Iterable[ExportRecord],
+    include_pre: bool = False,
+    workers: int = 1,
+) -> Iterator[tuple[ExportRecord, ExportData]]:
+    """
+    Render the records in order, in worker processes if there is more than one worker
+    """
+    if workers > 1:
+        results = render_parallel(template, list(records), include_pre, workers)
+        for record, result in results:
+            if isinstance(result, Exception):
+                raise RenderException(anbieter=record.anbieter, exc=result)
+            yield record, result
+        return
+    for record in records:
+        try:
+            data = render_record(template, record, include_pre)
+        except Exception as e:
+            raise RenderException(anbieter=record.anbieter, exc=e)
+        yield record, data
+
+
+def row_values(obj: models.Model | None) -> list[str] | None:
+    if obj is None:
+        return None
+    return [field.value_to_string(obj) for field in obj._meta.concrete_fields]
+
+
+def survey_revision(anbieter: Anbieter | None) -> tuple[str, int] | None:
+    """
+    Code and revision of the survey, access counts don't change the export
+    """
+    try:
+        survey_access = anbieter.survey_access if anbieter is not None else None
+    except ObjectDoesNotExist:
+        survey_access = None
+    if survey_access is None:
+        return None
+    return survey_access.code, survey_access.current_revision
+
+
+def input_hash(template_hash: str, record: ExportRecord) -> str:
+    obj = record.anbieter
+    inputs: list[Any] = [
+        template_hash,
+        row_values(obj),
+        row_values(obj.mutter),
+        row_values(obj.sells_from),
+        row_values(obj.root_anbieter),
+        survey_revision(obj),
+        survey_revision(obj.root_anbieter),
+        record.names,
+    ]
+    encoded = json.dumps(inputs, cls=DjangoJSONEncoder, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def update_homepage_export(template: str, workers: int = 1) -> ExportUpdate:
+    """
+    Render the Anbieter whose inputs changed since the last update and store them
+    """
+    now = timezone.now()
+    # JSON only has milliseconds, the timestamp has to survive being the next since
+    timestamp = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    template_hash = content_hash(template)
+    stored = {
+        entry.anbieter_id: entry
+        for entry in HomepageExportEntry.objects.only(
+            "anbieter_id", "input_hash", "removed"
+        )
+    }
+    seen: set[int] = set()
+    hashes: dict[int, str] = {}
+    changed: list[ExportRecord] = []
+    for record in iter_export_records():
+        pk = record.anbieter.pk
+        seen.add(pk)
+        hashes[pk] = input_hash(template_hash, record)
+        entry = stored.get(pk)
+        if entry is None or entry.removed or entry.input_hash != hashes[pk]:
+            changed.append(record)
+
+    new_entries: list[HomepageExportEntry] = []
+    updated_entries: list[HomepageExportEntry] = []
+    for record, data in render_records(template, changed, workers=workers):
+        pk = record.anbieter.pk
+        entry = stored.get(pk) or HomepageExportEntry(anbieter_id=pk)
+        (updated_entries if entry.pk else new_entries).append(entry)
+        entry.input_hash = hashes[pk]
+        entry.data = data
+        entry.changed = timestamp
+        entry.removed = None
+    removed = [
+        pk for pk, entry in stored.items() if pk not in seen and entry.removed is None
+    ]
+
+    with transaction.atomic():
+        HomepageExportEntry.objects.bulk_create(new_entries, batch_size=500)
+        HomepageExportEntry.objects.bulk_update(
+            updated_entries,
+            ["input_hash", "data", "changed", "removed"],
+            batch_size=500,
+        )
+        HomepageExportEntry.objects.filter(anbieter_id__in=removed).update(
+            changed=timestamp, removed=timestamp
+        )
+    return ExportUpdate(timestamp=timestamp, updated=len(changed), removed=len(removed))
+
+
+def get_homepage_export_delta(
+    since: datetime | None, until: datetime
+) -> dict[str, Any]:
+    """
+    Anbieter updated or removed after since, all Anbieter if since is None
+    """
+    entries = HomepageExportEntry.objects.filter(changed__lte=until)
+    if since is None:
+        entries = entries.filter(removed=None)
+    else:
+        entries = entries.filter(changed__gt=since)
+    entries = sorted(entries, key=lambda entry: entry.data["title"])
+    return {
+        "since": since,
+        "until": until,
+        "updated": [entry.data for entry in entries if entry.removed is None],
+        "removed": [entry.data["id"] for entry in entries if entry.removed is not None],
+    }
@@ -0,0 +1,160 @@
+"""
+Cached facet counts for the list filters of the admin changelists
+
+Django computes the counts shown next to the filter options with one aggregate query
+per list filter, against the full table on every changelist load.
+FacetCountsMixin computes the counts of all filters in a single aggregate query instead
+and stores them in the ADMIN_FACET_CACHE_ALIAS cache, keyed by the filter and search
+parameters. Like in Django the counts of a filter include the other active filters.
+The cached counts are invalidated when an Anbieter or SurveyAccess is saved or deleted.
+Bulk updates don't send signals, after them the counts are outdated for at most
+ADMIN_FACET_CACHE_TIMEOUT seconds.
+"""
+
+import hashlib
+import json
+import operator
+import uuid
+from functools import partial, reduce
+from typing import Any, Final
+
+from django.conf import settings
+from django.contrib.admin.filters import FacetsMixin
+from django.contrib.admin.utils import build_q_object_from_lookup_parameters
+from django.core.cache import caches
+from django.db.models import Q, QuerySet
+from django.http import HttpRequest
+
+KEY_PREFIX: Final[str] = "admin-facets"
+GENERATION_KEY: Final[str] = f"{KEY_PREFIX}:generation"
+
+# facet counts of every list filter by the index of the filter
+FacetCounts = dict[int, dict[str, int]]
+
+
+def get_facet_cache():
+    return caches[settings.ADMIN_FACET_CACHE_ALIAS]
+
+
+def invalidate_facet_counts() -> None:
+    # a new generation changes all keys, old entries expire on their own
+    get_facet_cache().set(GENERATION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def invalidate_on_change(sender, **kwargs) -> None:  # noqa: ARG001
+    invalidate_facet_counts()
+
+
+def get_generation() -> str:
+    cache = get_facet_cache()
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        # another process may have set it in the meantime
+        if not cache.add(GENERATION_KEY, generation, timeout=None):
+            generation = cache.get(GENERATION_KEY, generation)
+    return generation
+
+
+class FacetCountsMixin:
+    """
+    ChangeList mixin that provides the facet counts of all list filters from the cache
+    """
+
+    facet_counts: FacetCounts | None = None
+
+    def get_filters(self, request: HttpRequest):
+        (
+            filter_specs,
+            has_filters,
+            remaining_lookup_params,
+            may_have_duplicates,
+            has_active_filters,
+        ) = super().get_filters(request)
+        self.facet_request = request
+        self.remaining_lookup_params = remaining_lookup_params
+        for index, spec in enumerate(filter_specs):
+            if isinstance(spec, FacetsMixin):
+                # the filters get their counts from the single aggregate
+                spec.get_facet_queryset = partial(self.get_filter_facet_counts, index)
+        return (
+            filter_specs,
+            has_filters,
+            remaining_lookup_params,
+            may_have_duplicates,
+            has_active_filters,
+        )
+
+    def get_filter_facet_counts(
+        self,
+        index: int,
+        changelist,  # noqa: ARG002
+    ) -> dict[str, int]:
+        if self.facet_counts is None:
+            self.facet_counts = self.get_facet_counts()
+        return self.facet_counts.get(index, {})
+
+    def facet_cache_key(self) -> str:
+        params = {
+            "model": self.opts.label,
+            "filters": sorted(self.get_filters_params().items()),
+            "query": self.query,
+        }
+        digest = hashlib.sha1(
+            json.dumps(params, sort_keys=True, default=str).encode()
+        ).hexdigest()
+        return f"{KEY_PREFIX}:{get_generation()}:{digest}"
+
+    def get_facet_counts(self) -> FacetCounts:
+        cache = get_facet_cache()
+        key = self.facet_cache_key()
+        counts = cache.get(key)
+        if counts is None:
+            counts = self.compute_facet_counts()
+            cache.set(key, counts, timeout=settings.ADMIN_FACET_CACHE_TIMEOUT)
+        return counts
+
+    def facet_base_queryset(self) -> QuerySet:
+        """
+        Queryset with the search and lookup parameters, without the list filters
+        """
+        qs = self.root_queryset.filter(
+            build_q_object_from_lookup_parameters(self.remaining_lookup_params)
+        )
+        qs, may_have_duplicates = self.model_admin.get_search_results(
+            self.facet_request, qs, self.query
+        )
+        return qs.distinct() if may_have_duplicates else qs
+
+    def compute_facet_counts(self) -> FacetCounts:
+        """
+        Counts of all list filters with a single aggregate query
+        """
+        qs = self.facet_base_queryset()
+        specs = {
+            index: spec
+            for index, spec in enumerate(self.filter_specs)
+            if isinstance(spec, FacetsMixin)
+        }
+        active = {
+            index: Q(pk__in=spec.queryset(self.facet_request, self.root_queryset))
+            for index, spec in specs.items()
+            if spec.used_parameters
+        }
+        aggregates: dict[str, Any] = {}
+        for index, spec in specs.items():
+            others = [
+                condition for other, condition in active.items() if other != index
+            ]
+            for name, count in spec.get_facet_counts(self.pk_attname, qs).items():
+                if others:
+                    count.filter = reduce(operator.and_, others, count.filter)
+                aggregates[f"{index}__{name}"] = count
+        if not aggregates:
+            return {}
+
+        counts: FacetCounts = {}
+        for key, value in qs.aggregate(**aggregates).items():
+            index, name = key.split("__", 1)
+            counts.setdefault(int(index), {})[name] = value
+        return counts
@@ -1,7 +1,21 @@
 import uuid
 from typing import TYPE_CHECKING, Any
 
+from django.db.models import (
+    Case,
+    CharField,
+    ExpressionWrapper,
+    FileField,
+    FloatField,
+    Q,
+    TextField,
+    Value,
+    When,
+)
+
 if TYPE_CHECKING:
+    from django.db.models import Model
+
     from .models import CompanySurvey2024
 
 
@@ -23,16 +37,43 @@ def is_empty(val: Any) -> bool:
     return val is None or str(val).strip() == ""
 
 
+# fields that are not counted for the fill status
+FILL_STATUS_EXCLUDE = {
+    "id",
+    "created",
+    "anbieter_id",
+    "revision",
+    "name",
+    "mail",
+    "homepage",
+}
+
+
 def get_fill_status(values: dict[str, Any]) -> float:
     fields = {f for f in values if not f.startswith("_")}
-    fields -= {
-        "id",
-        "created",
-        "anbieter_id",
-        "revision",
-        "name",
-        "mail",
-        "homepage",
-    }
+    fields -= FILL_STATUS_EXCLUDE
     missing = {f for f in fields if is_empty(values.get(f, None))}
     return (len(fields) - len(missing)) / len(fields) * 100
+
+
+def fill_status_expression(model: type["Model"]) -> ExpressionWrapper:
+    """
+    SQL version of get_fill_status to calculate it for many surveys at once
+    """
+    fields = [
+        field
+        for field in model._meta.concrete_fields
+        if not field.attname.startswith("_")
+        and field.attname not in FILL_STATUS_EXCLUDE
+    ]
+    filled: list[Case] = []
+    for field in fields:
+        empty = Q(**{f"{field.attname}__isnull": True})
+        if isinstance(field, CharField | TextField | FileField):
+            # like str(val).strip() == ""
+            empty |= Q(**{f"{field.attname}__regex": r"^\s*$"})
+        filled.append(Case(When(empty, then=Value(0)), default=Value(1)))
+    return ExpressionWrapper(
+        sum(filled[1:], start=filled[0]) * Value(100.0) / Value(len(fields)),
+        output_field=FloatField(),
+    )
@@ -1,7 +1,7 @@
-from typing import Literal
-
 from django.contrib.admin import SimpleListFilter
-from django.db.models import Q
+from django.db.models import Count, Q
+
+ANSWERED = Q(survey_access__current_revision__gt=1)
 
 
 class SurveyStatusFilter(SimpleListFilter):
@@ -20,13 +20,19 @@ class SurveyStatusFilter(SimpleListFilter):
 
     def queryset(self, request, queryset):  # noqa: ARG002
         """Filter the queryset based on the selected option."""
-        answered = Q(survey_access__current_revision__gt=1)
         if self.value() == "unanswered":
-            return queryset.exclude(answered)
+            return queryset.exclude(ANSWERED)
         if self.value() == "answered":
-            return queryset.filter(answered)
+            return queryset.filter(ANSWERED)
         return queryset  # No filtering for "all"
 
+    def get_facet_counts(self, pk_attname, filtered_qs):  # noqa: ARG002
+        """Count the options directly instead of with a subquery per option."""
+        return {
+            "0__c": Count(pk_attname, filter=~ANSWERED),
+            "1__c": Count(pk_attname, filter=ANSWERED),
+        }
+
 
 class EmpfohlenFilter(SimpleListFilter):
     # Human-readable title for the filter
@@ -44,36 +50,19 @@ class EmpfohlenFilter(SimpleListFilter):
 
     def queryset(self, request, queryset):  # noqa: ARG002
         """Filter the queryset based on the selected option."""
-
-        queryset = queryset.select_related("mutter", "sells_from")
-
-        def empfohlen_for(prefix_: Literal["mutter", "sells_from", "self"]) -> Q:
-            extra_q: dict[str, bool] = {}
-
-            if prefix_ == "self":
-                prefix = ""
-            else:
-                prefix = f"{prefix_}__"
-                extra_q = {f"{prefix_}__isnull": False}
-
-            return Q(
-                Q(**extra_q, **{f"{prefix}survey_access__current_revision__gt": 1})
-                & ~Q(**{f"{prefix}nur_oeko": False})
-                & ~Q(**{f"{prefix}unabhaengigkeit": False})
-                & ~Q(**{f"{prefix}zusaetzlichkeit": False})
-                & ~Q(**{f"{prefix}money_for_ee_only": False})
-            )
-
-        empfohlen = (
-            empfohlen_for("mutter")
-            | empfohlen_for("sells_from")
-            | empfohlen_for("self")
-        )
-
         if self.value() == "ja":
-            return queryset.filter(empfohlen)
+            return queryset.with_empfehlung().filter(empfohlen=True)
 
         if self.value() == "nein":
-            return queryset.exclude(empfohlen)
+            return queryset.with_empfehlung().filter(empfohlen=False)
 
         return queryset  # No filtering for "all"
+
+    def get_facet_counts(self, pk_attname, filtered_qs):
+        """Count the options with the annotation of the admin queryset."""
+        if "empfohlen" not in filtered_qs.query.annotations:
+            return super().get_facet_counts(pk_attname, filtered_qs)
+        return {
+            "0__c": Count(pk_attname, filter=Q(empfohlen=True)),
+            "1__c": Count(pk_attname, filter=Q(empfohlen=False)),
+        }
@@ -0,0 +1,265 @@
+"""
+Fragment cache for the immutable parts of the survey form
+
+Sections, headers and labels as well as the crispy markup around every field
+(wrapper div, label, help text, appended units) are the same for every survey.
+They are rendered once and stored in the Django cache, keyed by the version of the
+survey model and the template pack.
+Per request only the field widgets holding the survey values are rendered.
+"""
+
+import hashlib
+import logging
+from typing import TYPE_CHECKING, Any
+
+from crispy_forms.layout import Layout
+from crispy_forms.utils import TEMPLATE_PACK, render_field
+from django.conf import settings
+from django.core.cache import caches
+from django.forms import FileInput, RadioSelect
+from django.utils.safestring import SafeString
+
+from .layouts import LayoutElement
+
+if TYPE_CHECKING:
+    from crispy_forms.layout import LayoutObject
+    from django.forms import BoundField, Form
+    from django.template import Context
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "survey-fragment"
+
+# context variables of crispy that influence how a field is rendered
+CONTEXT_KEYS = (
+    "error_text_inline",
+    "field_class",
+    "field_template",
+    "form_class",
+    "form_show_errors",
+    "form_show_labels",
+    "help_text_inline",
+    "label_class",
+    "tag",
+    "use_custom_control",
+    "wrapper_class",
+)
+
+# Marker that is rendered instead of the widget to split the crispy markup around it
+WIDGET_MARKER = "\x00survey-widget\x00"
+
+
+def get_fragment_cache():
+    return caches[settings.SURVEY_FRAGMENT_CACHE_ALIAS]
+
+
+def context_key(context: "Context") -> str:
+    values = "|".join(f"{key}={context.get(key)}" for key in CONTEXT_KEYS)
+    return hashlib.sha1(values.encode()).hexdigest()[:8]
+
+
+def value_key(value: Any) -> str:
+    if value is None or value == "":
+        return "empty"
+    return hashlib.sha1(f"{type(value).__name__}:{value}".encode()).hexdigest()[:16]
+
+
+class StaticFragment(LayoutElement):
+    """
+    Consecutive static layout elements (sections, headers, labels) combined to one fragment
+    """
+
+    def __init__(self, elements: list[LayoutElement], index: int) -> None:
+        self.elements = elements
+        self.index = index
+        super().__init__()
+
+    def __html__(self) -> str:
+        return "".join(element.__html__() for element in self.elements)
+
+    def cache_keys(self, base: str, form: "Form") -> list[str]:  # noqa: ARG002
+        return [f"{base}:static:{self.index}"]
+
+    def render_fragment(  # noqa: PLR0913
+        self,
+        form: "Form",  # noqa: ARG002
+        context: "Context",  # noqa: ARG002
+        template_pack: str,  # noqa: ARG002
+        keys: list[str],
+        fragments: dict[str, Any],
+        new_fragments: dict[str, Any],
+    ) -> str:
+        if keys[0] in fragments:
+            return fragments[keys[0]]
+        html = self.__html__()
+        new_fragments[keys[0]] = html
+        return html
+
+
+class CachedField:
+    """
+    Wraps a field of the survey layout so that only widgets with new values are rendered
+
+    The rendered field is cached together with its value.
+    If the value is not cached yet, only the widget is rendered and put into the cached
+    crispy markup around it.
+    Widgets that are rendered by the crispy templates directly (radio buttons, file uploads)
+    can't be split and are rendered completely in that case.
+    Fields with errors are never cached.
+    """
+
+    def __init__(self, field: "LayoutObject | str", name: str) -> None:
+        self.field = field
+        self.name = name
+
+    def render(self, form, context, template_pack=TEMPLATE_PACK, **kwargs):
+        return render_field(
+            self.field, form, context, template_pack=template_pack, **kwargs
+        )
+
+    def splittable(self, bound_field: "BoundField") -> bool:
+        return not isinstance(bound_field.field.widget, RadioSelect | FileInput)
+
+    def cache_keys(self, base: str, form: "Form") -> list[str]:
+        """
+        Key of the rendered field with the current value and the key of the split markup
+        """
+        bound_field = form[self.name]
+        if bound_field.errors:
+            return []
+        state = "disabled" if bound_field.field.disabled else "enabled"
+        key = f"{base}:field:{self.name}:{state}"
+        keys = [f"{key}:{value_key(bound_field.value())}"]
+        if self.splittable(bound_field):
+            keys.append(f"{key}:split")
+        return keys
+
+    def render_fragment(  # noqa: PLR0913
+        self,
+        form: "Form",
+        context: "Context",
+        template_pack: str,
+        keys: list[str],
+        fragments: dict[str, Any],
+        new_fragments: dict[str, Any],
+    ) -> str:
+        if not keys:
+            return self.render(form, context, template_pack)
+        html_key = keys[0]
+        if html_key in fragments:
+            form.rendered_fields.add(self.name)
+            return fragments[html_key]
+
+        if len(keys) == 1:
+            html = self.render(form, context, template_pack)
+        else:
+            split_key = keys[1]
+            if split_key in fragments:
+                form.rendered_fields.add(self.name)
+                prefix, suffix, name, attrs = fragments[split_key]
+            else:
+                prefix, suffix, name, attrs = self.split(form, context, template_pack)
+                new_fragments[split_key] = (prefix, suffix, name, attrs)
+            bound_field = form[self.name]
+            widget_html = bound_field.field.widget.render(
+                name, bound_field.value(), attrs=attrs, renderer=form.renderer
+            )
+            html = SafeString(f"{prefix}{widget_html}{suffix}")
+        new_fragments[html_key] = html
+        return html
+
+    def split(
+        self, form: "Form", context: "Context", template_pack: str
+    ) -> tuple[str, str, str, dict[str, Any]]:
+        """
+        Render the field with a marker as widget, to get the markup around the widget
+        """
+        widget = form[self.name].field.widget
+        captured: dict[str, Any] = {}
+
+        def capture(name: str, value: Any, attrs=None, renderer=None) -> str:  # noqa: ARG001
+            captured["name"] = name
+            captured["attrs"] = {**widget.attrs, **(attrs or {})}
+            return SafeString(WIDGET_MARKER)
+
+        widget.render = capture
+        try:
+            html = self.render(form, context, template_pack)
+        finally:
+            del widget.render
+        prefix, suffix = html.split(WIDGET_MARKER)
+        return prefix, suffix, captured["name"], captured["attrs"]
+
+
+class FragmentLayout(Layout):
+    """
+    Layout that fetches all cached fragments of the survey with a single cache lookup
+    """
+
+    def __init__(self, *fields, version: str) -> None:
+        super().__init__(*fields)
+        self.version = version
+
+    def render(self, form, context, template_pack=TEMPLATE_PACK, **kwargs):
+        cache = get_fragment_cache()
+        base = f"{KEY_PREFIX}:{self.version}:{template_pack}:{context_key(context)}"
+        keys: dict[int, list[str]] = {
+            index: field.cache_keys(base, form)
+            for index, field in enumerate(self.fields)
+            if isinstance(field, StaticFragment | CachedField)
+        }
+        fragments = cache.get_many(
+            [key for key_list in keys.values() for key in key_list]
+        )
+        new_fragments: dict[str, Any] = {}
+        html: list[str] = []
+        for index, field in enumerate(self.fields):
+            if index in keys:
+                html.append(
+                    field.render_fragment(
+                        form,
+                        context,
+                        template_pack,
+                        keys[index],
+                        fragments,
+                        new_fragments,
+                    )
+                )
+            else:
+                html.append(
+                    render_field(
+                        field, form, context, template_pack=template_pack, **kwargs
+                    )
+                )
+        if new_fragments:
+            cache.set_many(
+                new_fragments, timeout=settings.SURVEY_FRAGMENT_CACHE_TIMEOUT
+            )
+            logger.debug(
+                f"Cached {len(new_fragments)} survey fragments {self.version=}"
+            )
+        return SafeString("".join(html))
+
+
+def compile_fragments(items: list[Any]) -> list[Any]:
+    """
+    Combine the static elements and wrap the fields of a survey layout plan
+    """
+    result: list[Any] = []
+    static: list[LayoutElement] = []
+    for item in items:
+        if isinstance(item, LayoutElement):
+            static.append(item)
+            continue
+        if static:
+            result.append(StaticFragment(static, len(result)))
+            static = []
+        if isinstance(item, str):
+            result.append(CachedField(item, item))
+        elif len(getattr(item, "fields", ())) == 1:
+            result.append(CachedField(item, item.fields[0]))
+        else:
+            result.append(item)
+    if static:
+        result.append(StaticFragment(static, len(result)))
+    return result
@@ -0,0 +1,54 @@
+"""
+Resolve the root of every Anbieter in the graph of mutter/sells_from links
+
+Anbieter.parent follows mutter first and sells_from second until an Anbieter without
+both is found. The result is stored in Anbieter.root_anbieter and Anbieter.depth,
+so it doesn't need to be walked for every access.
+"""
+
+# Anbieter id -> (mutter id, sells_from id)
+Links = dict[int, tuple[int | None, int | None]]
+# Anbieter id -> (root id or None if the Anbieter is a root itself, depth)
+Roots = dict[int, tuple[int | None, int]]
+
+
+def next_hop(links: Links, anbieter_id: int) -> int | None:
+    mutter_id, sells_from_id = links[anbieter_id]
+    hop = mutter_id if mutter_id is not None else sells_from_id
+    # links to unknown Anbieter are ignored, like a deleted mutter
+    return hop if hop in links else None
+
+
+def resolve_roots(links: Links) -> tuple[Roots, set[int]]:
+    """
+    Root and depth of all Anbieter in one pass and the Anbieter that are part of a cycle
+
+    Anbieter in a cycle are treated as root, as there is no sensible root for them.
+    """
+    roots: Roots = {}
+    cycles: set[int] = set()
+    for start in links:
+        path: list[int] = []
+        on_path: dict[int, int] = {}
+        anbieter_id: int | None = start
+        while anbieter_id is not None and anbieter_id not in roots:
+            if anbieter_id in on_path:
+                cycle = path[on_path[anbieter_id] :]
+                cycles.update(cycle)
+                for member in cycle:
+                    roots[member] = (None, 0)
+                break
+            on_path[anbieter_id] = len(path)
+            path.append(anbieter_id)
+            anbieter_id = next_hop(links, anbieter_id)
+        # walk back and resolve every Anbieter on the way from its next hop
+        for anbieter_id in reversed(path):
+            if anbieter_id in roots:
+                continue
+            hop = next_hop(links, anbieter_id)
+            if hop is None:
+                roots[anbieter_id] = (None, 0)
+            else:
+                root_id, depth = roots[hop]
+                roots[anbieter_id] = (hop if root_id is None else root_id, depth + 1)
+    return roots, cycles
@@ -0,0 +1,165 @@
+"""
+Keyset pagination for the admin changelists
+
+The changelist renders only the first page as HTML, the following rows are loaded as
+JSON by static/anbieter/keyset_changelist.js while scrolling.
+Instead of an offset, the rows after the last loaded one are selected by the values
+of the ordering fields (the keyset), which stays fast for any position and doesn't
+need to count the rows.
+Filters, search and the sort order are applied by the ChangeList just like for the
+HTML page. Empty values are always sorted last, so they can be compared the same way
+on every database.
+"""
+
+import json
+from typing import Any, Final
+
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.templatetags.admin_list import items_for_result
+from django.contrib.admin.views.main import ChangeList
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Model, OrderBy, Q, QuerySet
+from django.http import HttpRequest
+from django.urls import reverse
+
+# parameter holding the keyset of the last loaded row
+AFTER_VAR: Final[str] = "after"
+# rows loaded per JSON request
+ROWS_PER_REQUEST: Final[int] = 200
+
+# ordering field and whether it is descending
+Key = tuple[str, bool]
+
+
+def key_alias(index: int) -> str:
+    return f"keyset_{index}"
+
+
+def ordering_keys(ordering: list[Any]) -> list[Key] | None:
+    """
+    Fields of the ordering, None if it contains expressions that can't be compared
+    """
+    keys: list[Key] = []
+    for field in ordering:
+        if isinstance(field, str):
+            keys.append((field.removeprefix("-"), field.startswith("-")))
+        elif isinstance(field, OrderBy) and isinstance(field.expression, F):
+            keys.append((field.expression.name, field.descending))
+        else:
+            return None
+    return keys
+
+
+def order_by_keys(qs: QuerySet, keys: list[Key]) -> QuerySet:
+    qs = qs.annotate(
+        **{key_alias(index): F(name) for index, (name, _) in enumerate(keys)}
+    )
+    return qs.order_by(
+        *(
+            F(key_alias(index)).desc(nulls_last=True)
+            if descending
+            else F(key_alias(index)).asc(nulls_last=True)
+            for index, (_, descending) in enumerate(keys)
+        )
+    )
+
+
+def after_condition(keys: list[Key], values: list[Any]) -> Q:
+    """
+    Rows after the keyset values, with empty values sorted last
+    """
+    condition = Q(pk__in=[])
+    equal = Q()
+    for index, ((_, descending), value) in enumerate(zip(keys, values, strict=True)):
+        alias = key_alias(index)
+        if value is not None:
+            lookup = "lt" if descending else "gt"
+            condition |= equal & (
+                Q(**{f"{alias}__{lookup}": value}) | Q(**{f"{alias}__isnull": True})
+            )
+            equal &= Q(**{alias: value})
+        else:
+            # nothing is sorted after an empty value
+            equal &= Q(**{f"{alias}__isnull": True})
+    return condition
+
+
+def encode_keyset(obj: Model, keys: list[Key]) -> str:
+    return json.dumps(
+        [getattr(obj, key_alias(index)) for index in range(len(keys))],
+        cls=DjangoJSONEncoder,
+    )
+
+
+class KeysetChangeList(ChangeList):
+    """
+    ChangeList that loads the rows after ?after=<keyset> instead of a page
+    """
+
+    keys: list[Key] | None = None
+    next_keyset: str | None = None
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(AFTER_VAR, None)
+        return lookup_params
+
+    def get_queryset(self, request: HttpRequest, exclude_parameters=None) -> QuerySet:
+        qs = super().get_queryset(request, exclude_parameters)
+        # the ordering of the queryset, the search may put the best matches first
+        self.keys = ordering_keys(list(qs.query.order_by))
+        if self.keys is None:
+            return qs
+        return order_by_keys(qs, self.keys)
+
+    def get_results(self, request: HttpRequest) -> None:
+        if AFTER_VAR not in request.GET or self.keys is None:
+            super().get_results(request)
+            count = len(self.result_list)
+            if self.keys is not None and self.result_count > count:
+                # the result list is a sliced queryset without negative indexing
+                last = self.result_list[count - 1]
+                self.next_keyset = encode_keyset(last, self.keys)
+            return
+
+        qs = self.queryset
+        if request.GET[AFTER_VAR]:
+            try:
+                values = json.loads(request.GET[AFTER_VAR])
+                qs = qs.filter(after_condition(self.keys, values))
+            except (ValueError, TypeError) as e:
+                raise IncorrectLookupParameters(e) from e
+        rows = list(qs[: ROWS_PER_REQUEST + 1])
+        self.result_list = rows[:ROWS_PER_REQUEST]
+        if len(rows) > ROWS_PER_REQUEST:
+            self.next_keyset = encode_keyset(self.result_list[-1], self.keys)
+        self.result_count = self.full_result_count = len(self.result_list)
+        self.show_full_result_count = False
+        self.can_show_all = False
+        self.multi_page = False
+        self.paginator = None
+
+    @property
+    def rows_url(self) -> str:
+        return (
+            reverse(
+                f"{self.model_admin.admin_site.name}:"
+                f"{self.opts.app_label}_{self.opts.model_name}_changelist_rows"
+            )
+            + self.get_query_string()
+        )
+
+    @property
+    def keyset(self) -> dict[str, str] | None:
+        """
+        Data for loading the following rows, None if all rows are shown
+        """
+        if self.next_keyset is None:
+            return None
+        return {"url": self.rows_url, "after": self.next_keyset}
+
+    def rendered_rows(self) -> list[str]:
+        return [
+            "<tr>" + "".join(items_for_result(self, obj, None)) + "</tr>"
+            for obj in self.result_list
+        ]
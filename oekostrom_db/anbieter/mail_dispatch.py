@@ -0,0 +1,289 @@
+"""
+Queued sending of the survey mails
+
+The admin action only marks the selected UmfrageVersendung2024 as queued.
+The queue is processed in a background thread of the admin process (with
+SURVEY_MAIL_BACKGROUND) or by `manage.py send_survey_emails`. The thread is started
+again when the server starts and when the changelist finds a queue nobody processes.
+All mails are sent through one SMTP connection, optionally at most SURVEY_MAIL_RATE per
+second. A dispatcher claims SURVEY_MAIL_BATCH_SIZE mails at a time by setting
+mail_sending in a short transaction, the mails are sent outside of any transaction and
+the status of each mail is written as soon as it was sent. Claims older than
+SURVEY_MAIL_CLAIM_TIMEOUT are left by a dispatcher that was stopped and are taken over.
+"""
+
+import logging
+import threading
+import time
+import traceback
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import connections, transaction
+from django.db.models import Count, Q, QuerySet
+from django.utils import timezone
+from jinja2 import Template as JinjaTemplate
+
+from .facets import invalidate_facet_counts
+from .models import Template, TemplateNames, UmfrageVersendung2024
+from .templating import get_template
+
+logger = logging.getLogger(__name__)
+
+STATUS_FIELDS = [
+    "mail_status",
+    "sent_date",
+    "mail_details",
+    "mail_queued",
+    "mail_sending",
+]
+
+# only one dispatcher thread per process
+dispatch_lock = threading.Lock()
+
+
+@dataclass
+class SurveyMailTemplates:
+    subject: JinjaTemplate
+    text: JinjaTemplate
+    html: JinjaTemplate
+
+    @classmethod
+    def load(cls) -> "SurveyMailTemplates":
+        names = [
+            TemplateNames.SURVEY2024_SUBJECT,
+            TemplateNames.SURVEY2024_TXT,
+            TemplateNames.SURVEY2024_HTML,
+        ]
+        templates = {
+            template.name: template.template
+            for template in Template.objects.filter(name__in=names)
+        }
+        missing = [name for name in names if name not in templates]
+        if missing:
+            raise Template.DoesNotExist(
+                f"Missing survey mail templates {', '.join(missing)}"
+            )
+        return cls(
+            subject=get_template(templates[TemplateNames.SURVEY2024_SUBJECT]),
+            text=get_template(templates[TemplateNames.SURVEY2024_TXT]),
+            html=get_template(templates[TemplateNames.SURVEY2024_HTML]),
+        )
+
+    def render(self, obj: UmfrageVersendung2024) -> EmailMultiAlternatives:
+        message = EmailMultiAlternatives(
+            self.subject.render(obj=obj),
+            self.text.render(obj=obj),
+            None,  # Uses DEFAULT_FROM_EMAIL
+            [obj.mail],
+        )
+        message.attach_alternative(self.html.render(obj=obj), "text/html")
+        return message
+
+
+@dataclass
+class DispatchResult:
+    sent: int = 0
+    retried: int = 0
+    failed: int = 0
+    errors: list[str] = field(default_factory=list)
+
+
+class RateLimit:
+    def __init__(self, rate: float) -> None:
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_time = 0.0
+
+    def wait(self) -> None:
+        now = time.monotonic()
+        if self.next_time > now:
+            time.sleep(self.next_time - now)
+            now = self.next_time
+        self.next_time = now + self.interval
+
+
+def queue_survey_emails(queryset: QuerySet) -> tuple[int, int]:
+    """
+    Queue the mails that weren't sent successfully, returns queued and already sent
+    """
+    # the ordering of the changelist can't be used for the update of the child table
+    queryset = queryset.order_by()
+    already_sent = queryset.filter(mail_status=True).count()
+    queued = queryset.exclude(mail_status=True).update(mail_queued=timezone.now())
+    return queued, already_sent
+
+
+def queued_mails() -> QuerySet:
+    return UmfrageVersendung2024.objects.filter(mail_queued__isnull=False)
+
+
+def claim_expiry() -> datetime:
+    return timezone.now() - timedelta(seconds=settings.SURVEY_MAIL_CLAIM_TIMEOUT)
+
+
+def claimable_mails() -> QuerySet:
+    """
+    Queued mails that no running dispatcher has claimed
+    """
+    return queued_mails().filter(
+        Q(mail_sending=None) | Q(mail_sending__lt=claim_expiry())
+    )
+
+
+def dispatch_running() -> bool:
+    """
+    Whether this process or another dispatcher is sending the queue
+    """
+    return (
+        dispatch_lock.locked()
+        or queued_mails().filter(mail_sending__gte=claim_expiry()).exists()
+    )
+
+
+def dispatch_progress() -> dict[str, int]:
+    """
+    Number of mails waiting, sent and failed
+    """
+    done = Q(mail_queued=None)
+    return UmfrageVersendung2024.objects.aggregate(
+        queued=Count("pk", filter=~done),
+        sent=Count("pk", filter=done & Q(mail_status=True)),
+        failed=Count("pk", filter=done & Q(mail_status=False)),
+    )
+
+
+def claim_batch(batch_size: int) -> list[UmfrageVersendung2024]:
+    """
+    Claim the next mails, the rows are only locked until the claim is committed
+    """
+    with transaction.atomic():
+        # other dispatchers skip the batch instead of sending it twice
+        batch = list(
+            claimable_mails()
+            .select_related("survey_access")
+            .select_for_update(skip_locked=True, of=("self",))
+            .order_by("mail_queued", "pk")[:batch_size]
+        )
+        UmfrageVersendung2024.objects.filter(pk__in=[obj.pk for obj in batch]).update(
+            mail_sending=timezone.now()
+        )
+    return batch
+
+
+def store_status(obj: UmfrageVersendung2024) -> None:
+    UmfrageVersendung2024.objects.filter(pk=obj.pk).update(
+        **{name: getattr(obj, name) for name in STATUS_FIELDS}
+    )
+
+
+def send_batch(
+    templates: SurveyMailTemplates,
+    connection,
+    batch: list[UmfrageVersendung2024],
+    rate_limit: RateLimit,
+    result: DispatchResult,
+) -> Iterator[UmfrageVersendung2024]:
+    """
+    Send the mails of the batch, yields every processed UmfrageVersendung2024
+    """
+    for obj in batch:
+        rate_limit.wait()
+        try:
+            connection.send_messages([templates.render(obj)])
+        except Exception as e:
+            result.failed += 1
+            result.errors.append(f"{obj.name}: {type(e).__name__}: {e}")
+            obj.mail_status = False
+            obj.mail_details = f"{type(e).__name__}: {e}\n\n{traceback.format_exc()}"
+            obj.mail_queued = None
+            obj.mail_sending = None
+            yield obj
+            # the connection may be unusable after an error
+            connection.close()
+            connection.open()
+        else:
+            if obj.mail_status is None:
+                result.sent += 1
+            else:
+                result.retried += 1
+            obj.mail_status = True
+            obj.sent_date = timezone.now()
+            obj.mail_details = ""
+            obj.mail_queued = None
+            obj.mail_sending = None
+            yield obj
+
+
+def dispatch_queued(
+    batch_size: int | None = None, rate: float | None = None
+) -> DispatchResult:
+    """
+    Send all queued mails, stops with the rest still queued if the connection is lost
+    """
+    batch_size = batch_size or settings.SURVEY_MAIL_BATCH_SIZE
+    rate_limit = RateLimit(settings.SURVEY_MAIL_RATE if rate is None else rate)
+    result = DispatchResult()
+    if not claimable_mails().exists():
+        return result
+    # before claiming, a missing template would leave the mails claimed otherwise
+    templates = SurveyMailTemplates.load()
+    batch = claim_batch(batch_size)
+    if not batch:
+        return result
+    with get_connection(fail_silently=False) as connection:
+        while batch:
+            processed: set[int] = set()
+            try:
+                for obj in send_batch(templates, connection, batch, rate_limit, result):
+                    store_status(obj)
+                    processed.add(obj.pk)
+            except Exception:
+                logger.exception("Lost connection while sending survey mails")
+                # the rest stays queued for the next dispatcher
+                UmfrageVersendung2024.objects.filter(
+                    pk__in=[obj.pk for obj in batch if obj.pk not in processed]
+                ).update(mail_sending=None)
+                batch = []
+            else:
+                batch = claim_batch(batch_size)
+            # the mail status is a list filter of the admin
+            invalidate_facet_counts()
+            logger.info(
+                f"Survey mails sent={result.sent} retried={result.retried} failed={result.failed}"
+            )
+    return result
+
+
+def run_dispatch() -> None:
+    if not dispatch_lock.acquire(blocking=False):
+        return
+    try:
+        dispatch_queued()
+    except Exception:
+        logger.exception("Sending the survey mails failed")
+    finally:
+        dispatch_lock.release()
+        # the connections of this thread would never be closed otherwise
+        connections.close_all()
+
+
+def start_dispatch() -> bool:
+    """
+    Process the queue in a background thread, False if one is already running
+    """
+    if dispatch_lock.locked():
+        return False
+    threading.Thread(target=run_dispatch, name="survey-mail", daemon=True).start()
+    return True
+
+
+def resume_dispatch() -> bool:
+    """
+    Continue sending a queue left by a restart, if it's sent in the background
+    """
+    if not settings.SURVEY_MAIL_BACKGROUND:
+        return False
+    return start_dispatch()
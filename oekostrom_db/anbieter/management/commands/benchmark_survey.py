@@ -0,0 +1,443 @@
+"""
+Benchmark the survey request path
+
+Seeds a throw away SQLite database with Anbieter and their survey revisions and
+sends requests through the SurveyView.
+Run it with the benchmark settings so no real data is touched:
+
+    python manage.py benchmark_survey --settings=oekostrom_db.settings_benchmark
+
+Use `--output` to store the results as JSON and `--compare` to compare a run with
+the results of another commit.
+"""
+
+import json
+import platform
+import statistics
+import subprocess
+import time
+import tracemalloc
+from collections.abc import Callable
+from decimal import Decimal
+from functools import partial
+from pathlib import Path
+from typing import Any
+
+import django
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, models
+from django.forms import FileInput
+from django.forms import models as model_forms
+from django.http import HttpResponse
+from django.template.loader import render_to_string
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from anbieter.field_helper import get_fill_status
+from anbieter.fragment_cache import get_fragment_cache
+from anbieter.layouts import State
+from anbieter.models import Anbieter, CompanySurvey2024, SurveyAccess
+from anbieter.views import RevisionModelForm, SurveyView, gen_survey_helper
+
+SAMPLE_VALUES: dict[type[models.Field], object] = {
+    models.DecimalField: Decimal("12.5"),
+    models.FloatField: 1.5,
+    models.IntegerField: 42,
+    models.BooleanField: True,
+    models.TextField: "Beispiel\nmit mehreren Zeilen",
+    models.CharField: "Beispiel",
+}
+
+REQUEST_SCENARIOS: dict[str, State] = {
+    "get_view": State.view_only,
+    "get_edit": State.start,
+    "post_valid": State.saved,
+    "post_unchanged": State.unchanged,
+    "post_invalid": State.error,
+}
+RENDER_SCENARIO = "render"
+
+# number of requests per scenario used to measure the allocations, as tracing is slow
+ALLOCATION_REPEAT = 10
+
+
+def survey_fields() -> list[models.Field]:
+    return [
+        field
+        for field in CompanySurvey2024._meta.concrete_fields
+        if field.editable and not field.primary_key and field.name != "revision"
+    ]
+
+
+def fill_survey(survey: CompanySurvey2024, fields: list[models.Field]) -> None:
+    for field in fields:
+        if field.choices and not isinstance(field, models.BooleanField):
+            setattr(survey, field.attname, field.choices[0][0])
+            continue
+        for field_type, value in SAMPLE_VALUES.items():
+            if isinstance(field, field_type):
+                setattr(survey, field.attname, value)
+                break
+
+
+def filled_survey() -> CompanySurvey2024:
+    survey = CompanySurvey2024(revision=1)
+    fill_survey(survey, survey_fields())
+    return survey
+
+
+def unchanged_survey(survey: CompanySurvey2024) -> Callable[[], CompanySurvey2024]:
+    return lambda: survey
+
+
+def edited_survey() -> Callable[[], CompanySurvey2024]:
+    """
+    Every call returns the filled survey with some changed answers, like after saving it
+    """
+    survey = filled_survey()
+    counter = 0
+
+    def edit() -> CompanySurvey2024:
+        nonlocal counter
+        counter += 1
+        survey.name = f"Beispiel {counter}"
+        survey.ownership_structure = f"Eigentümer {counter}"
+        survey.num_employees = counter
+        return survey
+
+    return edit
+
+
+def render_survey(survey: CompanySurvey2024, view_mode: bool) -> str:
+    form_class = model_forms.modelform_factory(
+        CompanySurvey2024, fields="__all__", form=RevisionModelForm
+    )
+    form = form_class(instance=survey, current_revision=1, request_path="/")
+    state = State.start
+    if view_mode:
+        state = State.view_only
+        for field in form.fields.values():
+            field.disabled = True
+    form.helper = gen_survey_helper(form, state, add_save_button=not view_mode)
+    context = {
+        "form": form,
+        "rowo_url": "/static",
+        "rowo_hp": "https://robinwood.de",
+        "teaser": "Benchmark",
+        "tag": "div",
+        "wrapper_class": "form-group row align-items-center",
+    }
+    return render_to_string("anbieter/survey.html", context)
+
+
+def measure(func: Callable[[], str], repeat: int) -> tuple[list[float], str]:
+    html = func()  # warm up caches
+    timings: list[float] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings, html
+
+
+def percentile(values: list[float], percent: float) -> float:
+    ordered = sorted(values)
+    return ordered[round(percent / 100 * (len(ordered) - 1))]
+
+
+def git_commit() -> str:
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+    return result.stdout.strip()
+
+
+def seed(count: int, revisions: int) -> list[SurveyAccess]:
+    """
+    Create Anbieter with a chain of survey revisions that get filled more and more
+    """
+    fields = survey_fields()
+    surveys: list[CompanySurvey2024] = []
+    for index in range(count):
+        # creates the SurveyAccess and the first revision
+        anbieter = Anbieter.objects.create(name=f"Benchmark Anbieter {index:05}")
+        for revision in range(2, revisions + 1):
+            survey = CompanySurvey2024(anbieter=anbieter, revision=revision)
+            fill_survey(survey, fields[: len(fields) * revision // revisions])
+            survey._fill_status = get_fill_status(survey.__dict__)
+            surveys.append(survey)
+    CompanySurvey2024.objects.bulk_create(surveys, batch_size=500)
+
+    accesses = list(SurveyAccess.objects.select_related("anbieter").order_by("id"))
+    if revisions > 1:
+        latest = {
+            survey.anbieter_id: survey
+            for survey in CompanySurvey2024.objects.filter(revision=revisions)
+        }
+        for access in accesses:
+            access.survey = latest[access.anbieter_id]
+            access.current_revision = revisions
+            access.changed = timezone.now()
+        SurveyAccess.objects.bulk_update(
+            accesses, ["survey", "current_revision", "changed"], batch_size=500
+        )
+    return accesses
+
+
+def post_data(survey: CompanySurvey2024, current_revision: int) -> dict[str, str]:
+    """
+    Form data as a browser would send it for the given survey
+    """
+    form_class = model_forms.modelform_factory(
+        CompanySurvey2024, fields="__all__", form=RevisionModelForm
+    )
+    form = form_class(
+        instance=survey, current_revision=current_revision, request_path=""
+    )
+    data: dict[str, str] = {}
+    for name, bound_field in form._bound_items():
+        if isinstance(bound_field.field.widget, FileInput):
+            continue
+        value = bound_field.value()
+        data[name] = "" if value is None else str(value)
+    return data
+
+
+class SurveyRequests:
+    """
+    Creates the requests of the different scenarios, round robin over all surveys
+    """
+
+    def __init__(self, accesses: list[SurveyAccess]) -> None:
+        self.codes = [access.code for access in accesses]
+        self.factory = RequestFactory()
+        self.view = SurveyView.as_view()
+        self.counter = 0
+
+    def next_code(self) -> str:
+        self.counter += 1
+        return self.codes[self.counter % len(self.codes)]
+
+    def prepare(self, scenario: str) -> Callable[[], HttpResponse]:
+        """
+        Build the request outside the measurement and return a function sending it
+        """
+        code = self.next_code()
+        path = f"/survey/{code}/"
+        if scenario == "get_view":
+            request = self.factory.get(path, {"view": 1})
+        elif scenario == "get_edit":
+            request = self.factory.get(path)
+        else:
+            access = SurveyAccess.objects.select_related("survey").get(code=code)
+            data = post_data(access.survey, access.current_revision)
+            if scenario == "post_valid":
+                data["name"] = f"Benchmark {self.counter}"
+            elif scenario == "post_invalid":
+                data["hydro_power"] = "500"
+            request = self.factory.post(path, data)
+
+        def send() -> HttpResponse:
+            response = self.view(request, code=code)
+            response.render()
+            return response
+
+        return send
+
+
+class Command(BaseCommand):
+    help = "Benchmark the survey requests and the fragment cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--anbieter", type=int, default=50, help="Number of Anbieter to create"
+        )
+        parser.add_argument(
+            "--revisions", type=int, default=5, help="Survey revisions per Anbieter"
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=50, help="Requests per scenario"
+        )
+        parser.add_argument(
+            "--scenario",
+            action="append",
+            choices=[*REQUEST_SCENARIOS, RENDER_SCENARIO],
+            help="Only run the given scenarios, can be given multiple times",
+        )
+        parser.add_argument("--output", type=Path, help="Write results as JSON")
+        parser.add_argument(
+            "--compare", type=Path, help="JSON results of another run to compare to"
+        )
+        parser.add_argument(
+            "--min-speedup",
+            type=float,
+            default=0,
+            help="Fail if the fragment cache is not at least this much faster",
+        )
+
+    def handle(self, *args, **options):  # noqa: ARG002
+        scenarios = options["scenario"] or [*REQUEST_SCENARIOS, RENDER_SCENARIO]
+        results: dict[str, Any] = {
+            "commit": git_commit(),
+            "created": timezone.now().isoformat(),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "anbieter": options["anbieter"],
+            "revisions": options["revisions"],
+            "repeat": options["repeat"],
+            "scenarios": {},
+        }
+
+        request_scenarios = [s for s in scenarios if s in REQUEST_SCENARIOS]
+        if request_scenarios:
+            accesses = self.setup_database(options["anbieter"], options["revisions"])
+            requests = SurveyRequests(accesses)
+            for scenario in request_scenarios:
+                results["scenarios"][scenario] = self.run_requests(
+                    requests, scenario, options["repeat"]
+                )
+
+        if RENDER_SCENARIO in scenarios:
+            results["scenarios"][RENDER_SCENARIO] = self.run_render(
+                options["repeat"], options["min_speedup"]
+            )
+
+        if options["compare"]:
+            self.compare(json.loads(options["compare"].read_text()), results)
+        if options["output"]:
+            options["output"].write_text(json.dumps(results, indent=4))
+            self.stdout.write(f"Results written to {options['output']}")
+
+    def setup_database(self, count: int, revisions: int) -> list[SurveyAccess]:
+        if connection.vendor != "sqlite":
+            raise CommandError(
+                "The benchmark creates its own data, "
+                "run it with --settings=oekostrom_db.settings_benchmark"
+            )
+        call_command("migrate", run_syncdb=True, verbosity=0)
+        if Anbieter.objects.exists():
+            raise CommandError("The benchmark needs an empty database")
+        start = time.perf_counter()
+        accesses = seed(count, revisions)
+        self.stdout.write(
+            f"Seeded {count} Anbieter with {revisions} revisions "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
+        return accesses
+
+    def run_requests(
+        self, requests: SurveyRequests, scenario: str, repeat: int
+    ) -> dict[str, float]:
+        # warm up and ensure we measure what we want to measure
+        response = requests.prepare(scenario)()
+        state = response.context_data["view"].state
+        if response.status_code != 200 or state != REQUEST_SCENARIOS[scenario]:  # noqa: PLR2004
+            raise CommandError(
+                f"{scenario} returned {response.status_code} with {state=}"
+            )
+
+        timings: list[float] = []
+        queries: list[int] = []
+        for _ in range(repeat):
+            send = requests.prepare(scenario)
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                send()
+                timings.append((time.perf_counter() - start) * 1000)
+            queries.append(len(captured))
+
+        allocated: list[float] = []
+        tracemalloc.start()
+        try:
+            for _ in range(min(repeat, ALLOCATION_REPEAT)):
+                send = requests.prepare(scenario)
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                send()
+                allocated.append((tracemalloc.get_traced_memory()[1] - before) / 1024)
+        finally:
+            tracemalloc.stop()
+
+        result = {
+            "p50_ms": percentile(timings, 50),
+            "p95_ms": percentile(timings, 95),
+            "mean_ms": statistics.mean(timings),
+            "queries": statistics.median(queries),
+            "alloc_peak_kb": statistics.median(allocated),
+        }
+        self.stdout.write(
+            f"{scenario:>15}: p50 {result['p50_ms']:7.2f} ms  "
+            f"p95 {result['p95_ms']:7.2f} ms  queries {result['queries']:4.0f}  "
+            f"alloc {result['alloc_peak_kb']:8.0f} KiB"
+        )
+        return result
+
+    def run_render(
+        self, repeat: int, min_speedup: float
+    ) -> dict[str, dict[str, float]]:
+        """
+        Render the survey page with and without the fragment cache
+        """
+        empty = CompanySurvey2024(revision=1)
+        filled = filled_survey()
+        # scenario name -> (factory of the survey getter, view mode)
+        scenarios: dict[
+            str, tuple[Callable[[], Callable[[], CompanySurvey2024]], bool]
+        ] = {
+            "empty": (partial(unchanged_survey, empty), False),
+            "filled": (partial(unchanged_survey, filled), False),
+            "edited": (edited_survey, False),
+            "view": (partial(unchanged_survey, filled), True),
+        }
+        results: dict[str, dict[str, float]] = {}
+        for name, (survey_factory, view_mode) in scenarios.items():
+            medians: dict[bool, float] = {}
+            outputs: dict[bool, str] = {}
+            for fragment_cache in (False, True):
+                get_fragment_cache().clear()
+                get_survey = survey_factory()
+                with override_settings(SURVEY_FRAGMENT_CACHE=fragment_cache):
+                    timings, outputs[fragment_cache] = measure(
+                        lambda: render_survey(get_survey(), view_mode),  # noqa: B023
+                        repeat,
+                    )
+                medians[fragment_cache] = statistics.median(timings)
+            if outputs[False] != outputs[True]:
+                raise CommandError(f"Fragment cache changed the output of {name}")
+            results[name] = {
+                "uncached_ms": medians[False],
+                "cached_ms": medians[True],
+                "speedup": medians[False] / medians[True],
+            }
+            self.stdout.write(
+                f"{'render ' + name:>15}: uncached {medians[False]:7.2f} ms  "
+                f"cached {medians[True]:7.2f} ms  "
+                f"speedup {results[name]['speedup']:4.1f}x"
+            )
+        speedup = min(result["speedup"] for result in results.values())
+        if speedup < min_speedup:
+            raise CommandError(f"Speedup {speedup:.1f}x below {min_speedup}x")
+        return results
+
+    def compare(self, old: dict[str, Any], new: dict[str, Any]) -> None:
+        self.stdout.write(f"Compared to {old.get('commit') or 'previous run'}:")
+        for scenario, result in new["scenarios"].items():
+            if scenario == RENDER_SCENARIO or scenario not in old["scenarios"]:
+                continue
+            old_result = old["scenarios"][scenario]
+            changes = "  ".join(
+                f"{key} {(result[key] / old_result[key] - 1) * 100:+6.1f}%"
+                for key in ("p50_ms", "p95_ms", "alloc_peak_kb")
+                if old_result.get(key)
+            )
+            queries = result["queries"] - old_result["queries"]
+            self.stdout.write(f"{scenario:>15}: {changes}  queries {queries:+.0f}")
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from anbieter.models import SurveyAccess
+from anbieter.revisions import compact_revisions, expand_revisions
+
+
+class Command(BaseCommand):
+    help = (
+        "Store old survey revisions as deltas to the next revision, "
+        "see SURVEY_DELTA_REVISIONS"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--expand",
+            action="store_true",
+            help="Store all revisions completely again, i.e. to disable the delta storage",
+        )
+
+    def handle(self, *args, **options):  # noqa: ARG002
+        convert = expand_revisions if options["expand"] else compact_revisions
+        total = 0
+        for anbieter_id, current_revision in SurveyAccess.objects.values_list(
+            "anbieter_id", "current_revision"
+        ):
+            total += convert(anbieter_id, current_revision)
+        action = "Expanded" if options["expand"] else "Compacted"
+        self.stdout.write(f"{action} {total} survey revisions")
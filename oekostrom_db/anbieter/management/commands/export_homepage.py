@@ -0,0 +1,79 @@
+import json
+from collections.abc import Iterator
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from anbieter.admin import (
+    RenderException,
+    iter_homepage_export_data,
+    iter_homepage_export_data_parallel,
+)
+from anbieter.export import get_homepage_export_delta, update_homepage_export
+from anbieter.models import Template, TemplateNames
+from anbieter.streaming import iter_json_list
+
+
+class Command(BaseCommand):
+    help = "Export the active Anbieter for the homepage as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Render the template in that many processes",
+        )
+        parser.add_argument(
+            "--since",
+            nargs="?",
+            const="",
+            help="Only export the Anbieter changed after this timestamp, "
+            "all current ones without value. The until of the output is the next since.",
+        )
+        parser.add_argument("--output", help="File to write, default is stdout")
+
+    def handle(self, *args, **options):  # noqa: ARG002
+        try:
+            template = Template.objects.get(name=TemplateNames.HOMEPAGE_TEXT_EXPORT)
+        except Template.DoesNotExist:
+            raise CommandError("Homepage export template not found.")
+
+        if options["since"] is not None:
+            parts = self.iter_delta(template, options["since"], options["workers"])
+        elif options["workers"] > 1:
+            parts = iter_json_list(
+                iter_homepage_export_data_parallel(
+                    template.template, workers=options["workers"]
+                )
+            )
+        else:
+            parts = iter_json_list(iter_homepage_export_data(template.template))
+
+        try:
+            if options["output"]:
+                with Path(options["output"]).open("w", encoding="utf-8") as output:
+                    output.writelines(parts)
+            else:
+                for part in parts:
+                    self.stdout.write(part, ending="")
+        except RenderException as e:
+            raise CommandError(str(e))
+
+    def iter_delta(self, template: Template, since: str, workers: int) -> Iterator[str]:
+        since_timestamp = None
+        if since:
+            since_timestamp = parse_datetime(since)
+            if since_timestamp is None:
+                raise CommandError(f"Invalid timestamp {since}")
+            if timezone.is_naive(since_timestamp):
+                since_timestamp = timezone.make_aware(since_timestamp)
+        update = update_homepage_export(template.template, workers=workers)
+        self.stderr.write(
+            f"Rendered {update.updated} Anbieter, {update.removed} removed"
+        )
+        delta = get_homepage_export_delta(since_timestamp, update.timestamp)
+        yield json.dumps(delta, cls=DjangoJSONEncoder, indent=4)
@@ -0,0 +1,80 @@
+import asyncio
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.http import Http404
+from django.template.defaultfilters import filesizeformat
+
+from anbieter.mirror_cache import get_mirror_index
+from anbieter.view_mirror import get_local_file
+
+
+class Command(BaseCommand):
+    help = "Show, fill or empty the cache of the files mirrored from the RoWo homepage"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "action",
+            choices=["stats", "warmup", "purge"],
+            help="stats: show the cached files, warmup: download the given paths "
+            "or revalidate them, purge: delete the downloaded files",
+        )
+        parser.add_argument("paths", nargs="*", help="Paths to download for warmup")
+        parser.add_argument(
+            "--expired",
+            action="store_true",
+            help="Only purge the files older than ROWO_MIRROR_TTL",
+        )
+        parser.add_argument(
+            "--top", type=int, default=10, help="Show that many most used files"
+        )
+
+    def handle(self, *args, **options):  # noqa: ARG002
+        if options["action"] == "stats":
+            self.stats(options["top"])
+        elif options["action"] == "warmup":
+            if not options["paths"]:
+                raise CommandError("No paths given")
+            failed = asyncio.run(self.warmup(options["paths"]))
+            if failed:
+                raise CommandError(f"{failed} of {len(options['paths'])} failed")
+        else:
+            purged = get_mirror_index().purge(
+                Path(settings.APP_STATIC_ROOT).resolve(),
+                expired_only=options["expired"],
+            )
+            size = sum(entry.size for entry in purged)
+            self.stdout.write(f"Deleted {len(purged)} files, {filesizeformat(size)}")
+
+    def stats(self, top: int) -> None:
+        entries = get_mirror_index().entries()
+        now = time.time()
+        size = sum(entry.size for entry in entries)
+        self.stdout.write(
+            f"{len(entries)} files, {filesizeformat(size)} "
+            f"of {filesizeformat(settings.ROWO_MIRROR_MAX_BYTES)}, "
+            f"{sum(entry.expired(now) for entry in entries)} expired"
+        )
+        for entry in sorted(entries, key=lambda entry: -entry.hits)[:top]:
+            self.stdout.write(
+                f"{entry.hits:8} {filesizeformat(entry.size):>10} {entry.path}"
+            )
+
+    async def warmup(self, paths: list[str]) -> int:
+        results = await asyncio.gather(
+            *(get_local_file(path, count_hit=False) for path in paths),
+            return_exceptions=True,
+        )
+        failed = 0
+        for path, result in zip(paths, results, strict=True):
+            if isinstance(result, Http404):
+                failed += 1
+                self.stderr.write(f"{path}: {result}")
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                result.close()
+                self.stdout.write(f"{path}: {filesizeformat(result.stat.st_size)}")
+        return failed
@@ -0,0 +1,36 @@
+import asyncio
+
+from django.core.management.base import BaseCommand, CommandError
+from django.template.defaultfilters import filesizeformat
+
+from anbieter.mirror_prewarm import TEMPLATES, prewarm, template_assets
+
+
+class Command(BaseCommand):
+    help = (
+        "Download the files of the RoWo homepage referenced by the survey pages "
+        "and their stylesheets into the mirror"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "paths", nargs="*", help="Additional paths to download, e.g. themes/..."
+        )
+        parser.add_argument(
+            "--fail",
+            action="store_true",
+            help="Exit with an error if a file couldn't be downloaded",
+        )
+
+    def handle(self, *args, **options):  # noqa: ARG002
+        paths = [*template_assets(TEMPLATES), *options["paths"]]
+        result = asyncio.run(prewarm(paths))
+        for path, error in result.errors.items():
+            self.stderr.write(f"{path}: {error}")
+        self.stdout.write(
+            f"Mirrored {len(result.sizes)} files, "
+            f"{filesizeformat(sum(result.sizes.values()))}, "
+            f"{len(result.errors)} failed"
+        )
+        if result.errors and options["fail"]:
+            raise CommandError(f"{len(result.errors)} files couldn't be downloaded")
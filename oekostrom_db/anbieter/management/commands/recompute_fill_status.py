@@ -0,0 +1,32 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+
+from anbieter.field_helper import fill_status_expression
+from anbieter.models import CompanySurvey2024
+
+
+class Command(BaseCommand):
+    help = "Recompute the fill status of all survey revisions in the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):  # noqa: ARG002
+        batch_size = options["batch_size"]
+        surveys = CompanySurvey2024.objects.annotate(
+            fill_status=fill_status_expression(CompanySurvey2024)
+        ).values_list("pk", "_fill_status", "fill_status")
+        changed: list[CompanySurvey2024] = []
+        count = 0
+        for pk, old_status, fill_status in surveys.iterator(chunk_size=batch_size):
+            new_status = Decimal(f"{fill_status:.1f}")
+            if old_status != new_status:
+                changed.append(CompanySurvey2024(pk=pk, _fill_status=new_status))
+            if len(changed) >= batch_size:
+                CompanySurvey2024.objects.bulk_update(changed, ["_fill_status"])
+                count += len(changed)
+                changed = []
+        CompanySurvey2024.objects.bulk_update(changed, ["_fill_status"])
+        count += len(changed)
+        self.stdout.write(f"Updated fill status of {count} survey revisions")
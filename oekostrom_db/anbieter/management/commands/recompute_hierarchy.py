@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from anbieter.models import Anbieter
+
+
+class Command(BaseCommand):
+    help = "Recompute root Anbieter and depth of all Anbieter from mutter/sells_from"
+
+    def handle(self, *args, **options):  # noqa: ARG002
+        cycles = Anbieter.update_hierarchy()
+        for anbieter in Anbieter.objects.filter(pk__in=cycles).order_by("name"):
+            self.stderr.write(
+                f"{anbieter.name} ({anbieter.pk}) is part of a cycle "
+                f"mutter={anbieter.mutter_id} sells_from={anbieter.sells_from_id}"
+            )
+        self.stdout.write(f"Recomputed hierarchy, {len(cycles)} Anbieter in cycles")
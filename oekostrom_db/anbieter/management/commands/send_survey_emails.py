@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from anbieter.mail_dispatch import dispatch_queued
+
+
+class Command(BaseCommand):
+    help = "Send the queued survey mails"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, help="Default is SURVEY_MAIL_BATCH_SIZE"
+        )
+        parser.add_argument(
+            "--rate", type=float, help="Mails per second, default is SURVEY_MAIL_RATE"
+        )
+
+    def handle(self, *args, **options):  # noqa: ARG002
+        result = dispatch_queued(options["batch_size"], options["rate"])
+        for error in result.errors:
+            self.stderr.write(error)
+        self.stdout.write(
+            f"Sent {result.sent}, retried {result.retried}, failed {result.failed}"
+        )
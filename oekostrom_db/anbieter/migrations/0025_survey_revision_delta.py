@@ -0,0 +1,48 @@
+# Generated by Django 5.1.5 on 2026-10-17 22:39
+
+import django.core.serializers.json
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("anbieter", "0024_fix_fill_status"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SurveyRevisionDelta",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("revision", models.PositiveIntegerField()),
+                (
+                    "changes",
+                    models.JSONField(
+                        encoder=django.core.serializers.json.DjangoJSONEncoder
+                    ),
+                ),
+                (
+                    "anbieter",
+                    models.ForeignKey(
+                        editable=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="anbieter.anbieter",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Umfrage Revision (Delta)",
+                "verbose_name_plural": "Umfrage: Revisionen (Delta)",
+                "unique_together": {("anbieter", "revision")},
+            },
+        ),
+    ]
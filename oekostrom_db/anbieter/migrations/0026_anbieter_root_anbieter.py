@@ -0,0 +1,62 @@
+# Generated by Django 5.1.5 on 2026-10-17 22:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from anbieter.hierarchy import resolve_roots
+
+
+def calculate_roots(apps, schema_editor):  # noqa: ARG001
+    Anbieter = apps.get_model("anbieter", "Anbieter")
+    links = {
+        pk: (mutter_id, sells_from_id)
+        for pk, mutter_id, sells_from_id in Anbieter.objects.values_list(
+            "pk", "mutter_id", "sells_from_id"
+        )
+    }
+    roots, _ = resolve_roots(links)
+    Anbieter.objects.bulk_update(
+        [
+            Anbieter(pk=pk, root_anbieter_id=root_id, depth=depth)
+            for pk, (root_id, depth) in roots.items()
+            if root_id is not None
+        ],
+        ["root_anbieter", "depth"],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("anbieter", "0025_survey_revision_delta"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="anbieter",
+            name="depth",
+            field=models.PositiveSmallIntegerField(
+                db_default=0,
+                default=0,
+                editable=False,
+                help_text="Anzahl der Schritte bis zum Wurzel Anbieter",
+                verbose_name="Tiefe",
+            ),
+        ),
+        migrations.AddField(
+            model_name="anbieter",
+            name="root_anbieter",
+            field=models.ForeignKey(
+                blank=True,
+                db_default=None,
+                editable=False,
+                help_text="Ende der Mutter Firma/Verkauft Strom von Kette, leer für sich selbst",
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="descendants",
+                to="anbieter.anbieter",
+                verbose_name="Wurzel Anbieter",
+            ),
+        ),
+        migrations.RunPython(calculate_roots, migrations.RunPython.noop),
+    ]
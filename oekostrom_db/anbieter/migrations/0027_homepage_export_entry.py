@@ -0,0 +1,41 @@
+# Generated by Django 5.1.5 on 2026-10-17 22:51
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("anbieter", "0026_anbieter_root_anbieter"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="HomepageExportEntry",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("anbieter_id", models.IntegerField(unique=True)),
+                ("input_hash", models.CharField(max_length=64)),
+                (
+                    "data",
+                    models.JSONField(
+                        encoder=django.core.serializers.json.DjangoJSONEncoder
+                    ),
+                ),
+                ("changed", models.DateTimeField(db_index=True)),
+                ("removed", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "verbose_name": "Homepage Export Eintrag",
+                "verbose_name_plural": "Homepage: Export Einträge",
+            },
+        ),
+    ]
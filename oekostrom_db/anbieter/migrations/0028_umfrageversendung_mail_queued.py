@@ -0,0 +1,25 @@
+# Generated by Django 5.1.5 on 2026-10-17 22:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("anbieter", "0027_homepage_export_entry"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="umfrageversendung2024",
+            name="mail_queued",
+            field=models.DateTimeField(
+                blank=True,
+                db_default=None,
+                db_index=True,
+                editable=False,
+                help_text="Zeitpunkt seit dem die Mail auf den Versand wartet",
+                null=True,
+                verbose_name="📥 Warteschlange",
+            ),
+        ),
+    ]
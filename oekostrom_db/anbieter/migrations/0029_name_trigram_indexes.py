@@ -0,0 +1,43 @@
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+# tables whose name column is searched by anbieter/search.py
+TABLES = (
+    "anbieter_anbieter",
+    "anbieter_anbietername",
+    "anbieter_oekotest",
+    "anbieter_okpower",
+    "anbieter_rowo2019",
+    "anbieter_stromauskunft",
+    "anbieter_verivox",
+)
+
+
+def create_indexes(apps, schema_editor):  # noqa: ARG001
+    # GIN indexes only exist on PostgreSQL, other databases use the in-memory index
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for table in TABLES:
+        # the expression of the icontains lookup, used for the similarity as well
+        schema_editor.execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_name_trgm "
+            f"ON {table} USING gin ((UPPER(name::text)) gin_trgm_ops)"
+        )
+
+
+def drop_indexes(apps, schema_editor):  # noqa: ARG001
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for table in TABLES:
+        schema_editor.execute(f"DROP INDEX IF EXISTS {table}_name_trgm")
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("anbieter", "0028_umfrageversendung_mail_queued"),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.5 on 2026-10-18 01:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("anbieter", "0029_name_trigram_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="umfrageversendung2024",
+            name="mail_sending",
+            field=models.DateTimeField(
+                blank=True,
+                db_default=None,
+                editable=False,
+                help_text="Zeitpunkt seit dem ein Dispatcher die Mail versendet",
+                null=True,
+                verbose_name="📨 Versand",
+            ),
+        ),
+    ]
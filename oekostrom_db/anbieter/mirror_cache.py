@@ -0,0 +1,211 @@
+"""
+Index of the files downloaded by the mirror views
+
+Every downloaded file is recorded with its URL, size, ETag, fetch time and hits in a
+SQLite database, by default .mirror_index.sqlite3 in APP_STATIC_ROOT.
+Files older than ROWO_MIRROR_TTL are revalidated with If-None-Match, if the total size
+exceeds ROWO_MIRROR_MAX_BYTES the least recently used files are deleted.
+Files that aren't in the index, i.e. the ones committed to the repository, are never
+revalidated or deleted.
+
+Serving a file only reads the index. The hits and the last access are counted in
+memory and written every ROWO_MIRROR_HIT_FLUSH_INTERVAL seconds by a background thread,
+before every eviction and when the process exits.
+Evicting a file that is being served doesn't cut off the response, the file is opened
+before it's served and an unlinked file stays readable through the open handle.
+"""
+
+import atexit
+import logging
+import sqlite3
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import closing, contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Final
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME: Final[str] = ".mirror_index.sqlite3"
+
+COLUMNS: Final[str] = "path, url, size, etag, fetched, last_access, hits"
+
+
+@dataclass
+class MirrorEntry:
+    path: str
+    url: str
+    size: int
+    etag: str
+    fetched: float
+    last_access: float
+    hits: int
+
+    def expired(self, now: float | None = None) -> bool:
+        return (now or time.time()) - self.fetched > settings.ROWO_MIRROR_TTL
+
+
+class MirrorIndex:
+    def __init__(self, db_path: Path) -> None:
+        self.db_path = db_path
+        self.hits_lock = threading.Lock()
+        # hits and last access by path, not written yet
+        self.pending_hits: dict[str, tuple[int, float]] = {}
+        self.last_flush = time.monotonic()
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self.connect() as db:
+            # readers don't wait for the writers of other processes
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    etag TEXT NOT NULL,
+                    fetched REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+                """
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS files_last_access ON files (last_access)"
+            )
+
+    @contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        """
+        Connection for one transaction, the index is used from several threads
+        """
+        with closing(sqlite3.connect(self.db_path, timeout=10)) as db, db:
+            yield db
+
+    def count_hit(self, path: str) -> None:
+        """
+        Count a hit of the file in memory, written in the background from time to time
+        """
+        with self.hits_lock:
+            hits, _ = self.pending_hits.get(path, (0, 0.0))
+            self.pending_hits[path] = (hits + 1, time.time())
+            now = time.monotonic()
+            flush = now - self.last_flush >= settings.ROWO_MIRROR_HIT_FLUSH_INTERVAL
+            if flush:
+                self.last_flush = now
+        if flush:
+            threading.Thread(
+                target=self.flush_hits, name="mirror-hits", daemon=True
+            ).start()
+
+    def flush_hits(self) -> None:
+        with self.hits_lock:
+            pending, self.pending_hits = self.pending_hits, {}
+            self.last_flush = time.monotonic()
+        if not pending:
+            return
+        try:
+            with self.connect() as db:
+                db.executemany(
+                    """
+                    UPDATE files
+                    SET hits = hits + ?, last_access = max(last_access, ?)
+                    WHERE path = ?
+                    """,
+                    [
+                        (hits, last_access, path)
+                        for path, (hits, last_access) in pending.items()
+                    ],
+                )
+        except sqlite3.Error:
+            # the hits are only statistics and a hint for the eviction
+            logger.exception("Failed to write the hits of the mirrored files")
+
+    def get(self, path: str) -> MirrorEntry | None:
+        with self.connect() as db:
+            row = db.execute(
+                f"SELECT {COLUMNS} FROM files WHERE path = ?", (path,)
+            ).fetchone()
+        return MirrorEntry(*row) if row else None
+
+    def record(self, path: str, url: str, size: int, etag: str) -> None:
+        now = time.time()
+        with self.connect() as db:
+            db.execute(
+                """
+                INSERT INTO files (path, url, size, etag, fetched, last_access)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET
+                    url = excluded.url,
+                    size = excluded.size,
+                    etag = excluded.etag,
+                    fetched = excluded.fetched
+                """,
+                (path, url, size, etag, now, now),
+            )
+
+    def revalidated(self, path: str) -> None:
+        with self.connect() as db:
+            db.execute(
+                "UPDATE files SET fetched = ? WHERE path = ?", (time.time(), path)
+            )
+
+    def entries(self) -> list[MirrorEntry]:
+        with self.connect() as db:
+            rows = db.execute(
+                f"SELECT {COLUMNS} FROM files ORDER BY last_access DESC"
+            ).fetchall()
+        return [MirrorEntry(*row) for row in rows]
+
+    def remove(self, static_root: Path, entries: list[MirrorEntry]) -> None:
+        with self.connect() as db:
+            db.executemany(
+                "DELETE FROM files WHERE path = ?", [(entry.path,) for entry in entries]
+            )
+        for entry in entries:
+            (static_root / entry.path).unlink(missing_ok=True)
+
+    def evict(
+        self, static_root: Path, max_bytes: int, keep: str = ""
+    ) -> list[MirrorEntry]:
+        """
+        Delete the least recently used files until the rest fits into max_bytes
+        """
+        self.flush_hits()
+        entries = self.entries()
+        total = sum(entry.size for entry in entries)
+        evicted: list[MirrorEntry] = []
+        for entry in reversed(entries):
+            if total <= max_bytes:
+                break
+            if entry.path != keep:
+                evicted.append(entry)
+                total -= entry.size
+        if evicted:
+            self.remove(static_root, evicted)
+        return evicted
+
+    def purge(self, static_root: Path, expired_only: bool = False) -> list[MirrorEntry]:
+        now = time.time()
+        entries = [
+            entry for entry in self.entries() if not expired_only or entry.expired(now)
+        ]
+        self.remove(static_root, entries)
+        return entries
+
+
+@lru_cache
+def open_index(db_path: Path) -> MirrorIndex:
+    index = MirrorIndex(db_path)
+    atexit.register(index.flush_hits)
+    return index
+
+
+def get_mirror_index() -> MirrorIndex:
+    if settings.ROWO_MIRROR_INDEX:
+        return open_index(Path(settings.ROWO_MIRROR_INDEX))
+    return open_index(Path(settings.APP_STATIC_ROOT) / INDEX_NAME)
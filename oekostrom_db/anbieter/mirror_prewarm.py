@@ -0,0 +1,116 @@
+"""
+Download the assets of the survey pages into the mirror before the first visitor
+
+The templates reference the files of the RoWo homepage as {{ rowo_url }}/..., which
+the browser loads through the mirror views. The stylesheets reference further files
+with url(...) and @import, those are crawled as well. Like in the browser, relative
+references are resolved against the URL of the stylesheet. Absolute references are
+only followed to /mirror/ and /themes/, other paths aren't served by the app.
+"""
+
+import asyncio
+import posixpath
+import re
+import urllib.parse
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+from typing import Final
+
+from django.http import Http404
+from django.template.loader import get_template
+
+from .view_mirror import get_local_file
+
+TEMPLATES: Final[tuple[str, ...]] = ("anbieter/survey.html", "anbieter/startpage.html")
+
+ROWO_URL_RE: Final[re.Pattern] = re.compile(r"""\{\{\s*rowo_url\s*\}\}(/[^"'\s<>)]+)""")
+CSS_URL_RE: Final[re.Pattern] = re.compile(
+    r"""url\(\s*(?P<quote>['"]?)(?P<url>[^'")]+)(?P=quote)\s*\)"""
+    r"""|@import\s+(?P<import_quote>['"])(?P<import_url>[^'"]+)(?P=import_quote)"""
+)
+# prefixes of the URLs handled by the mirror views, see urls.py
+MIRROR_PREFIXES: Final[tuple[tuple[str, str], ...]] = (
+    ("/mirror/", ""),
+    ("/themes/", "themes/"),
+)
+
+
+def mirror_path(url: str) -> str | None:
+    """
+    Path of the file in the mirror for a URL of the app, None if it isn't mirrored
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme or parts.netloc:
+        return None
+    path = posixpath.normpath(urllib.parse.unquote(parts.path))
+    for prefix, replacement in MIRROR_PREFIXES:
+        if path.startswith(prefix):
+            return replacement + path.removeprefix(prefix)
+    return None
+
+
+def template_assets(template_names: Iterable[str] = TEMPLATES) -> list[str]:
+    """
+    Mirror paths of the {{ rowo_url }} references in the template sources
+    """
+    paths: dict[str, None] = {}
+    for name in template_names:
+        source = get_template(name).template.source
+        for match in ROWO_URL_RE.finditer(source):
+            path = mirror_path(f"/mirror{match[1]}")
+            if path:
+                paths[path] = None
+    return list(paths)
+
+
+def css_references(css_path: str, css: str) -> list[str]:
+    """
+    Mirror paths of the files referenced by the stylesheet
+    """
+    base_url = f"/mirror/{css_path}"
+    paths: dict[str, None] = {}
+    for match in CSS_URL_RE.finditer(css):
+        url = (match["url"] or match["import_url"]).strip()
+        if url.startswith(("data:", "#")):
+            continue
+        path = mirror_path(urllib.parse.urljoin(base_url, url))
+        if path:
+            paths[path] = None
+    return list(paths)
+
+
+@dataclass
+class PrewarmResult:
+    sizes: dict[str, int] = field(default_factory=dict)
+    errors: dict[str, str] = field(default_factory=dict)
+
+
+async def prewarm(paths: Iterable[str]) -> PrewarmResult:
+    """
+    Download the files and everything their stylesheets reference, concurrently
+    """
+    result = PrewarmResult()
+    pending = list(dict.fromkeys(paths))
+    seen = set(pending)
+    while pending:
+        mirrored_files = await asyncio.gather(
+            *(get_local_file(path, count_hit=False) for path in pending),
+            return_exceptions=True,
+        )
+        found: list[str] = []
+        for path, mirrored_file in zip(pending, mirrored_files, strict=True):
+            if isinstance(mirrored_file, Http404):
+                result.errors[path] = str(mirrored_file)
+                continue
+            if isinstance(mirrored_file, BaseException):
+                raise mirrored_file
+            result.sizes[path] = mirrored_file.stat.st_size
+            try:
+                if mirrored_file.path.suffix.lower() == ".css":
+                    css = await asyncio.to_thread(mirrored_file.file.read)
+                    found.extend(css_references(path, css.decode(errors="replace")))
+            finally:
+                await asyncio.to_thread(mirrored_file.close)
+        pending = [path for path in dict.fromkeys(found) if path not in seen]
+        seen.update(pending)
+    return result
@@ -1,10 +1,14 @@
+import logging
+import operator
 from collections.abc import Iterable
-from functools import cached_property
+from functools import cached_property, reduce
 from typing import Any
 
+from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models import DecimalField
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, models, router, transaction
+from django.db.models import NOT_PROVIDED, Case, DecimalField, F, Q, When
 from django.db.models.base import ModelBase
 from django.db.models.functions import Now
 from django.urls import reverse
@@ -14,6 +18,7 @@ from django.utils.html import format_html
 from django.utils.safestring import mark_safe
 from django.utils.text import slugify
 
+from .access_counter import buffer_access
 from .field_helper import generate_unique_code, get_fill_status, upload_to_power_plants
 from .fields import (
     CharField,
@@ -26,6 +31,7 @@ from .fields import (
     YesNoField,
     is_percentage,
 )
+from .hierarchy import resolve_roots
 from .layouts import (
     AlertBuilder,
     Header,
@@ -36,6 +42,8 @@ from .layouts import (
     StateLabels,
 )
 
+logger = logging.getLogger(__name__)
+
 
 class AnbieterBase(models.Model):
     name = models.CharField(max_length=255, unique=True)
@@ -195,6 +203,90 @@ STATUS_CHOICES = {
 }
 
 
+KRITERIEN_FIELDS = (
+    "nur_oeko",
+    "unabhaengigkeit",
+    "zusaetzlichkeit",
+    "money_for_ee_only",
+)
+
+
+def from_parent(field: str) -> Case:
+    """
+    Value of the field of the root Anbieter, see Anbieter.parent
+    """
+    return Case(
+        When(root_anbieter__isnull=True, then=F(field)),
+        default=F(f"root_anbieter__{field}"),
+    )
+
+
+# fields Anbieter.parent is resolved from
+HIERARCHY_LINK_FIELDS = frozenset(
+    {"mutter", "mutter_id", "sells_from", "sells_from_id"}
+)
+
+
+class AnbieterQuerySet(models.QuerySet):
+    def update(self, **kwargs) -> int:
+        if HIERARCHY_LINK_FIELDS.isdisjoint(kwargs):
+            return super().update(**kwargs)
+        pks = list(self.values_list("pk", flat=True))
+        count = super().update(**kwargs)
+        Anbieter.update_hierarchy(pks)
+        return count
+
+    update.alters_data = True
+
+    def delete(self) -> tuple[int, dict[str, int]]:
+        # the collector sets mutter/sells_from of the children without update()
+        pks = list(self.values_list("pk", flat=True))
+        children = Anbieter.linked_children(pks)
+        result = super().delete()
+        Anbieter.update_hierarchy(children)
+        return result
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def with_empfehlung(self) -> "AnbieterQuerySet":
+        """
+        Annotate the recommendation and the values it is based on, like Anbieter.ist_empfohlen
+
+        - beantwortet: survey answered by the Anbieter itself
+        - parent_beantwortet: survey answered by the parent
+        - parent_<kriterium>: the criteria of the parent
+        - parent_unerfuellt: any criterion of the parent not fulfilled
+        - empfohlen: recommended
+        """
+        if "empfohlen" in self.query.annotations:
+            return self
+        answered = Q(survey_access__current_revision__gt=1)
+        parent_answered = Q(root_anbieter__isnull=True) & answered | Q(
+            root_anbieter__isnull=False,
+            root_anbieter__survey_access__current_revision__gt=1,
+        )
+        unerfuellt = reduce(
+            operator.or_,
+            (
+                Q(root_anbieter__isnull=True, **{field: False})
+                | Q(root_anbieter__isnull=False, **{f"root_anbieter__{field}": False})
+                for field in KRITERIEN_FIELDS
+            ),
+        )
+        return self.annotate(
+            beantwortet=Case(When(answered, then=True), default=False),
+            parent_beantwortet=Case(When(parent_answered, then=True), default=False),
+            **{f"parent_{field}": from_parent(field) for field in KRITERIEN_FIELDS},
+            parent_unerfuellt=Case(When(unerfuellt, then=True), default=False),
+            empfohlen=Case(
+                When(unerfuellt, then=False),
+                When(parent_answered, then=True),
+                default=False,
+            ),
+        )
+
+
 class Anbieter(AnbieterBase):
     slug_id = models.SlugField(unique=True, default=None, max_length=255)
     active = models.BooleanField(
@@ -246,6 +338,27 @@ class Anbieter(AnbieterBase):
         verbose_name="Verkauft Strom von",
         related_name="sellers",
     )
+    # materialized result of parent, maintained by update_hierarchy when an Anbieter is
+    # saved or deleted and by AnbieterQuerySet.update/delete. bulk_update() of mutter or
+    # sells_from and raw SQL need manage.py recompute_hierarchy afterwards.
+    root_anbieter = models.ForeignKey(
+        "Anbieter",
+        on_delete=models.SET_NULL,
+        db_default=None,
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name="Wurzel Anbieter",
+        help_text="Ende der Mutter Firma/Verkauft Strom von Kette, leer für sich selbst",
+        related_name="descendants",
+    )
+    depth = models.PositiveSmallIntegerField(
+        db_default=0,
+        default=0,
+        editable=False,
+        verbose_name="Tiefe",
+        help_text="Anzahl der Schritte bis zum Wurzel Anbieter",
+    )
     ee_anteil = models.PositiveSmallIntegerField(
         null=True,
         blank=True,
@@ -328,13 +441,21 @@ class Anbieter(AnbieterBase):
         auto_now_add=True, null=True, editable=False, db_default=Now()
     )
 
+    objects = AnbieterQuerySet.as_manager()
+
     class Meta:
         verbose_name_plural = "Anbieter"
 
     def save(self, *args, **kwargs) -> None:
         if not self.slug_id:
             self.slug_id = slugify(self.name)
+        links_changed = self.links_changed
         super().save(*args, **kwargs)
+        self._loaded_links = self.links
+        if links_changed:
+            Anbieter.update_hierarchy([self.pk])
+            self.refresh_from_db(fields=["root_anbieter", "depth"])
+            self.__dict__.pop("parent", None)
         # Ensure SurveyAccess and initial CompanySurvey2024 exist
         if not SurveyAccess.objects.filter(anbieter=self).exists():
             survey = CompanySurvey2024.objects.create(anbieter=self, revision=1)
@@ -342,11 +463,38 @@ class Anbieter(AnbieterBase):
                 anbieter=self, survey=survey, code=generate_unique_code()
             )
 
+    def delete(self, *args, **kwargs):
+        # children and sellers lose their mutter/sells_from
+        children = Anbieter.linked_children([self.pk])
+        result = super().delete(*args, **kwargs)
+        Anbieter.update_hierarchy(children)
+        return result
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_links = instance.links
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None) -> None:
+        super().refresh_from_db(using, fields, from_queryset)
+        if fields is None or not HIERARCHY_LINK_FIELDS.isdisjoint(fields):
+            self._loaded_links = self.links
+
+    @property
+    def links(self) -> tuple[int | None, int | None]:
+        return self.__dict__.get("mutter_id"), self.__dict__.get("sells_from_id")
+
+    @property
+    def links_changed(self) -> bool:
+        return self.links != getattr(self, "_loaded_links", (None, None))
+
     def clean(self):
         """
         Ensure no duplicate names are created
         """
         super().clean()
+        self.clean_hierarchy()
         try:
             obj = AnbieterName.objects.get(name=self.name)
         except AnbieterName.DoesNotExist:
@@ -359,33 +507,153 @@ class Anbieter(AnbieterBase):
                 f"{self.name} ist bereits für {obj.anbieter} in Benutzung."
             )
 
+    def clean_hierarchy(self) -> None:
+        """
+        Ensure mutter/sells_from don't lead back to this Anbieter
+        """
+        if self.pk is None or self.links == (None, None) or not self.links_changed:
+            return
+        # walk the ancestors, one query per level
+        mutter_id, sells_from_id = self.links
+        hop = mutter_id if mutter_id is not None else sells_from_id
+        visited: set[int] = set()
+        while hop is not None and hop not in visited:
+            if hop == self.pk:
+                field = "mutter" if self.mutter_id is not None else "sells_from"
+                raise ValidationError(
+                    {
+                        field: "Dieser Anbieter würde sein eigener Mutter/Lieferant werden."
+                    }
+                )
+            visited.add(hop)
+            links = (
+                Anbieter.objects.filter(pk=hop)
+                .values_list("mutter_id", "sells_from_id")
+                .first()
+            )
+            if links is None:
+                break
+            hop = links[0] if links[0] is not None else links[1]
+
+    @staticmethod
+    def linked_children(pks: Iterable[int]) -> list[int]:
+        """
+        Anbieter with one of the Anbieter as mutter or sells_from, besides themselves
+        """
+        pks = list(pks)
+        return list(
+            Anbieter.objects.filter(Q(mutter__in=pks) | Q(sells_from__in=pks))
+            .exclude(pk__in=pks)
+            .values_list("pk", flat=True)
+        )
+
+    @staticmethod
+    def load_hierarchy(
+        pks: Iterable[int],
+    ) -> dict[int, tuple[int | None, int | None, int | None, int]]:
+        """
+        Links and stored root of the Anbieter, their ancestors and their descendants
+
+        The graph is walked with one query per level, up and down.
+        """
+        rows: dict[int, tuple[int | None, int | None, int | None, int]] = {}
+
+        def load(query: Q) -> list[int]:
+            found = []
+            for pk, *values in Anbieter.objects.filter(query).values_list(
+                "pk", "mutter_id", "sells_from_id", "root_anbieter_id", "depth"
+            ):
+                rows[pk] = tuple(values)
+                found.append(pk)
+            return found
+
+        start = load(Q(pk__in=list(pks)))
+        pending = start
+        while pending:
+            hops = {
+                rows[pk][0] if rows[pk][0] is not None else rows[pk][1]
+                for pk in pending
+            }
+            hops -= {None, *rows}
+            pending = load(Q(pk__in=hops)) if hops else []
+        # the Anbieter whose next hop is in the frontier
+        visited = set(start)
+        frontier = start
+        while frontier:
+            children = load(
+                Q(mutter_id__in=frontier)
+                | Q(mutter_id__isnull=True, sells_from_id__in=frontier)
+            )
+            frontier = [pk for pk in children if pk not in visited]
+            visited.update(frontier)
+        return rows
+
+    @classmethod
+    def update_hierarchy(cls, pks: Iterable[int] | None = None) -> set[int]:
+        """
+        Recompute root_anbieter and depth, returns Anbieter within cycles
+
+        Without pks all Anbieter are recomputed, otherwise the given Anbieter and their
+        descendants, resolved from their ancestors.
+        """
+        if pks is None:
+            rows = {
+                pk: tuple(values)
+                for pk, *values in Anbieter.objects.values_list(
+                    "pk", "mutter_id", "sells_from_id", "root_anbieter_id", "depth"
+                )
+            }
+        else:
+            rows = cls.load_hierarchy(pks)
+        links = {
+            pk: (mutter_id, sells_from_id)
+            for pk, (mutter_id, sells_from_id, _, _) in rows.items()
+        }
+        roots, cycles = resolve_roots(links)
+        changed = [
+            Anbieter(pk=pk, root_anbieter_id=root_id, depth=depth)
+            for pk, (root_id, depth) in roots.items()
+            if rows[pk][2:] != (root_id, depth)
+        ]
+        Anbieter.objects.bulk_update(
+            changed, ["root_anbieter", "depth"], batch_size=500
+        )
+        if cycles:
+            logger.warning(f"Anbieter with cyclic mutter/sells_from {sorted(cycles)}")
+        return cycles
+
     @classproperty
     def kriterien_fields(cls) -> tuple[str, ...]:
-        return (
-            "nur_oeko",
-            "unabhaengigkeit",
-            "zusaetzlichkeit",
-            "money_for_ee_only",
-        )
+        return KRITERIEN_FIELDS
+
+    def parent_kriterium(self, field: str) -> bool | None:
+        """
+        Criterion of the parent, taken from with_empfehlung if annotated
+        """
+        if f"parent_{field}" in self.__dict__:
+            return self.__dict__[f"parent_{field}"]
+        return getattr(self.parent, field)
 
     @property
     def nicht_nur_oekostrom(self) -> bool:
-        return self.parent.nur_oeko is False
+        return self.parent_kriterium("nur_oeko") is False
 
     @property
     def nicht_unabhangig(self) -> bool:
-        return self.parent.unabhaengigkeit is False
+        return self.parent_kriterium("unabhaengigkeit") is False
 
     @property
     def nicht_zusaetzlich(self) -> bool:
-        return self.parent.zusaetzlichkeit is False
+        return self.parent_kriterium("zusaetzlichkeit") is False
 
     @property
     def auch_kohle_oder_atom(self) -> bool:
-        return self.parent.money_for_ee_only is False
+        return self.parent_kriterium("money_for_ee_only") is False
 
     @property
     def nur_umfrage_nicht_beantwortet(self) -> bool:
+        if "parent_unerfuellt" in self.__dict__:
+            return not self.parent_unerfuellt and not self.parent_beantwortet
         if self.parent.unerfuellte_kriterien:
             return False
         return not self.parent.survey_answered
@@ -396,15 +664,13 @@ class Anbieter(AnbieterBase):
 
     @cached_property
     def parent(self) -> "Anbieter":
-        if self.mutter is not None:
-            return self.mutter.parent
-        if self.sells_from is not None:
-            return self.sells_from.parent
-        return self
+        if self.root_anbieter_id is None:
+            return self
+        return self.root_anbieter
 
     @property
     def has_parent(self) -> bool:
-        return self.parent != self
+        return self.root_anbieter_id is not None
 
     @property
     def unerfuellte_kriterien(self) -> bool:
@@ -415,6 +681,8 @@ class Anbieter(AnbieterBase):
 
     @property
     def ist_empfohlen(self) -> bool:
+        if "empfohlen" in self.__dict__:
+            return self.empfohlen
         # empfehle erstmal alles was nicht nicht empfohlen ist
         anbieter = self.parent
         if not anbieter.survey_answered:
@@ -422,9 +690,8 @@ class Anbieter(AnbieterBase):
         return not anbieter.unerfuellte_kriterien
 
     def get_nicht_erfuellte_kriterien_iter(self) -> Iterable[str]:
-        anbieter = self.parent
         for field in self.kriterien_fields:
-            if getattr(anbieter, field) is False:
+            if self.parent_kriterium(field) is False:
                 yield self._meta.get_field(field).help_text
 
     @property
@@ -453,6 +720,8 @@ class Anbieter(AnbieterBase):
 
     @property
     def survey_answered(self) -> bool | None:
+        if "beantwortet" in self.__dict__:
+            return self.beantwortet
         if self.survey_access is None:
             return None
         return self.survey_access.current_revision > 1
@@ -480,11 +749,66 @@ class UmfrageVersendung2024(Anbieter):
         help_text="Status des Mail versand",
     )
     mail_details = models.TextField(help_text="i.e. Fehlermeldung aus Mail Versand")
+    mail_queued = models.DateTimeField(
+        null=True,
+        blank=True,
+        db_default=None,
+        db_index=True,
+        editable=False,
+        verbose_name="📥 Warteschlange",
+        help_text="Zeitpunkt seit dem die Mail auf den Versand wartet",
+    )
+    mail_sending = models.DateTimeField(
+        null=True,
+        blank=True,
+        db_default=None,
+        editable=False,
+        verbose_name="📨 Versand",
+        help_text="Zeitpunkt seit dem ein Dispatcher die Mail versendet",
+    )
 
     class Meta:
         verbose_name = "Umfrage Mailversand Anbieter"
         verbose_name_plural = "Umfrage: Mailversand"
 
+    @classmethod
+    def create_for(cls, anbieter_ids: Iterable[int]) -> tuple[int, int]:
+        """
+        Create the missing rows for the Anbieter, returns created and already existing
+
+        Only the rows of this table are inserted, the Anbieter are neither copied nor
+        changed, like save_base(raw=True) does for a single instance.
+        bulk_create doesn't support multi-table inheritance, so they're inserted in
+        batches with the same low level insert as save_base uses.
+        """
+        from .facets import invalidate_facet_counts
+        from .search import invalidate_index
+
+        anbieter_ids = set(anbieter_ids)
+        existing = set(
+            cls.objects.filter(pk__in=anbieter_ids).values_list("pk", flat=True)
+        )
+        new = [cls(anbieter_id=pk) for pk in sorted(anbieter_ids - existing)]
+        if not new:
+            return 0, len(existing)
+        # fields with a database default are left to the database
+        fields = [
+            field
+            for field in cls._meta.local_concrete_fields
+            if field.db_default is NOT_PROVIDED
+        ]
+        connection = connections[router.db_for_write(cls)]
+        batch_size = max(connection.ops.bulk_batch_size(fields, new), 1)
+        with transaction.atomic(using=connection.alias):
+            for start in range(0, len(new), batch_size):
+                cls._base_manager.using(connection.alias)._insert(
+                    new[start : start + batch_size], fields=fields, raw=True
+                )
+        # no post_save is sent for the inserted rows
+        invalidate_facet_counts()
+        invalidate_index(None)
+        return len(new), len(existing)
+
 
 class AnbieterName(models.Model):
     name = models.CharField(max_length=255, unique=True)
@@ -531,6 +855,26 @@ class Template(models.Model):
         return TemplateNames(self.name).label
 
 
+class HomepageExportEntry(models.Model):
+    """
+    Last exported content of an Anbieter with the hash of everything it was rendered from
+    """
+
+    # no foreign key, the entry of a deleted Anbieter is kept to report its removal
+    anbieter_id = models.IntegerField(unique=True)
+    input_hash = models.CharField(max_length=64)
+    data = models.JSONField(encoder=DjangoJSONEncoder)
+    changed = models.DateTimeField(db_index=True)
+    removed = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Homepage Export Eintrag"
+        verbose_name_plural = "Homepage: Export Einträge"
+
+    def __str__(self) -> str:
+        return self.data.get("title", str(self.anbieter_id))
+
+
 class KeepOrderModelBase(ModelBase):
     def __new__(
         cls, name: str, bases: list[type], attrs: dict[str, Any], **kwargs
@@ -1028,6 +1372,24 @@ class CompanySurvey2024(models.Model, metaclass=KeepOrderModelBase):
         return f"anbieter={self.anbieter.name} rev={self.revision} fill_state={self._fill_status:.1f}%"
 
 
+class SurveyRevisionDelta(models.Model):
+    """
+    Old revision of a survey, stored as the fields that differ from the next revision
+    """
+
+    anbieter = models.ForeignKey(Anbieter, on_delete=models.CASCADE, editable=False)
+    revision = models.PositiveIntegerField()
+    changes = models.JSONField(encoder=DjangoJSONEncoder)
+
+    class Meta:
+        unique_together = ["anbieter", "revision"]
+        verbose_name = "Umfrage Revision (Delta)"
+        verbose_name_plural = "Umfrage: Revisionen (Delta)"
+
+    def __str__(self) -> str:
+        return f"Umfrage {self.anbieter.name} (Rev {self.revision})"
+
+
 class SurveyAccess(models.Model):
     anbieter = models.OneToOneField(
         Anbieter, on_delete=models.CASCADE, related_name="survey_access"
@@ -1054,6 +1416,13 @@ class SurveyAccess(models.Model):
         return f'{reverse("survey_update", kwargs={"code": self.code})}?view=1'
 
     def increment_access_count(self) -> None:
-        self.access_count += 1
         self.last_access = timezone.now()
-        self.save()
+        if settings.SURVEY_ACCESS_BUFFER:
+            buffer_access(self)
+            self.access_count += 1
+            return
+        # update only the counter and atomic, so concurrent requests don't get lost
+        SurveyAccess.objects.filter(pk=self.pk).update(
+            access_count=F("access_count") + 1, last_access=self.last_access
+        )
+        self.access_count += 1
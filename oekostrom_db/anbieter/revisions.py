@@ -0,0 +1,205 @@
+"""
+Delta storage of the survey revisions
+
+The current revision of a survey is always stored completely as CompanySurvey2024,
+as everything else works with it.
+With SURVEY_DELTA_REVISIONS enabled, older revisions are stored as SurveyRevisionDelta
+holding only the fields that differ from the next newer revision.
+Every SURVEY_SNAPSHOT_INTERVAL revisions one is kept completely, so reconstructing a
+revision never needs more than that many deltas.
+"""
+
+import logging
+from decimal import Decimal
+from typing import TYPE_CHECKING, Any
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.backends.utils import format_number
+
+from .models import CompanySurvey2024, SurveyRevisionDelta
+
+if TYPE_CHECKING:
+    from .models import Anbieter
+
+logger = logging.getLogger(__name__)
+
+# fields identifying the revision, everything else is part of the delta
+KEY_FIELDS = {"id", "anbieter", "revision"}
+
+DELTA_FIELDS: list[models.Field] = [
+    field
+    for field in CompanySurvey2024._meta.concrete_fields
+    if field.name not in KEY_FIELDS
+]
+
+
+def is_snapshot(revision: int) -> bool:
+    return revision % settings.SURVEY_SNAPSHOT_INTERVAL == 0
+
+
+def survey_values(survey: CompanySurvey2024) -> dict[str, Any]:
+    values: dict[str, Any] = {}
+    for field in DELTA_FIELDS:
+        value = getattr(survey, field.attname)
+        if isinstance(field, models.FileField):
+            value = value.name
+        elif isinstance(field, models.DecimalField) and value is not None:
+            # as stored in the database, i.e. the fill status is set as float
+            value = Decimal(
+                format_number(
+                    field.to_python(value), field.max_digits, field.decimal_places
+                )
+            )
+        values[field.attname] = value
+    return values
+
+
+def diff_values(old: dict[str, Any], new: dict[str, Any]) -> dict[str, Any]:
+    """
+    Values of old that differ from new
+    """
+    return {key: value for key, value in old.items() if new.get(key) != value}
+
+
+def apply_changes(values: dict[str, Any], changes: dict[str, Any]) -> dict[str, Any]:
+    """
+    Values of the older revision from the values of the newer one and the delta
+    """
+    values = values.copy()
+    for field in DELTA_FIELDS:
+        if field.attname in changes:
+            value = changes[field.attname]
+            values[field.attname] = None if value is None else field.to_python(value)
+    return values
+
+
+def build_survey(
+    anbieter_id: int, revision: int, values: dict[str, Any]
+) -> CompanySurvey2024:
+    return CompanySurvey2024(anbieter_id=anbieter_id, revision=revision, **values)
+
+
+def get_survey_revision(
+    anbieter: "Anbieter", revision: int
+) -> CompanySurvey2024 | None:
+    """
+    Load the revision of the survey, reconstruct it from deltas if it's not stored completely
+    """
+    survey = (
+        CompanySurvey2024.objects.filter(anbieter=anbieter, revision__gte=revision)
+        .order_by("revision")
+        .first()
+    )
+    if survey is None or survey.revision == revision:
+        return survey
+    deltas = list(
+        SurveyRevisionDelta.objects.filter(
+            anbieter=anbieter, revision__gte=revision, revision__lt=survey.revision
+        ).order_by("-revision")
+    )
+    if [delta.revision for delta in deltas] != list(
+        range(survey.revision - 1, revision - 1, -1)
+    ):
+        logger.warning(f"Revision {revision} of {anbieter.name} can't be reconstructed")
+        return None
+    values = survey_values(survey)
+    for delta in deltas:
+        values = apply_changes(values, delta.changes)
+    reconstructed = build_survey(anbieter.pk, revision, values)
+    reconstructed.anbieter = anbieter
+    return reconstructed
+
+
+def store_as_delta(previous_pk: int, survey: CompanySurvey2024) -> None:
+    """
+    Replace the previous revision by its delta to the just saved survey
+    """
+    previous = CompanySurvey2024.objects.get(pk=previous_pk)
+    if is_snapshot(previous.revision) or previous.revision != survey.revision - 1:
+        return
+    changes = diff_values(survey_values(previous), survey_values(survey))
+    with transaction.atomic():
+        SurveyRevisionDelta.objects.create(
+            anbieter_id=previous.anbieter_id,
+            revision=previous.revision,
+            changes=changes,
+        )
+        previous.delete()
+
+
+def compact_revisions(anbieter_id: int, current_revision: int) -> int:
+    """
+    Convert all complete revisions that are neither the current one nor a snapshot to deltas
+    """
+    surveys = {
+        survey.revision: survey
+        for survey in CompanySurvey2024.objects.filter(anbieter_id=anbieter_id)
+    }
+    deltas = {
+        delta.revision: delta
+        for delta in SurveyRevisionDelta.objects.filter(anbieter_id=anbieter_id)
+    }
+    new_deltas: list[SurveyRevisionDelta] = []
+    obsolete: list[int] = []
+    # values of the revision above the one processed, None if it's missing
+    newer: dict[str, Any] | None = None
+    for revision in range(current_revision, 0, -1):
+        if revision in surveys:
+            values = survey_values(surveys[revision])
+            if newer is not None and not is_snapshot(revision):
+                new_deltas.append(
+                    SurveyRevisionDelta(
+                        anbieter_id=anbieter_id,
+                        revision=revision,
+                        changes=diff_values(values, newer),
+                    )
+                )
+                obsolete.append(surveys[revision].pk)
+        elif revision in deltas and newer is not None:
+            values = apply_changes(newer, deltas[revision].changes)
+        else:
+            values = None
+        newer = values
+    with transaction.atomic():
+        SurveyRevisionDelta.objects.bulk_create(new_deltas)
+        # never delete the survey of the access, that would delete the access as well
+        CompanySurvey2024.objects.filter(pk__in=obsolete, surveyaccess=None).delete()
+    return len(new_deltas)
+
+
+def expand_revisions(anbieter_id: int, current_revision: int) -> int:
+    """
+    Store all revisions completely again
+    """
+    newer: dict[str, Any] | None = None
+    surveys = {
+        survey.revision: survey
+        for survey in CompanySurvey2024.objects.filter(anbieter_id=anbieter_id)
+    }
+    deltas = {
+        delta.revision: delta
+        for delta in SurveyRevisionDelta.objects.filter(anbieter_id=anbieter_id)
+    }
+    new_surveys: list[CompanySurvey2024] = []
+    for revision in range(current_revision, 0, -1):
+        if revision in surveys:
+            newer = survey_values(surveys[revision])
+        elif revision in deltas and newer is not None:
+            newer = apply_changes(newer, deltas[revision].changes)
+            new_surveys.append(build_survey(anbieter_id, revision, newer))
+        else:
+            newer = None
+    created = [survey.created for survey in new_surveys]
+    with transaction.atomic():
+        # bulk_create doesn't call save(), so the fill status of the delta is kept
+        CompanySurvey2024.objects.bulk_create(new_surveys)
+        # but the creation time is overwritten by auto_now_add
+        for survey, timestamp in zip(new_surveys, created, strict=True):
+            survey.created = timestamp
+        CompanySurvey2024.objects.bulk_update(new_surveys, ["created"])
+        SurveyRevisionDelta.objects.filter(
+            anbieter_id=anbieter_id,
+            revision__in=[survey.revision for survey in new_surveys],
+        ).delete()
+    return len(new_surveys)
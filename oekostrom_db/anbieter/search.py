@@ -0,0 +1,245 @@
+"""
+Fuzzy search of the Anbieter by all their names
+
+Besides Anbieter.name the alternative spellings in AnbieterName and the names in the
+scrape tables are searched, every match is returned as its Anbieter.
+A name matches if it contains the search term or if the term is similar to a word of
+the name (pg_trgm word similarity). The Anbieter are ranked by their best matching name.
+
+On PostgreSQL the names are searched with one query using the trigram indexes of
+migration 0029. For other databases, i.e. SQLite in development, the trigrams of all
+names are kept in memory and the similarity is computed like pg_trgm does, so both
+return the same ranking. That index is rebuilt after a name was saved or deleted.
+"""
+
+import re
+import threading
+from collections import defaultdict
+from collections.abc import Iterable
+from dataclasses import dataclass
+from typing import Final
+
+from django.contrib.postgres.search import TrigramWordSimilarity
+from django.db import connection
+from django.db.models import F, Model, Q, QuerySet, TextField
+from django.db.models.functions import Cast, Upper
+
+from .models import (
+    Anbieter,
+    AnbieterName,
+    Oekotest,
+    OkPower,
+    Rowo2019,
+    Stromauskunft,
+    Verivox,
+)
+
+# default of pg_trgm.word_similarity_threshold, used by the trigram_word_similar lookup
+WORD_SIMILARITY_THRESHOLD: Final[float] = 0.6
+
+SCRAPE_FIELDS: Final[tuple[str, ...]] = (
+    "rowo_2019",
+    "oekotest",
+    "ok_power",
+    "stromauskunft",
+    "verivox",
+)
+# models whose names are searched, to invalidate the in-memory index
+NAME_MODELS: Final[tuple[type[Model], ...]] = (
+    Anbieter,
+    AnbieterName,
+    Oekotest,
+    OkPower,
+    Rowo2019,
+    Stromauskunft,
+    Verivox,
+)
+# model, path to the id of the Anbieter, path to the name
+NAME_SOURCES: Final[tuple[tuple[type[Model], str, str], ...]] = (
+    (Anbieter, "pk", "name"),
+    (AnbieterName, "anbieter_id", "name"),
+    *((Anbieter, "pk", f"{field}__name") for field in SCRAPE_FIELDS),
+    *((AnbieterName, "anbieter_id", f"{field}__name") for field in SCRAPE_FIELDS),
+)
+
+
+def trigram_list(text: str) -> list[str]:
+    """
+    Trigrams of the words in order like pg_trgm, two spaces before and one after a word
+    """
+    result: list[str] = []
+    for word in re.findall(r"[^\W_]+", text.lower()):
+        padded = f"  {word} "
+        result.extend(padded[index : index + 3] for index in range(len(padded) - 2))
+    return result
+
+
+def trigrams(text: str) -> set[str]:
+    return set(trigram_list(text))
+
+
+def word_similarity(term: str, name: str) -> float:
+    """
+    Greatest similarity of the term and any continuous extent of the trigrams of the
+    name, the same as word_similarity() of pg_trgm
+    """
+    term_trigrams = trigrams(term)
+    name_trigrams = trigram_list(name)
+    if not term_trigrams or not name_trigrams:
+        return 0.0
+    found = [trigram in term_trigrams for trigram in name_trigrams]
+
+    def similarity(count: int, extent_unique: int) -> float:
+        return count / (len(term_trigrams) + extent_unique - count)
+
+    best = 0.0
+    # position of the last occurrence of every trigram within the extent
+    last_position: dict[str, int] = {}
+    lower = -1
+    count = extent_unique = 0
+    for index, trigram in enumerate(name_trigrams):
+        if lower >= 0 or found[index]:
+            if trigram not in last_position:
+                extent_unique += 1
+                count += found[index]
+            last_position[trigram] = index
+        if not found[index]:
+            continue
+        # the extent ends with a trigram of the term, find its best start
+        if lower == -1:
+            lower = index
+            extent_unique = 1
+        current = similarity(count, extent_unique)
+        start_count, start_unique, previous_lower = count, extent_unique, lower
+        for start in range(lower, index + 1):
+            candidate = similarity(start_count, start_unique)
+            if candidate > current:
+                current = candidate
+                lower, count, extent_unique = start, start_count, start_unique
+            if last_position[name_trigrams[start]] == start:
+                start_unique -= 1
+                start_count -= found[start]
+        best = max(best, current)
+        for start in range(previous_lower, lower):
+            if last_position.get(name_trigrams[start]) == start:
+                del last_position[name_trigrams[start]]
+    return best
+
+
+@dataclass(frozen=True)
+class Match:
+    anbieter_id: int
+    name: str
+    score: float
+
+
+def rank(matches: Iterable[Match], limit: int | None = None) -> list[int]:
+    """
+    Ids of the Anbieter ordered by their best matching name
+    """
+    ranked = sorted(matches, key=lambda match: (-match.score, match.name))
+    # the first occurrence of every Anbieter is its best match
+    return list(dict.fromkeys(match.anbieter_id for match in ranked))[:limit]
+
+
+class TrigramIndex:
+    """
+    Trigrams of all names in memory, for databases without pg_trgm
+    """
+
+    def __init__(self, names: Iterable[tuple[int, str]]) -> None:
+        self.names = sorted(set(names))
+        self.lower_names = [name.lower() for _, name in self.names]
+        self.postings: defaultdict[str, list[int]] = defaultdict(list)
+        for index, (_, name) in enumerate(self.names):
+            for trigram in trigrams(name):
+                self.postings[trigram].append(index)
+
+    @classmethod
+    def load(cls) -> "TrigramIndex":
+        return cls(
+            (anbieter_id, name)
+            for model, id_path, name_path in NAME_SOURCES
+            for anbieter_id, name in model.objects.filter(
+                **{f"{name_path}__isnull": False}
+            ).values_list(id_path, name_path)
+        )
+
+    def search(self, term: str) -> list[Match]:
+        # only names with a trigram of the term can be similar
+        candidates: set[int] = set()
+        for trigram in trigrams(term):
+            candidates.update(self.postings.get(trigram, ()))
+        lower_term = term.lower()
+        matches: list[Match] = []
+        for index, (anbieter_id, name) in enumerate(self.names):
+            contains = lower_term in self.lower_names[index]
+            if index not in candidates and not contains:
+                continue
+            score = word_similarity(term, name) if index in candidates else 0.0
+            if score >= WORD_SIMILARITY_THRESHOLD or contains:
+                matches.append(Match(anbieter_id, name, score))
+        return matches
+
+
+index_lock = threading.Lock()
+trigram_index: TrigramIndex | None = None
+
+
+def get_trigram_index() -> TrigramIndex:
+    global trigram_index  # noqa: PLW0603
+    with index_lock:
+        if trigram_index is None:
+            trigram_index = TrigramIndex.load()
+        return trigram_index
+
+
+def invalidate_index(sender, **kwargs) -> None:  # noqa: ARG001
+    global trigram_index  # noqa: PLW0603
+    with index_lock:
+        trigram_index = None
+
+
+def postgres_queryset(term: str) -> QuerySet:
+    """
+    Ids, names and similarity of the matching names, using the trigram indexes
+    """
+    querysets = []
+    for model, id_path, name_path in NAME_SOURCES:
+        # the same expression as the index and the icontains lookup
+        search_name = Upper(Cast(name_path, TextField()))
+        querysets.append(
+            model.objects.alias(search_name=search_name)
+            .filter(
+                Q(**{f"{name_path}__icontains": term})
+                | Q(search_name__trigram_word_similar=term)
+            )
+            .annotate(
+                search_id=F(id_path),
+                search_score=TrigramWordSimilarity(term, F("search_name")),
+            )
+            .values_list("search_id", name_path, "search_score")
+            .order_by()
+        )
+    return querysets[0].union(*querysets[1:], all=True)
+
+
+def search_postgres(term: str) -> list[Match]:
+    return [
+        Match(anbieter_id, name, score)
+        for anbieter_id, name, score in postgres_queryset(term)
+    ]
+
+
+def search_anbieter(term: str, limit: int | None = None) -> list[int]:
+    """
+    Ids of the Anbieter matching the term, best match first
+    """
+    term = term.strip()
+    if not term:
+        return []
+    if connection.vendor == "postgresql":
+        matches = search_postgres(term)
+    else:
+        matches = get_trigram_index().search(term)
+    return rank(matches, limit)
@@ -0,0 +1,93 @@
+"""
+Helper to stream large responses, like the homepage export
+"""
+
+import asyncio
+import json
+import os
+import textwrap
+from collections.abc import AsyncIterator, Iterable, Iterator
+from itertools import islice
+from typing import Any, BinaryIO
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, HttpRequest, StreamingHttpResponse
+
+# bytes read at once when streaming a file
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+def iter_json_list(items: Iterable[Any], indent: int = 4) -> Iterator[str]:
+    """
+    Encode the items as JSON list piece by piece, same output as json.dumps(list(items), indent)
+    """
+    prefix = " " * indent
+    first = True
+    for item in items:
+        # strings are escaped, so every line of the item is part of the structure
+        yield ("[\n" if first else ",\n") + textwrap.indent(
+            json.dumps(item, indent=indent), prefix
+        )
+        first = False
+    yield "[]" if first else "\n]"
+
+
+async def aiter_in_thread(
+    iterator: Iterator[str], batch_size: int
+) -> AsyncIterator[str]:
+    """
+    Consume a synchronous iterator (i.e. database access) in the thread of the sync views
+    """
+    next_batch = sync_to_async(
+        lambda: "".join(islice(iterator, batch_size)), thread_sensitive=True
+    )
+    while batch := await next_batch():
+        yield batch
+
+
+def streaming_response(
+    request: HttpRequest, content: Iterator[str], batch_size: int = 20, **kwargs: Any
+) -> StreamingHttpResponse:
+    """
+    Stream the content, without the ASGI handler collecting the whole sync iterator first
+    """
+    if isinstance(request, ASGIRequest):
+        return StreamingHttpResponse(aiter_in_thread(content, batch_size), **kwargs)
+    return StreamingHttpResponse(content, **kwargs)
+
+
+class AsyncFileIterator:
+    """
+    Read the open file in a worker thread, chunk by chunk
+
+    The response calls close() when it's done, even if the content was never read.
+    """
+
+    def __init__(self, file: BinaryIO, chunk_size: int = FILE_CHUNK_SIZE) -> None:
+        self.file = file
+        self.chunk_size = chunk_size
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        while chunk := await asyncio.to_thread(self.file.read, self.chunk_size):
+            yield chunk
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def file_response(
+    request: HttpRequest, file: BinaryIO, **kwargs: Any
+) -> StreamingHttpResponse:
+    """
+    Stream the open file, the ASGI handler would read a FileResponse into memory first
+
+    The size is taken from the handle, so it matches the content even if the file is
+    replaced or deleted in the meantime.
+    """
+    if isinstance(request, ASGIRequest):
+        response = StreamingHttpResponse(AsyncFileIterator(file), **kwargs)
+        response["Content-Length"] = str(os.fstat(file.fileno()).st_size)
+        return response
+    # WSGI servers send it with their file wrapper, i.e. os.sendfile
+    return FileResponse(file, **kwargs)
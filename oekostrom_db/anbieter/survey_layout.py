@@ -0,0 +1,142 @@
+"""
+Precompiled layout of the survey form
+
+Walking the ~90 attributes of the survey model, sorting out sections, labels and fields
+and creating the crispy layout objects is the same for every request.
+So we do it once per model class and only evaluate the request dependent parts
+(i.e. the PercentChecker) when building the form helper.
+"""
+
+import hashlib
+import logging
+from functools import cached_property
+from typing import TYPE_CHECKING, Any
+
+from django.db.models.query_utils import DeferredAttribute
+
+from .fragment_cache import compile_fragments
+from .layouts import LayoutElement, PercentChecker, Section
+
+if TYPE_CHECKING:
+    from crispy_forms.layout import LayoutObject
+    from django.db.models import Field, Model
+
+logger = logging.getLogger(__name__)
+
+
+def _stable_repr(value: Any) -> str:
+    """
+    repr that does not contain memory addresses so it stays the same across processes
+    """
+    if callable(value):
+        return f"{value.__module__}.{value.__qualname__}"
+    if isinstance(value, list | tuple):
+        return repr(tuple(_stable_repr(v) for v in value))
+    return repr(value)
+
+
+class CheckerSlot:
+    """
+    Placeholder within the layout for a PercentChecker, as its result depends on the data
+    """
+
+    def __init__(self, checker: PercentChecker, section: str, section_id: str) -> None:
+        self.checker = checker
+        self.section = section
+        self.section_id = section_id
+
+
+class SurveyLayoutPlan:
+    def __init__(self, model: type["Model"]) -> None:
+        self.model = model
+        self.field_order: tuple[str, ...] = model._field_order
+        self.field_to_section: dict[str, str] = {}
+        self.field_to_name: dict[str, str] = {}
+        self.items: list[LayoutElement | CheckerSlot | LayoutObject | str] = []
+        self._build()
+        self.version = self._calc_version()
+
+    def _build(self) -> None:
+        section = ""
+        section_id = ""
+        for field_name in self.field_order:
+            field = getattr(self.model, field_name)
+            if isinstance(field, PercentChecker):
+                self.items.append(CheckerSlot(field, section, section_id))
+            elif isinstance(field, LayoutElement):
+                if isinstance(field, Section):
+                    section = field.name
+                    section_id = field_name
+                field.field_name = field_name
+                self.items.append(field)
+            else:
+                if isinstance(field, DeferredAttribute):
+                    field: Field = field.field
+                if getattr(field, "name", False):
+                    self.field_to_section[field.name] = section
+                    self.field_to_name[field.name] = field.verbose_name
+                if hasattr(field, "bootstrap_field"):
+                    self.items.append(field.bootstrap_field(field_name))
+                elif getattr(field, "editable", False):
+                    self.items.append(field_name)
+
+    def _calc_version(self) -> str:
+        """
+        Fingerprint of the model definition, changes whenever the survey is changed
+        """
+        parts: list[str] = []
+        for field_name in self.field_order:
+            field = getattr(self.model, field_name)
+            if isinstance(field, DeferredAttribute):
+                field = field.field
+            if isinstance(field, LayoutElement):
+                parts.append(f"{field_name}={field.__html__()}")
+            elif isinstance(field, PercentChecker):
+                parts.append(f"{field_name}={field.fields}")
+            elif hasattr(field, "deconstruct"):
+                _, path, args, kwargs = field.deconstruct()
+                kwargs = {k: _stable_repr(v) for k, v in kwargs.items()}
+                parts.append(f"{field_name}={path}{args}{kwargs}")
+            else:
+                parts.append(field_name)
+        return hashlib.sha1("\n".join(parts).encode()).hexdigest()[:12]
+
+    @cached_property
+    def fragment_items(self) -> list[Any]:
+        """
+        Items with static parts combined and fields wrapped for the fragment cache
+        """
+        return compile_fragments(self.items)
+
+    def layout_fields(
+        self, data: dict[str, Any], fragments: bool = False
+    ) -> tuple[list["LayoutObject | str"], list[tuple[str, str]]]:
+        """
+        Return the layout fields for the given data and the sections with failed checks
+        """
+        field_list: list[LayoutObject | str] = []
+        checks_failed: list[tuple[str, str]] = []
+        for item in self.fragment_items if fragments else self.items:
+            if isinstance(item, CheckerSlot):
+                layout, check_okay = item.checker.check(data)
+                field_list.append(layout)
+                if not check_okay:
+                    checks_failed.append((item.section, item.section_id))
+            else:
+                field_list.append(item)
+        return field_list, checks_failed
+
+
+_plans: dict[type["Model"], SurveyLayoutPlan] = {}
+
+
+def get_survey_layout_plan(model: type["Model"]) -> SurveyLayoutPlan:
+    """
+    Get the compiled layout for the model, only rebuild it if the model changed
+    """
+    plan = _plans.get(model)
+    if plan is None or plan.field_order is not model._field_order:
+        plan = SurveyLayoutPlan(model)
+        _plans[model] = plan
+        logger.debug(f"Compiled survey layout for {model.__name__} {plan.version=}")
+    return plan
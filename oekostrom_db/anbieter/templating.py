@@ -0,0 +1,90 @@
+"""
+Shared Jinja environment for the templates stored in the database
+
+Template rows are compiled once and reused for every Anbieter instead of parsing the
+source again for each of them.
+The compiled templates are kept in the environment keyed by the hash of their content,
+so an edited Template gets a new entry and never uses an outdated compilation.
+The compiled bytecode is additionally stored in the JINJA_BYTECODE_CACHE_ALIAS cache,
+which allows other processes to skip the compilation as well.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from collections.abc import Callable
+from typing import Final
+
+from django.conf import settings
+from django.core.cache import caches
+from jinja2 import BaseLoader, Environment, MemcachedBytecodeCache
+from jinja2 import Template as JinjaTemplate
+from jinja2.exceptions import TemplateNotFound
+
+# compiled templates kept in memory, the templates of all Template rows fit easily
+CACHE_SIZE: Final[int] = 64
+BYTECODE_KEY_PREFIX: Final[str] = "jinja-bytecode/"
+
+
+def content_hash(source: str) -> str:
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+class ContentHashLoader(BaseLoader):
+    """
+    Loads templates by the hash of their content
+
+    The source has to be registered with add() before, only the CACHE_SIZE most recent
+    sources are kept, the same as compiled templates in the environment.
+    """
+
+    def __init__(self, size: int = CACHE_SIZE) -> None:
+        self.size = size
+        self.sources: OrderedDict[str, str] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, source: str) -> str:
+        name = content_hash(source)
+        with self.lock:
+            self.sources[name] = source
+            self.sources.move_to_end(name)
+            while len(self.sources) > self.size:
+                self.sources.popitem(last=False)
+        return name
+
+    def get_source(
+        self,
+        environment: Environment,  # noqa: ARG002
+        template: str,
+    ) -> tuple[str, str | None, Callable[[], bool]]:
+        with self.lock:
+            source = self.sources.get(template)
+        if source is None:
+            raise TemplateNotFound(template)
+        # the content can't change without changing the name
+        return source, None, lambda: True
+
+
+class DjangoBytecodeCache(MemcachedBytecodeCache):
+    """
+    Bytecode stored in a Django cache, the cache has the interface expected from memcached
+    """
+
+    def __init__(self, alias: str) -> None:
+        super().__init__(caches[alias], prefix=BYTECODE_KEY_PREFIX)
+
+
+loader = ContentHashLoader()
+environment = Environment(
+    loader=loader,
+    cache_size=CACHE_SIZE,
+    auto_reload=False,
+    bytecode_cache=DjangoBytecodeCache(settings.JINJA_BYTECODE_CACHE_ALIAS),
+)
+
+
+def get_template(source: str) -> JinjaTemplate:
+    """
+    Compiled template of the source, only compiled the first time it's requested
+    """
+    return environment.get_template(loader.add(source))
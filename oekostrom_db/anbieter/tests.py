@@ -1 +1,1565 @@
-# Create your tests here.
+import asyncio
+import json
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from importlib import import_module
+from io import StringIO
+from pathlib import Path
+from unittest import mock, skipUnless
+from urllib.parse import urlencode
+
+from asgiref.sync import sync_to_async
+from crispy_forms.utils import render_crispy_form
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.exceptions import ValidationError
+from django.core.mail.backends import locmem
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, connections
+from django.forms import FileInput
+from django.http import Http404
+from django.test import (
+    AsyncRequestFactory,
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from oekostrom_db import health
+
+from . import access_counter, mirror_prewarm, templating, view_mirror
+from .access_counter import flush_access_counts, get_counter_cache, merge_pending_counts
+from .admin import AnbieterAdmin, RenderException, get_homepage_export_data
+from .export import get_homepage_export_delta, update_homepage_export
+from .facets import get_generation, invalidate_facet_counts
+from .field_helper import fill_status_expression, get_fill_status
+from .fragment_cache import get_fragment_cache
+from .layouts import State
+from .mail_dispatch import (
+    dispatch_progress,
+    dispatch_queued,
+    dispatch_running,
+    queue_survey_emails,
+    queued_mails,
+)
+from .mirror_cache import get_mirror_index
+from .models import (
+    Anbieter,
+    AnbieterName,
+    CompanySurvey2024,
+    SurveyAccess,
+    SurveyRevisionDelta,
+    Template,
+    TemplateNames,
+    UmfrageVersendung2024,
+    Verivox,
+)
+from .revisions import compact_revisions, expand_revisions
+from .search import (
+    get_trigram_index,
+    postgres_queryset,
+    search_anbieter,
+    search_postgres,
+    word_similarity,
+)
+from .survey_layout import SurveyLayoutPlan, get_survey_layout_plan
+from .templating import get_template
+from .views import SurveyView, gen_survey_helper
+
+
+def survey_post_data(survey: CompanySurvey2024, **changes: str) -> dict[str, str]:
+    """
+    Data of the survey as the form would post it
+    """
+    form_class = SurveyView().get_form_class()
+    form = form_class(
+        instance=survey, current_revision=survey.revision, request_path=""
+    )
+    data = {
+        name: "" if bound_field.value() is None else str(bound_field.value())
+        for name, bound_field in form._bound_items()
+        if not isinstance(bound_field.field.widget, FileInput)
+    }
+    return data | changes
+
+
+class SurveyViewQueryTest(TestCase):
+    """
+    Every survey request must only need a fixed number of queries
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.anbieter = Anbieter.objects.create(name="Test Anbieter")
+        cls.access = SurveyAccess.objects.get(anbieter=cls.anbieter)
+        cls.url = reverse("survey_update", kwargs={"code": cls.access.code})
+
+    def post_data(self, **changes: str) -> dict[str, str]:
+        return survey_post_data(self.access.survey, **changes)
+
+    def test_get(self):
+        # access with survey and anbieter, access counter
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url)
+        self.assertEqual(response.context["view"].state, State.start)
+        self.access.refresh_from_db()
+        self.assertEqual(self.access.access_count, 1)
+        self.assertIsNotNone(self.access.last_access)
+
+    def test_get_view(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, {"view": 1})
+        self.assertEqual(response.context["view"].state, State.view_only)
+        self.access.refresh_from_db()
+        self.assertEqual(self.access.access_count, 0)
+
+    def test_get_view_revision(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url, {"view": 1, "rev": 1})
+        self.assertEqual(response.context["view"].state, State.view_only)
+
+    def test_post_unchanged(self):
+        data = self.post_data()
+        with self.assertNumQueries(2):
+            response = self.client.post(self.url, data)
+        self.assertEqual(response.context["view"].state, State.unchanged)
+
+    def test_post_invalid(self):
+        data = self.post_data(hydro_power="500")
+        with self.assertNumQueries(2):
+            response = self.client.post(self.url, data)
+        self.assertEqual(response.context["view"].state, State.error)
+
+    def test_post_valid(self):
+        # access, counter, insert new revision, update access
+        data = self.post_data(name="Neuer Name")
+        with self.assertNumQueries(4):
+            response = self.client.post(self.url, data)
+        self.assertEqual(response.context["view"].state, State.saved)
+        self.access.refresh_from_db()
+        self.assertEqual(self.access.current_revision, 2)
+        self.assertEqual(self.access.survey.name, "Neuer Name")
+        self.assertEqual(self.access.access_count, 1)
+
+
+class FragmentCacheTest(TestCase):
+    """
+    The survey rendered from cached fragments must be identical to the uncached one
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        anbieter = Anbieter.objects.create(name="Test Anbieter")
+        cls.survey = SurveyAccess.objects.get(anbieter=anbieter).survey
+
+    def setUp(self):
+        get_fragment_cache().clear()
+
+    def render(self, fragments: bool, data: dict[str, str] | None = None) -> str:
+        form_class = SurveyView().get_form_class()
+        form = form_class(
+            data=data,
+            instance=self.survey,
+            current_revision=self.survey.revision,
+            request_path="",
+        )
+        state = State.start
+        if data is not None:
+            state = State.saved if form.is_valid() else State.error
+        with override_settings(SURVEY_FRAGMENT_CACHE=fragments):
+            helper = gen_survey_helper(form, state, add_save_button=True)
+            return render_crispy_form(
+                form,
+                helper,
+                {"tag": "div", "wrapper_class": "form-group row align-items-center"},
+            )
+
+    def assert_cached_identical(self, data: dict[str, str] | None = None) -> str:
+        uncached = self.render(fragments=False, data=data)
+        self.assertEqual(self.render(fragments=True, data=data), uncached, "cold")
+        # everything is taken from the cache
+        with mock.patch.object(get_fragment_cache(), "set_many") as set_many:
+            self.assertEqual(self.render(fragments=True, data=data), uncached, "warm")
+        set_many.assert_not_called()
+        return uncached
+
+    def test_unbound(self):
+        self.assert_cached_identical()
+
+    def test_bound(self):
+        self.assert_cached_identical(survey_post_data(self.survey, name="Neuer Name"))
+
+    def test_invalid(self):
+        html = self.assert_cached_identical(
+            survey_post_data(self.survey, hydro_power="500")
+        )
+        self.assertIn("invalid-feedback", html)
+        # the same value without the error comes from the cache again
+        self.assert_cached_identical(survey_post_data(self.survey))
+
+    def test_changed_value_misses(self):
+        self.assert_cached_identical()
+        html = self.assert_cached_identical(
+            survey_post_data(self.survey, name="Geänderter Name")
+        )
+        self.assertIn("Geänderter Name", html)
+
+    def test_changed_field_order_misses(self):
+        before = self.assert_cached_identical()
+        field_order = list(CompanySurvey2024._field_order)
+        street, plz = field_order.index("street"), field_order.index("plz")
+        field_order[street], field_order[plz] = field_order[plz], field_order[street]
+        with mock.patch.object(CompanySurvey2024, "_field_order", tuple(field_order)):
+            after = self.assert_cached_identical()
+        self.assertNotEqual(after, before)
+        self.assertLess(after.index('name="plz"'), after.index('name="street"'))
+
+
+class SurveyLayoutPlanTest(TestCase):
+    def test_reused_until_field_order_changes(self):
+        anbieter = Anbieter.objects.create(name="Test Anbieter")
+        survey = SurveyAccess.objects.get(anbieter=anbieter).survey
+        form_class = SurveyView().get_form_class()
+
+        def build_form() -> None:
+            form = form_class(
+                instance=survey, current_revision=survey.revision, request_path=""
+            )
+            gen_survey_helper(form, State.start, add_save_button=True)
+
+        build_form()
+        plan = get_survey_layout_plan(CompanySurvey2024)
+        with mock.patch(
+            "anbieter.survey_layout.SurveyLayoutPlan", wraps=SurveyLayoutPlan
+        ) as plan_class:
+            build_form()
+            plan_class.assert_not_called()
+
+            field_order = tuple(reversed(CompanySurvey2024._field_order))
+            with mock.patch.object(CompanySurvey2024, "_field_order", field_order):
+                build_form()
+                plan_class.assert_called_once_with(CompanySurvey2024)
+                changed_plan = get_survey_layout_plan(CompanySurvey2024)
+                self.assertIs(changed_plan.field_order, field_order)
+                self.assertNotEqual(changed_plan.version, plan.version)
+            build_form()
+            self.assertEqual(plan_class.call_count, 2)
+        self.assertEqual(
+            get_survey_layout_plan(CompanySurvey2024).version, plan.version
+        )
+
+
+class BenchmarkCommandTest(SimpleTestCase):
+    def benchmark(self, *args: str) -> str:
+        # in its own process, as the benchmark settings use their own database
+        result = subprocess.run(
+            [
+                sys.executable,
+                "manage.py",
+                "benchmark_survey",
+                "--settings=oekostrom_db.settings_benchmark",
+                "--anbieter=2",
+                "--revisions=1",
+                "--repeat=1",
+                *args,
+            ],
+            capture_output=True,
+            text=True,
+            cwd=settings.BASE_DIR,
+            check=False,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return result.stdout
+
+    def test_output_and_compare(self):
+        with tempfile.TemporaryDirectory() as directory:
+            first = Path(directory) / "first.json"
+            second = Path(directory) / "second.json"
+            self.benchmark(
+                "--scenario=get_edit", "--scenario=render", f"--output={first}"
+            )
+            results = json.loads(first.read_text())
+            self.assertEqual(set(results["scenarios"]), {"get_edit", "render"})
+            self.assertEqual(results["scenarios"]["get_edit"]["queries"], 2)
+
+            output = self.benchmark(
+                "--scenario=get_edit", f"--compare={first}", f"--output={second}"
+            )
+            self.assertIn("Compared to", output)
+            self.assertRegex(output, r"get_edit: p50_ms +[+-]\d")
+            self.assertEqual(
+                set(json.loads(second.read_text())["scenarios"]), {"get_edit"}
+            )
+
+
+@override_settings(SURVEY_ACCESS_BUFFER=True, SURVEY_ACCESS_FLUSH_INTERVAL=3600)
+class BufferedAccessCountTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.access = Anbieter.objects.create(name="Test Anbieter").survey_access
+        cls.url = reverse("survey_update", kwargs={"code": cls.access.code})
+
+    def setUp(self):
+        get_counter_cache().clear()
+        # no timer of another test
+        patcher = mock.patch.object(access_counter, "flush_timer", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_access_during_flush_schedules_next(self):
+        timers: list[threading.Thread] = []
+
+        class ManualTimer(threading.Thread):
+            """
+            Timer that only runs when the test says so
+            """
+
+            def __init__(self, interval: float, function) -> None:  # noqa: ARG002
+                super().__init__(target=function)
+                self.finished = False
+                timers.append(self)
+
+            def start(self) -> None:
+                pass
+
+            def is_alive(self) -> bool:
+                return not self.finished
+
+            def run(self) -> None:
+                try:
+                    super().run()
+                finally:
+                    self.finished = True
+
+            def fire(self) -> None:
+                super().start()
+                self.join()
+
+        self.access.last_access = timezone.now()
+        with mock.patch("anbieter.access_counter.threading.Timer", ManualTimer):
+            access_counter.buffer_access(self.access)
+            access_counter.buffer_access(self.access)
+            self.assertEqual(len(timers), 1)
+            # a request counts an access while the timer flushes
+            with mock.patch(
+                "anbieter.access_counter.flush_access_counts",
+                side_effect=lambda: access_counter.buffer_access(self.access),
+            ) as flush_mock:
+                timers[0].fire()
+            flush_mock.assert_called_once()
+        self.assertEqual(len(timers), 2)
+        self.assertIs(access_counter.flush_timer, timers[1])
+
+    def test_flush(self):
+        other = Anbieter.objects.create(name="Nicht besucht").survey_access
+        with mock.patch("anbieter.access_counter.threading.Timer") as timer_mock:
+            for _ in range(3):
+                self.client.get(self.url)
+        # the requests only schedule the flush
+        timer_mock.return_value.start.assert_called_once()
+        self.access.refresh_from_db()
+        self.assertEqual(self.access.access_count, 0)
+
+        merge_pending_counts([self.access])
+        self.assertEqual(self.access.access_count, 3)
+
+        # only the accessed rows are read and written
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(flush_access_counts(), 1)
+        self.assertEqual(len(queries), 1)
+        self.access.refresh_from_db()
+        self.assertEqual(self.access.access_count, 3)
+        self.assertIsNotNone(self.access.last_access)
+        self.assertEqual(flush_access_counts(), 0)
+
+        # accessed again after the flush
+        with mock.patch("anbieter.access_counter.threading.Timer"):
+            self.client.get(self.url)
+        self.assertEqual(flush_access_counts(), 1)
+        self.access.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((self.access.access_count, other.access_count), (4, 0))
+
+
+@override_settings(SURVEY_DELTA_REVISIONS=True, SURVEY_SNAPSHOT_INTERVAL=3)
+class DeltaRevisionTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.anbieter = Anbieter.objects.create(name="Test Anbieter")
+        cls.access = cls.anbieter.survey_access
+        cls.url = reverse("survey_update", kwargs={"code": cls.access.code})
+
+    def save_revisions(self, count: int) -> None:
+        for revision in range(2, count + 1):
+            self.access.refresh_from_db()
+            data = survey_post_data(
+                self.access.survey, name=f"Name {revision}", hydro_power=str(revision)
+            )
+            if revision % 2:
+                data["ownership_structure"] = f"Eigentümer {revision}"
+            self.client.post(self.url, data)
+
+    def assertRevisions(self, count: int) -> None:  # noqa: N802
+        for revision in range(1, count + 1):
+            response = self.client.get(self.url, {"view": 1, "rev": revision})
+            survey = response.context["object"]
+            self.assertEqual(survey.revision, revision)
+            if revision > 1:
+                self.assertEqual(survey.name, f"Name {revision}")
+                self.assertEqual(survey.hydro_power, revision)
+            ownership = revision if revision % 2 else revision - 1
+            self.assertEqual(
+                survey.ownership_structure,
+                f"Eigentümer {ownership}" if ownership > 1 else "",
+            )
+
+    def test_save_as_delta(self):
+        self.save_revisions(7)
+        full = CompanySurvey2024.objects.filter(anbieter=self.anbieter)
+        self.assertEqual(sorted(full.values_list("revision", flat=True)), [3, 6, 7])
+        delta = SurveyRevisionDelta.objects.get(anbieter=self.anbieter, revision=4)
+        self.assertEqual(
+            set(delta.changes),
+            {"created", "name", "hydro_power", "ownership_structure"},
+        )
+        self.assertRevisions(7)
+        response = self.client.get(self.url, {"view": 1, "rev": 8})
+        self.assertEqual(response.status_code, 404)
+
+    def test_compact_and_expand(self):
+        with self.settings(SURVEY_DELTA_REVISIONS=False):
+            self.save_revisions(7)
+        self.assertEqual(compact_revisions(self.anbieter.pk, 7), 4)
+        self.assertEqual(compact_revisions(self.anbieter.pk, 7), 0)
+        self.assertEqual(
+            CompanySurvey2024.objects.filter(anbieter=self.anbieter).count(), 3
+        )
+        self.assertRevisions(7)
+
+        self.assertEqual(expand_revisions(self.anbieter.pk, 7), 4)
+        self.assertEqual(
+            CompanySurvey2024.objects.filter(anbieter=self.anbieter).count(), 7
+        )
+        self.assertFalse(SurveyRevisionDelta.objects.exists())
+        self.assertRevisions(7)
+
+
+class FillStatusTest(TestCase):
+    def test_expression_matches_python(self):
+        anbieter = Anbieter.objects.create(name="Test Anbieter")
+        CompanySurvey2024.objects.bulk_create(
+            [
+                CompanySurvey2024(
+                    anbieter=anbieter, revision=2, street=" \n\t", _fill_status=0
+                ),
+                CompanySurvey2024(
+                    anbieter=anbieter,
+                    revision=3,
+                    street="Straße",
+                    hydro_power=0,
+                    num_employees=0,
+                    sells_fossil_or_nuclear_energy=False,
+                    power_plants_file="anlagen.pdf",
+                    _fill_status=0,
+                ),
+            ]
+        )
+        surveys = CompanySurvey2024.objects.annotate(
+            fill_status=fill_status_expression(CompanySurvey2024)
+        )
+        for survey in surveys:
+            values = survey.__dict__.copy()
+            fill_status = values.pop("fill_status")
+            self.assertAlmostEqual(fill_status, get_fill_status(values))
+        self.assertEqual(
+            len({survey.fill_status for survey in surveys}), 2, "whitespace is empty"
+        )
+
+
+class HierarchyTest(TestCase):
+    def test_root_is_maintained(self):
+        konzern = Anbieter.objects.create(name="Konzern")
+        tochter = Anbieter.objects.create(name="Tochter", mutter=konzern)
+        enkel = Anbieter.objects.create(name="Enkel", sells_from=tochter)
+        self.assertEqual((tochter.parent, tochter.depth), (konzern, 1))
+        self.assertEqual((enkel.parent, enkel.depth), (konzern, 2))
+        self.assertEqual(konzern.parent, konzern)
+        self.assertFalse(konzern.has_parent)
+
+        tochter.mutter = None
+        tochter.save()
+        enkel.refresh_from_db()
+        self.assertEqual((enkel.root_anbieter, enkel.depth), (tochter, 1))
+
+        tochter.delete()
+        enkel.refresh_from_db()
+        self.assertEqual((enkel.root_anbieter, enkel.depth), (None, 0))
+
+    def test_cycle(self):
+        first = Anbieter.objects.create(name="Erster")
+        second = Anbieter.objects.create(name="Zweiter", mutter=first)
+        first.mutter = second
+        with self.assertRaises(ValidationError):
+            first.clean_hierarchy()
+
+        # saved anyway, e.g. by an update
+        Anbieter.objects.filter(pk=first.pk).update(mutter=second)
+        self.assertEqual(Anbieter.update_hierarchy(), {first.pk, second.pk})
+        second.refresh_from_db()
+        self.assertEqual(second.parent, second)
+
+        # leaving the cycle resolves the other member
+        first.refresh_from_db()
+        first.mutter = None
+        first.save()
+        second.refresh_from_db()
+        self.assertEqual((second.root_anbieter, second.depth), (first, 1))
+
+    def test_only_related_loaded(self):
+        konzern = Anbieter.objects.create(name="Konzern")
+        tochter = Anbieter.objects.create(name="Tochter", mutter=konzern)
+        enkel = Anbieter.objects.create(name="Enkel", sells_from=tochter)
+        for index in range(5):
+            Anbieter.objects.create(name=f"Unbeteiligt {index}")
+        neu = Anbieter.objects.create(name="Neu")
+
+        form_anbieter = Anbieter.objects.get(pk=tochter.pk)
+        # unchanged links aren't checked
+        with self.assertNumQueries(0):
+            form_anbieter.clean_hierarchy()
+        form_anbieter.mutter = neu
+        with self.assertNumQueries(1):
+            form_anbieter.clean_hierarchy()
+        # the ancestors, one query per level
+        form_anbieter.mutter = enkel
+        with self.assertNumQueries(1), self.assertRaises(ValidationError):
+            form_anbieter.clean_hierarchy()
+        neu.mutter = enkel
+        with self.assertNumQueries(3):
+            neu.clean_hierarchy()
+
+        with CaptureQueriesContext(connection) as queries:
+            Anbieter.update_hierarchy([tochter.pk])
+        self.assertNotIn("Unbeteiligt", str(queries.captured_queries))
+        tochter.mutter = neu
+        tochter.save()
+        enkel.refresh_from_db()
+        self.assertEqual((enkel.root_anbieter, enkel.depth), (neu, 2))
+
+    def test_queryset_update_and_delete(self):
+        konzern = Anbieter.objects.create(name="Konzern")
+        tochter = Anbieter.objects.create(name="Tochter")
+        enkel = Anbieter.objects.create(name="Enkel", mutter=tochter)
+
+        Anbieter.objects.filter(pk=tochter.pk).update(mutter=konzern)
+        enkel.refresh_from_db()
+        self.assertEqual((enkel.root_anbieter, enkel.depth), (konzern, 2))
+
+        # like the delete action of the admin
+        Anbieter.objects.filter(pk__in=[konzern.pk, tochter.pk]).delete()
+        enkel.refresh_from_db()
+        self.assertEqual(
+            (enkel.mutter, enkel.root_anbieter, enkel.depth), (None, None, 0)
+        )
+
+
+class EmpfehlungTest(TestCase):
+    def test_annotation_matches_properties(self):
+        def create(name: str, answered: bool = True, **kwargs) -> Anbieter:
+            anbieter = Anbieter.objects.create(name=name, **kwargs)
+            if answered:
+                SurveyAccess.objects.filter(anbieter=anbieter).update(
+                    current_revision=2
+                )
+            return anbieter
+
+        gut = create("Gut", nur_oeko=True)
+        schlecht = create("Schlecht", unabhaengigkeit=False)
+        offen = create("Offen", answered=False)
+        create("Tochter Gut", answered=False, mutter=gut)
+        create("Enkel Gut", sells_from=Anbieter.objects.get(name="Tochter Gut"))
+        create("Tochter Schlecht", mutter=schlecht, nur_oeko=True)
+        create("Händler Offen", sells_from=offen)
+        create("Beides", mutter=gut, sells_from=schlecht)
+
+        annotated = {
+            anbieter.name: anbieter for anbieter in Anbieter.objects.with_empfehlung()
+        }
+        for anbieter in Anbieter.objects.all():
+            other = annotated[anbieter.name]
+            with self.subTest(anbieter.name):
+                self.assertEqual(anbieter.ist_empfohlen, other.empfohlen)
+                self.assertEqual(anbieter.ist_empfohlen, other.ist_empfohlen)
+                self.assertEqual(anbieter.survey_answered, other.survey_answered)
+                self.assertEqual(
+                    anbieter.nicht_erfuellte_kriterien, other.nicht_erfuellte_kriterien
+                )
+                self.assertEqual(
+                    anbieter.nur_umfrage_nicht_beantwortet,
+                    other.nur_umfrage_nicht_beantwortet,
+                )
+        self.assertEqual(
+            set(
+                Anbieter.objects.with_empfehlung()
+                .filter(empfohlen=True)
+                .values_list("name", flat=True)
+            ),
+            {"Gut", "Tochter Gut", "Enkel Gut", "Beides"},
+        )
+
+
+class HomepageExportTest(TestCase):
+    template = (
+        "{{ anbieter.name }} {% if anbieter.ist_empfohlen %}👍{% endif %}\n"
+        "{% for kriterium in anbieter.nicht_erfuellte_kriterien %}- {{ kriterium }}\n"
+        "{% endfor %}{{ related_names | join(', ') }}"
+    )
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        Template.objects.create(
+            name=TemplateNames.HOMEPAGE_TEXT_EXPORT, template=cls.template
+        )
+        konzern = Anbieter.objects.create(name="Konzern", nur_oeko=False)
+        for index in range(5):
+            anbieter = Anbieter.objects.create(
+                name=f"Stadtwerke Ä{index}", mutter=konzern if index % 2 else None
+            )
+            AnbieterName.objects.create(name=f"SW Ä{index}", anbieter=anbieter)
+        cls.url = reverse("admin:export_homepage")
+
+    def expected(self) -> bytes:
+        data = get_homepage_export_data(self.template)
+        return json.dumps(data, indent=4).encode()
+
+    def test_stream_is_identical(self):
+        self.client.force_login(self.user)
+        response = self.client.get(self.url)
+        self.assertTrue(response.streaming)
+        self.assertEqual(b"".join(response.streaming_content), self.expected())
+
+    async def test_stream_is_identical_asgi(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(self.url)
+        self.assertTrue(response.is_async)
+        content = b"".join([part async for part in response.streaming_content])
+        self.assertEqual(content, await sync_to_async(self.expected)())
+
+    def test_constant_queries(self):
+        # the Anbieter with everything related and their names
+        with self.assertNumQueries(2):
+            data = get_homepage_export_data(self.template)
+        self.assertEqual(data[-1]["names"], ["SW Ä4"])
+        konzern = Anbieter.objects.get(name="Konzern")
+        for index in range(5, 20):
+            anbieter = Anbieter.objects.create(
+                name=f"Stadtwerke Ä{index}", mutter=konzern, sells_from=konzern
+            )
+            AnbieterName.objects.create(name=f"SW Ä{index}", anbieter=anbieter)
+            AnbieterName.objects.create(name=f"SW Ä{index}b", anbieter=anbieter)
+        with self.assertNumQueries(2):
+            self.assertEqual(len(get_homepage_export_data(self.template)), 21)
+
+    def test_parallel(self):
+        data = get_homepage_export_data(self.template, workers=2)
+        self.assertEqual(data, get_homepage_export_data(self.template))
+        # only Anbieter with mutter fail, the first one by name is reported
+        with self.assertRaisesMessage(RenderException, "Stadtwerke Ä1: UndefinedError"):
+            get_homepage_export_data(
+                "{{ anbieter.mutter and anbieter.x.y }}", workers=2
+            )
+
+    def test_empty(self):
+        Anbieter.objects.update(active=False)
+        self.client.force_login(self.user)
+        response = self.client.get(self.url)
+        self.assertEqual(b"".join(response.streaming_content), b"[]")
+
+
+class TemplateCacheTest(TestCase):
+    def test_compiled_once_per_content(self):
+        source = "{{ anbieter.name }} TemplateCacheTest"
+        for index in range(3):
+            Anbieter.objects.create(name=f"Anbieter {index}")
+        with mock.patch.object(
+            templating.environment, "compile", wraps=templating.environment.compile
+        ) as compile_mock:
+            data = get_homepage_export_data(source)
+            self.assertIs(get_template(source), get_template(source))
+        self.assertEqual(compile_mock.call_count, 1)
+        self.assertEqual(data[0]["content"], "Anbieter 0 TemplateCacheTest")
+        # an edited template is compiled again
+        self.assertIsNot(get_template(source + "!"), get_template(source))
+
+    def test_syntax_error_names_anbieter(self):
+        Anbieter.objects.create(name="Kaputt")
+        with self.assertRaisesMessage(RenderException, "Kaputt"):
+            get_homepage_export_data("{% if %}")
+
+
+class IncrementalExportTest(TestCase):
+    template = "{{ anbieter.name }} {{ anbieter.parent.name }}"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.konzern = Anbieter.objects.create(name="Konzern")
+        for index in range(4):
+            Anbieter.objects.create(
+                name=f"Tochter {index}", mutter=cls.konzern if index % 2 else None
+            )
+
+    def test_only_changed_rendered(self):
+        first = update_homepage_export(self.template)
+        self.assertEqual((first.updated, first.removed), (5, 0))
+        self.assertEqual(update_homepage_export(self.template).updated, 0)
+        self.assertEqual(
+            len(get_homepage_export_delta(None, first.timestamp)["updated"]), 5
+        )
+
+        # the daughters show the name of the parent
+        self.konzern.name = "Konzern AG"
+        self.konzern.save()
+        second = update_homepage_export(self.template)
+        self.assertEqual(second.updated, 3)
+        delta = get_homepage_export_delta(first.timestamp, second.timestamp)
+        self.assertEqual(
+            [data["content"] for data in delta["updated"]],
+            ["Konzern AG Konzern AG", "Tochter 1 Konzern AG", "Tochter 3 Konzern AG"],
+        )
+        self.assertEqual(delta["removed"], [])
+
+        Anbieter.objects.filter(name="Tochter 0").update(active=False)
+        third = update_homepage_export(self.template)
+        self.assertEqual((third.updated, third.removed), (0, 1))
+        delta = get_homepage_export_delta(second.timestamp, third.timestamp)
+        self.assertEqual(
+            delta,
+            {
+                "since": second.timestamp,
+                "until": third.timestamp,
+                "updated": [],
+                "removed": ["tochter-0"],
+            },
+        )
+
+        # a new template changes everything
+        self.assertEqual(update_homepage_export(self.template + "!").updated, 4)
+
+    def test_view(self):
+        Template.objects.create(
+            name=TemplateNames.HOMEPAGE_TEXT_EXPORT, template=self.template
+        )
+        self.client.force_login(
+            User.objects.create_superuser("admin", "admin@example.com", "admin")
+        )
+        url = reverse("admin:export_homepage")
+        data = self.client.get(url, {"since": ""}).json()
+        self.assertEqual(len(data["updated"]), 5)
+        data = self.client.get(url, {"since": data["until"]}).json()
+        self.assertEqual(data["updated"], [])
+        self.assertEqual(self.client.get(url, {"since": "gestern"}).status_code, 400)
+
+
+@override_settings(SURVEY_MAIL_BACKGROUND=False)
+class SurveyMailDispatchTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for name, template in (
+            (
+                TemplateNames.SURVEY2024_SUBJECT,
+                "Umfrage {{ obj.name }}{% if obj.name == 'Kaputt' %}{{ obj.x.y }}{% endif %}",
+            ),
+            (TemplateNames.SURVEY2024_TXT, "Hallo {{ obj.name }}"),
+            (TemplateNames.SURVEY2024_HTML, "<p>Hallo {{ obj.name }}</p>"),
+        ):
+            Template.objects.create(name=name, template=template)
+        for index, name in enumerate(["Alpha", "Beta", "Gamma", "Kaputt", "Omega"]):
+            anbieter = Anbieter.objects.create(name=name, mail=f"{index}@example.com")
+            UmfrageVersendung2024(anbieter=anbieter).save_base(
+                raw=True, force_insert=True
+            )
+        UmfrageVersendung2024.objects.filter(name="Omega").update(mail_status=True)
+        cls.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+
+    def test_queue_and_dispatch(self):
+        self.client.force_login(self.user)
+        response = self.client.post(
+            reverse("admin:anbieter_umfrageversendung2024_changelist"),
+            {
+                "action": "send_survey_email",
+                "_selected_action": list(
+                    UmfrageVersendung2024.objects.values_list("pk", flat=True)
+                ),
+            },
+            follow=True,
+        )
+        self.assertContains(response, "queued=4 already_sent=1")
+        # nobody sends the queue without SURVEY_MAIL_BACKGROUND
+        self.assertContains(response, "4 Mails warten in der Warteschlange")
+        self.assertEqual(mail.outbox, [])
+
+        with mock.patch.object(
+            locmem.EmailBackend, "open", autospec=True, return_value=True
+        ) as open_mock:
+            result = dispatch_queued(batch_size=2, rate=0)
+        self.assertEqual((result.sent, result.retried, result.failed), (3, 0, 1))
+        # once for the dispatch, once again after the failure
+        self.assertEqual(open_mock.call_count, 2)
+        self.assertEqual(
+            [message.subject for message in mail.outbox],
+            ["Umfrage Alpha", "Umfrage Beta", "Umfrage Gamma"],
+        )
+        self.assertEqual(mail.outbox[0].alternatives[0][0], "<p>Hallo Alpha</p>")
+        self.assertEqual(dispatch_progress(), {"queued": 0, "sent": 4, "failed": 1})
+        failed = UmfrageVersendung2024.objects.get(mail_status=False)
+        self.assertEqual(failed.name, "Kaputt")
+        self.assertIn("UndefinedError", failed.mail_details)
+
+    def test_claims(self):
+        queue_survey_emails(UmfrageVersendung2024.objects.exclude(name="Kaputt"))
+        # Alpha is sent by a running dispatcher, Beta was left by a stopped one
+        UmfrageVersendung2024.objects.filter(name="Alpha").update(
+            mail_sending=timezone.now()
+        )
+        UmfrageVersendung2024.objects.filter(name="Beta").update(
+            mail_sending=timezone.now() - timedelta(hours=1)
+        )
+        self.assertTrue(dispatch_running())
+        atomic_blocks = len(connection.atomic_blocks)
+
+        def send_messages(backend, messages):  # noqa: ARG001
+            # outside of the transaction of the claim
+            self.assertEqual(len(connection.atomic_blocks), atomic_blocks)
+            mail.outbox.extend(messages)
+            return len(messages)
+
+        with mock.patch.object(
+            locmem.EmailBackend,
+            "send_messages",
+            autospec=True,
+            side_effect=send_messages,
+        ):
+            dispatch_queued(batch_size=1)
+        self.assertEqual(
+            [message.subject for message in mail.outbox],
+            ["Umfrage Beta", "Umfrage Gamma"],
+        )
+        self.assertEqual(list(queued_mails().values_list("name", flat=True)), ["Alpha"])
+
+    def test_missing_template(self):
+        queue_survey_emails(UmfrageVersendung2024.objects.all())
+        Template.objects.filter(name=TemplateNames.SURVEY2024_HTML).delete()
+        with self.assertRaisesMessage(Template.DoesNotExist, "SURVEY_2024_HTML"):
+            dispatch_queued()
+        # nothing is claimed, the queue isn't reported as being sent
+        self.assertFalse(queued_mails().filter(mail_sending__isnull=False).exists())
+        self.assertFalse(dispatch_running())
+        self.assertEqual(mail.outbox, [])
+
+    @override_settings(SURVEY_MAIL_BACKGROUND=True)
+    def test_changelist_resumes_queue(self):
+        queue_survey_emails(UmfrageVersendung2024.objects.all())
+        self.client.force_login(self.user)
+        with mock.patch(
+            "anbieter.mail_dispatch.start_dispatch", return_value=True
+        ) as start_mock:
+            response = self.client.get(
+                reverse("admin:anbieter_umfrageversendung2024_changelist")
+            )
+        start_mock.assert_called_once()
+        self.assertContains(response, "Mailversand läuft, noch 4 in der Warteschlange")
+
+    def test_rate_limit(self):
+        queue_survey_emails(UmfrageVersendung2024.objects.exclude(name="Kaputt"))
+        with mock.patch("anbieter.mail_dispatch.time.sleep") as sleep_mock:
+            dispatch_queued(rate=2)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(sleep_mock.call_count, 2)
+        # the first mail is sent immediately, the second waits half a second
+        self.assertAlmostEqual(sleep_mock.call_args_list[0][0][0], 0.5, places=1)
+
+
+class InitSurveyEmailTest(TestCase):
+    def test_bulk_insert(self):
+        anbieter = [
+            Anbieter.objects.create(name=f"Anbieter {index}", mail="a@example.com")
+            for index in range(30)
+        ]
+        UmfrageVersendung2024(anbieter=anbieter[0]).save_base(
+            raw=True, force_insert=True
+        )
+        UmfrageVersendung2024.objects.filter(pk=anbieter[0].pk).update(mail_status=True)
+        self.client.force_login(
+            User.objects.create_superuser("admin", "admin@example.com", "admin")
+        )
+        response = self.client.post(
+            reverse("admin:anbieter_anbieter_changelist"),
+            {
+                "action": "init_survey_email",
+                "_selected_action": [obj.pk for obj in anbieter[:4]],
+            },
+            follow=True,
+        )
+        self.assertContains(response, "created=3 already_existed=1")
+        self.assertEqual(
+            list(
+                UmfrageVersendung2024.objects.order_by("pk").values_list(
+                    "name", "mail", "mail_status", "mail_details", "mail_queued"
+                )
+            ),
+            [("Anbieter 0", "a@example.com", True, "", None)]
+            + [
+                (f"Anbieter {index}", "a@example.com", None, "", None)
+                for index in (1, 2, 3)
+            ],
+        )
+        # existing rows and Anbieter are left untouched
+        self.assertEqual(Anbieter.objects.count(), 30)
+        generation = get_generation()
+        # existing ids and one insert for all missing rows, within a savepoint as the
+        # test is a transaction
+        with self.assertNumQueries(4):
+            self.assertEqual(
+                UmfrageVersendung2024.create_for([obj.pk for obj in anbieter]), (26, 4)
+            )
+        self.assertEqual(UmfrageVersendung2024.objects.count(), 30)
+        # no post_save for the inserted rows, the caches are invalidated once
+        self.assertNotEqual(get_generation(), generation)
+
+
+class ChangelistQueryTest(TestCase):
+    """
+    The changelists must not need queries per row
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        cls.add_anbieter(0)
+
+    @staticmethod
+    def add_anbieter(start: int) -> None:
+        konzern = Anbieter.objects.create(name=f"Konzern {start}", nur_oeko=False)
+        for index in range(start, start + 3):
+            anbieter = Anbieter.objects.create(
+                name=f"Anbieter {index}",
+                homepage="https://www.example.com",
+                begruendung_extern="Text",
+                mutter=konzern if index % 2 else None,
+                sells_from=None if index % 2 else konzern,
+            )
+            UmfrageVersendung2024.create_for([anbieter.pk])
+            AnbieterName.objects.create(name=f"Name {index}", anbieter=anbieter)
+        SurveyAccess.objects.update(current_revision=2)
+
+    def count_queries(self, url: str) -> int:
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_constant_queries(self):
+        for start, url in (
+            (10, reverse("admin:anbieter_anbieter_changelist")),
+            (20, reverse("admin:anbieter_umfrageversendung2024_changelist")),
+        ):
+            with self.subTest(url=url):
+                before = self.count_queries(url)
+                self.add_anbieter(start)
+                self.assertEqual(self.count_queries(url), before)
+
+
+class KeysetChangelistTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        konzerne = [
+            Anbieter.objects.create(name=f"Konzern {index}") for index in (1, 2)
+        ]
+        for index in range(7):
+            Anbieter.objects.create(
+                name=f"Anbieter {index}",
+                mutter=konzerne[index % 2] if index % 3 else None,
+            )
+
+    def load_all(self, params: dict[str, str]) -> list[str]:
+        self.client.force_login(self.user)
+        with (
+            mock.patch.object(AnbieterAdmin, "list_per_page", 2),
+            mock.patch("anbieter.keyset.ROWS_PER_REQUEST", 3),
+        ):
+            response = self.client.get(
+                reverse("admin:anbieter_anbieter_changelist"), params
+            )
+            cl = response.context["cl"]
+            names = [obj.name for obj in cl.result_list]
+            self.assertContains(response, 'id="keyset-changelist"')
+            keyset = cl.keyset
+            while keyset["after"]:
+                data = self.client.get(
+                    keyset["url"] + "&" + urlencode({"after": keyset["after"]})
+                ).json()
+                self.assertLessEqual(len(data["rows"]), 3)
+                names += re.findall(r">(\w+ \d)</", "".join(data["rows"]))
+                keyset["after"] = data["after"]
+        return names
+
+    def test_ordering_with_empty_values(self):
+        # by mutter, empty last, then by the name of the admin ordering
+        expected = [
+            obj.name
+            for obj in sorted(
+                Anbieter.objects.all(),
+                key=lambda obj: (obj.mutter_id is None, obj.mutter_id or 0, obj.name),
+            )
+        ]
+        self.assertEqual(self.load_all({"o": "5"}), expected)
+        self.assertEqual(
+            self.load_all({"o": "-5"}),
+            [
+                obj.name
+                for obj in sorted(
+                    Anbieter.objects.all(),
+                    key=lambda obj: (
+                        obj.mutter_id is None,
+                        -(obj.mutter_id or 0),
+                        obj.name,
+                    ),
+                )
+            ],
+        )
+
+    def test_filter_and_search(self):
+        self.assertEqual(
+            self.load_all({"q": "Anbieter", "mutter__isempty": "0"}),
+            ["Anbieter 1", "Anbieter 2", "Anbieter 4", "Anbieter 5"],
+        )
+
+    def test_invalid_keyset(self):
+        self.client.force_login(self.user)
+        response = self.client.get(
+            reverse("admin:anbieter_anbieter_changelist_rows"), {"after": "[1, 2"}
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class FacetCountsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        konzern = Anbieter.objects.create(name="Konzern", nur_oeko=False)
+        for index in range(6):
+            Anbieter.objects.create(
+                name=f"Anbieter {index}",
+                active=bool(index % 2),
+                nur_oeko=bool(index % 3),
+                mutter=konzern if index % 4 else None,
+            )
+        SurveyAccess.objects.filter(
+            anbieter__name__in=["Anbieter 1", "Anbieter 2"]
+        ).update(current_revision=2)
+
+    def setUp(self):
+        invalidate_facet_counts()
+        self.client.force_login(self.user)
+
+    def get(self, query_string: str = ""):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse("admin:anbieter_anbieter_changelist") + query_string
+            )
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def result_count(self, query_string: str) -> int:
+        request = RequestFactory().get(
+            reverse("admin:anbieter_anbieter_changelist") + query_string
+        )
+        request.user = self.user
+        model_admin = admin.site.get_model_admin(Anbieter)
+        return model_admin.get_changelist_instance(request).result_count
+
+    def test_counts_match_filtered_results(self):
+        for params in ("", "?active__exact=1", "?q=Anbieter&empfohlen=nein"):
+            response, _ = self.get(params)
+            cl = response.context["cl"]
+            for spec in cl.filter_specs:
+                for choice in spec.choices(cl):
+                    match = re.search(r"\((\d+)\)$", str(choice["display"]))
+                    if match is None:
+                        continue
+                    with self.subTest(params=params, choice=choice["display"]):
+                        self.assertEqual(
+                            int(match[1]), self.result_count(choice["query_string"])
+                        )
+
+    def test_cached_until_saved(self):
+        _, uncached = self.get()
+        _, cached = self.get()
+        # all filters are counted with one query
+        self.assertEqual(cached, uncached - 1)
+        anbieter = Anbieter.objects.get(name="Anbieter 0")
+        anbieter.active = True
+        anbieter.save()
+        response, queries = self.get()
+        self.assertEqual(queries, uncached)
+        cl = response.context["cl"]
+        # the first filter is active
+        self.assertIn(
+            "Ja (5)", [choice["display"] for choice in cl.filter_specs[0].choices(cl)]
+        )
+
+
+class SearchTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        cls.stadtwerke = Anbieter.objects.create(name="Stadtwerke München")
+        AnbieterName.objects.create(name="SWM Versorgung", anbieter=cls.stadtwerke)
+        cls.naturstrom = Anbieter.objects.create(
+            name="naturstrom",
+            verivox=Verivox.objects.create(
+                name="NaturStromHandel GmbH", scrape_date=timezone.now()
+            ),
+        )
+        cls.stadtwerk = Anbieter.objects.create(name="Stadtwerk Tauberfranken")
+        Anbieter.objects.create(name="Greenpeace Energy")
+
+    def test_word_similarity(self):
+        # the values of word_similarity() of pg_trgm
+        for term, name, similarity in [
+            ("Stadwerke", "Stadtwerk Tauberfranken", 0.461538),
+            ("Stadwerke", "Stadtwerke München", 0.615385),
+            ("swm", "SWM Versorgung", 1.0),
+            ("Stromhandel", "NaturStromHandel GmbH", 0.833333),
+            ("stadtwerk", "Stadtwerke München", 0.9),
+            ("Energie", "", 0.0),
+        ]:
+            with self.subTest(term=term, name=name):
+                self.assertAlmostEqual(
+                    word_similarity(term, name), similarity, places=5
+                )
+
+    def test_fuzzy_over_all_names(self):
+        # typo, below the threshold for "Stadtwerk Tauberfranken"
+        self.assertEqual(search_anbieter("Stadwerke"), [self.stadtwerke.pk])
+        # ranked by the best matching name
+        self.assertEqual(
+            search_anbieter("Stadtwerk"), [self.stadtwerk.pk, self.stadtwerke.pk]
+        )
+        self.assertEqual(search_anbieter("swm"), [self.stadtwerke.pk])
+        # the scrape name returns the Anbieter
+        self.assertEqual(search_anbieter("Stromhandel"), [self.naturstrom.pk])
+        self.assertEqual(search_anbieter("  "), [])
+
+    def test_index_updated(self):
+        self.assertEqual(search_anbieter("Polarstern"), [])
+        AnbieterName.objects.create(name="Polarstern", anbieter=self.naturstrom)
+        self.assertEqual(search_anbieter("Polarstern"), [self.naturstrom.pk])
+
+    def test_autocomplete_ranked(self):
+        self.client.force_login(self.user)
+        response = self.client.get(
+            reverse("admin:autocomplete"),
+            {
+                "app_label": "anbieter",
+                "model_name": "anbieter",
+                "field_name": "mutter",
+                "term": "stadtwerk",
+            },
+        )
+        self.assertEqual(
+            [result["text"] for result in response.json()["results"]],
+            ["Stadtwerk Tauberfranken", "Stadtwerke München"],
+        )
+
+
+@skipUnless(connection.vendor == "postgresql", "trigram indexes need PostgreSQL")
+class PostgresSearchTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        SearchTest.setUpTestData()
+        cls.stadtwerke = SearchTest.stadtwerke
+
+    def test_same_as_in_memory(self):
+        for term in ("Stadwerke", "stadtwerk", "swm", "Stromhandel", "energy", "x"):
+            with self.subTest(term=term):
+                self.assertEqual(
+                    sorted(
+                        (match.anbieter_id, match.name, round(match.score, 5))
+                        for match in search_postgres(term)
+                    ),
+                    sorted(
+                        (match.anbieter_id, match.name, round(match.score, 5))
+                        for match in get_trigram_index().search(term)
+                    ),
+                )
+
+    def test_uses_indexes(self):
+        migration = import_module("anbieter.migrations.0029_name_trigram_indexes")
+        with connection.schema_editor() as schema_editor:
+            # the foreign keys of the test data are checked at the commit otherwise
+            schema_editor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+            migration.create_indexes(None, schema_editor)
+        queryset = postgres_queryset("Stadwerke")
+        with connection.cursor() as cursor:
+            # the tables of the test are too small to prefer an index otherwise
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            plan = queryset.explain()
+        # the scrape tables are joined to the few linked rows instead
+        self.assertIn("Bitmap Index Scan on anbieter_anbieter_name_trgm", plan)
+        self.assertIn("Bitmap Index Scan on anbieter_anbietername_name_trgm", plan)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT indexname FROM pg_indexes WHERE indexname LIKE %s",
+                ["%_name_trgm"],
+            )
+            indexes = {name for (name,) in cursor.fetchall()}
+        self.assertEqual(indexes, {f"{table}_name_trgm" for table in migration.TABLES})
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the RoWo homepage, counts the requests
+    """
+
+    lock = threading.Lock()
+    requests: list[str] = []
+    if_none_match: list[str | None] = []
+    active = 0
+    max_active = 0
+    etag = '"1"'
+    suffix = b""
+    # content of the paths that aren't "content of <path>"
+    files: dict[str, bytes] = {}
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.requests.append(self.path)
+            cls.if_none_match.append(self.headers.get("If-None-Match"))
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        time.sleep(0.1)
+        with cls.lock:
+            cls.active -= 1
+        if self.path.startswith("/missing"):
+            self.send_error(404)
+            return
+        if self.headers.get("If-None-Match") == cls.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        content = cls.files.get(self.path, f"content of {self.path}".encode())
+        content += cls.suffix
+        self.send_response(200)
+        self.send_header("ETag", cls.etag)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):  # noqa: A002
+        pass
+
+
+class MirrorTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), OriginHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.addClassCleanup(cls.server.server_close)
+        cls.addClassCleanup(cls.server.shutdown)
+
+    def setUp(self):
+        OriginHandler.requests = []
+        OriginHandler.if_none_match = []
+        OriginHandler.max_active = 0
+        OriginHandler.etag = '"1"'
+        OriginHandler.suffix = b""
+        OriginHandler.files = {}
+        self.static_root = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        self.enterContext(
+            self.settings(
+                APP_STATIC_ROOT=self.static_root,
+                ROWO_MIRROR_URL=f"http://127.0.0.1:{self.server.server_port}",
+                ROWO_MIRROR_CONCURRENCY=2,
+            )
+        )
+        # the buffered hits, before the directory is removed
+        self.addCleanup(lambda: get_mirror_index().flush_hits())
+
+    async def mirror(self, file_path: str, **headers: str):
+        return await view_mirror.mirror(
+            AsyncRequestFactory().get("/", headers=headers), file_path
+        )
+
+    async def content(self, response) -> bytes:
+        return b"".join([chunk async for chunk in response])
+
+    async def test_single_flight(self):
+        responses = await asyncio.gather(
+            *(self.mirror("themes/site.css?v=1") for _ in range(5))
+        )
+        self.assertEqual(OriginHandler.requests, ["/themes/site.css"])
+        for response in responses:
+            self.assertEqual(
+                await self.content(response), b"content of /themes/site.css"
+            )
+        # served from the disk now, without temporary files left
+        await self.mirror("themes/site.css")
+        self.assertEqual(len(OriginHandler.requests), 1)
+        self.assertEqual(
+            [path.name for path in (self.static_root / "themes").iterdir()],
+            ["site.css"],
+        )
+
+    async def test_conditional_requests(self):
+        response = await self.mirror("fonts/font.woff2")
+        self.assertEqual(response["Content-Length"], "28")
+        self.assertIn("max-age=86400", response["Cache-Control"])
+        for headers in (
+            {"If-None-Match": response["ETag"]},
+            {"If-Modified-Since": response["Last-Modified"]},
+        ):
+            with self.subTest(headers=headers):
+                not_modified = await self.mirror("fonts/font.woff2", **headers)
+                self.assertEqual(not_modified.status_code, 304)
+                self.assertEqual(not_modified["ETag"], response["ETag"])
+        changed = await self.mirror("fonts/font.woff2", **{"If-None-Match": '"other"'})
+        self.assertEqual(changed.status_code, 200)
+
+    async def test_replaced_while_serving(self):
+        mirrored_file = await view_mirror.get_local_file("site.css")
+        view_mirror.write_atomic(mirrored_file.path, b"a longer replacement content")
+        response = view_mirror.serve_local_file(
+            AsyncRequestFactory().get("/"), mirrored_file
+        )
+        # the opened file is served, with its own size
+        content = await self.content(response)
+        self.assertEqual(content, b"content of /site.css")
+        self.assertEqual(response["Content-Length"], str(len(content)))
+
+    async def test_accel_redirect(self):
+        with self.settings(ROWO_MIRROR_ACCEL_REDIRECT="/_mirror/"):
+            response = await self.mirror("themes/a b.svg")
+        self.assertEqual(response["X-Accel-Redirect"], "/_mirror/themes/a%20b.svg")
+        self.assertEqual(response["Content-Type"], "image/svg+xml")
+        self.assertEqual(response.content, b"")
+
+    async def test_bounded_concurrency(self):
+        await asyncio.gather(*(self.mirror(f"img/{index}.png") for index in range(6)))
+        self.assertEqual(len(OriginHandler.requests), 6)
+        self.assertLessEqual(OriginHandler.max_active, 2)
+
+    def mirrored_files(self) -> list[str]:
+        # without the index
+        return sorted(
+            path.relative_to(self.static_root).as_posix()
+            for path in self.static_root.rglob("*")
+            if path.is_file() and not path.name.startswith(".")
+        )
+
+    async def test_not_found(self):
+        for file_path in ("missing.css", "../outside.css", ".mirror_index.sqlite3"):
+            with self.subTest(file_path=file_path), self.assertRaises(Http404):
+                await self.mirror(file_path)
+        self.assertEqual(self.mirrored_files(), [])
+
+    async def test_revalidate_expired(self):
+        await self.mirror("site.css")
+        await self.mirror("site.css")
+        self.assertEqual(OriginHandler.if_none_match, [None])
+        with self.settings(ROWO_MIRROR_TTL=-1):
+            response = await self.mirror("site.css")
+            self.assertEqual(OriginHandler.if_none_match, [None, '"1"'])
+            self.assertEqual(await self.content(response), b"content of /site.css")
+            OriginHandler.etag = '"2"'
+            OriginHandler.suffix = b" changed"
+            response = await self.mirror("site.css")
+            self.assertEqual(
+                await self.content(response), b"content of /site.css changed"
+            )
+        entry = get_mirror_index().get("site.css")
+        self.assertEqual((entry.etag, entry.hits), ('"2"', 3))
+
+    async def test_hits_written_in_background(self):
+        for _ in range(4):
+            await self.mirror("site.css")
+        index = get_mirror_index()
+        # serving only reads the index
+        self.assertEqual(index.get("site.css").hits, 0)
+        with self.settings(ROWO_MIRROR_HIT_FLUSH_INTERVAL=0):
+            await self.mirror("site.css")
+        for thread in threading.enumerate():
+            if thread.name == "mirror-hits":
+                thread.join()
+        self.assertEqual(index.get("site.css").hits, 4)
+
+    async def test_evict_least_recently_used(self):
+        # every file has 17 bytes
+        with self.settings(ROWO_MIRROR_MAX_BYTES=60):
+            for name in ("a", "b", "c", "a", "d"):
+                await self.mirror(f"{name}.css")
+        self.assertEqual(self.mirrored_files(), ["a.css", "c.css", "d.css"])
+        self.assertIsNone(get_mirror_index().get("b.css"))
+
+    def test_command(self):
+        output = StringIO()
+        with self.assertRaisesMessage(CommandError, "1 of 2 failed"):
+            call_command(
+                "mirror_cache",
+                "warmup",
+                "img/logo.png",
+                "missing.png",
+                stdout=output,
+                stderr=StringIO(),
+            )
+        self.assertIn("img/logo.png: 24", output.getvalue())
+        call_command("mirror_cache", "stats", stdout=output)
+        self.assertIn("1 files, 24", output.getvalue())
+        call_command("mirror_cache", "purge", "--expired", stdout=output)
+        self.assertEqual(self.mirrored_files(), ["img/logo.png"])
+        call_command("mirror_cache", "purge", stdout=output)
+        self.assertEqual(self.mirrored_files(), [])
+
+    async def test_prewarm_stylesheets(self):
+        OriginHandler.files = {
+            "/sites/files/css/site.css": b"""
+                @import "print.css";
+                body { background: url(../img/bg.png?v=2); }
+                .icon { background: url("data:image/svg+xml,<svg></svg>"); }
+                .error { background: url(/core/misc/error.svg); }
+                @font-face { src: url('/themes/rowo/fonts/font.woff2#iefix'); }
+            """,
+            "/sites/files/css/print.css": b".logo { background: url(site.css); }",
+        }
+        result = await mirror_prewarm.prewarm(["sites/files/css/site.css"])
+        self.assertEqual(
+            sorted(result.sizes),
+            [
+                "sites/files/css/print.css",
+                "sites/files/css/site.css",
+                "sites/files/img/bg.png",
+                "themes/rowo/fonts/font.woff2",
+            ],
+        )
+        self.assertEqual(result.errors, {})
+        # every file once, paths outside of the mirror are skipped
+        self.assertEqual(len(OriginHandler.requests), 4)
+
+    def test_prewarm_command(self):
+        assets = mirror_prewarm.template_assets()
+        self.assertIn("sites/default/files/favicon_1_0_0.png", assets)
+        self.assertIn("themes/custom/rowotheme/images/sprite.svg", assets)
+        output = StringIO()
+        call_command("prewarm_mirror", "missing.png", stdout=output, stderr=StringIO())
+        self.assertIn(f"Mirrored {len(assets)} files", output.getvalue())
+        self.assertIn("1 failed", output.getvalue())
+        self.assertEqual(self.mirrored_files(), sorted(assets))
+        with self.assertRaisesMessage(CommandError, "1 files"):
+            call_command(
+                "prewarm_mirror",
+                "missing.png",
+                "--fail",
+                stdout=StringIO(),
+                stderr=StringIO(),
+            )
+
+
+class PoolStub:
+    """
+    Stand-in for the psycopg ConnectionPool of the postgresql backend
+    """
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "pool_min": 2,
+            "pool_max": 10,
+            "pool_size": 3,
+            "pool_available": 1,
+            "requests_num": 4,
+            "requests_wait_ms": 10,
+        }
+
+
+class HealthCheckTest(TestCase):
+    def test_ok(self):
+        response = self.client.get(reverse("health"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("no-cache", response["Cache-Control"])
+        data = response.json()
+        self.assertEqual(data["status"], "ok")
+        # only with DB_POOL on PostgreSQL
+        self.assertEqual("pool" in data, getattr(connection, "pool", None) is not None)
+
+    def test_pool_stats(self):
+        # the postgresql backend has a read-only pool property
+        with mock.patch.object(
+            type(connections["default"]),
+            "pool",
+            new_callable=mock.PropertyMock,
+            return_value=PoolStub(),
+            create=True,
+        ):
+            data = self.client.get(reverse("health")).json()
+        self.assertEqual(data["pool"]["size"], 3)
+        self.assertEqual(data["pool"]["available"], 1)
+        self.assertEqual(data["pool"]["requests"], 4)
+        self.assertEqual(data["pool"]["wait_ms_average"], 2.5)
+        self.assertEqual(data["pool"]["requests_errors"], 0)
+
+    def test_database_error(self):
+        with mock.patch.object(
+            connection, "cursor", side_effect=OperationalError("connection refused")
+        ):
+            with self.assertLogs("oekostrom_db.health", "ERROR") as logs:
+                response = health.health(RequestFactory().get("/health/"))
+        self.assertEqual(response.status_code, 503)
+        # the error is only logged
+        self.assertEqual(json.loads(response.content), {"status": "error"})
+        self.assertIn("connection refused", logs.output[0])
+
+    @skipUnless(connection.vendor == "postgresql", "the pool needs PostgreSQL")
+    def test_pool(self):
+        # a second connection to the test database, with the pool of DB_POOL
+        settings_dict = {
+            **connection.settings_dict,
+            "CONN_MAX_AGE": 0,
+            "OPTIONS": {
+                **connection.settings_dict["OPTIONS"],
+                "pool": {"min_size": 1, "max_size": 2, "timeout": 5},
+            },
+        }
+        pooled = type(connections["default"])(settings_dict, alias="health_pool")
+        # looked up by the connection_created handlers
+        connections["health_pool"] = pooled
+        try:
+            with mock.patch.object(health, "connection", pooled):
+                for _ in range(3):
+                    response = health.health(RequestFactory().get("/health/"))
+                    self.assertEqual(response.status_code, 200)
+                    # returns the connection to the pool, like the end of a request
+                    pooled.close()
+        finally:
+            pooled.close_pool()
+            del connections["health_pool"]
+        stats = json.loads(response.content)["pool"]
+        self.assertEqual((stats["min_size"], stats["max_size"]), (1, 2))
+        self.assertIn(stats["size"], (1, 2))
+        self.assertGreaterEqual(stats["requests"], 3)
+        self.assertEqual(stats["requests_errors"], 0)
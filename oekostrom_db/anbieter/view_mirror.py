@@ -1,65 +1,249 @@
 """
 Views for mirroring content from the RoWo homepage to our app in order to show the same layout
+
+The views are async, so waiting for a download doesn't block the other requests.
 """
 
+import asyncio
 import logging
 import mimetypes
+import os
+import tempfile
 import urllib.parse
+import weakref
+from dataclasses import dataclass
+from http import HTTPStatus
 from pathlib import Path
+from typing import BinaryIO
 
 import httpx
 from django.conf import settings
 from django.http import Http404, HttpRequest, HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.utils.encoding import smart_str
+from django.utils.http import http_date, quote_etag
+
+from .mirror_cache import MirrorIndex, get_mirror_index
+from .streaming import file_response
 
 logger = logging.getLogger(__name__)
 
 
-def theme(request: HttpRequest, file_path: str) -> HttpResponse:  # noqa ARG001
-    return mirror(request, f"themes/{file_path}")
+def write_atomic(file_path: Path, content: bytes) -> None:
+    """
+    Write to a temporary file and rename it, so a partial file is never served
+    """
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        dir=file_path.parent, prefix=f".{file_path.name}.", delete=False
+    ) as temp_file:
+        temp_path = Path(temp_file.name)
+        try:
+            temp_file.write(content)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+    # readable like the other static files, not only by this process
+    temp_path.chmod(0o644)
+    temp_path.replace(file_path)
 
 
-def mirror(request: HttpRequest, file_path: str) -> HttpResponse:  # noqa: ARG001
-    # Ignore query parameters (everything after the "?")
-    file_path = file_path.split("?")[0]
+class MirrorClient:
+    """
+    Downloads from ROWO_MIRROR_URL within one event loop
 
-    # Convert to Path object for easier path manipulation
-    local_file_path = Path(settings.APP_STATIC_ROOT) / file_path
+    All downloads share the connections of one client, at most ROWO_MIRROR_CONCURRENCY
+    run at the same time. Requests for a file that is already downloading wait for
+    that download instead of starting another one.
+    """
 
-    # If file already exists, serve it
-    if local_file_path.exists():
-        return serve_local_file(local_file_path)
+    def __init__(self) -> None:
+        self.client = httpx.AsyncClient(
+            base_url=settings.ROWO_MIRROR_URL,
+            timeout=settings.ROWO_MIRROR_TIMEOUT,
+            limits=httpx.Limits(max_connections=settings.ROWO_MIRROR_CONCURRENCY),
+        )
+        self.semaphore = asyncio.Semaphore(settings.ROWO_MIRROR_CONCURRENCY)
+        self.downloads: dict[Path, asyncio.Task] = {}
 
-    # If not, download the file from the external URL
-    try:
-        # Build the URL for the external resource
-        external_url = f"https://www.robinwood.de/{urllib.parse.quote(file_path)}"
+    async def fetch(
+        self, relative_path: str, local_file_path: Path, etag: str = ""
+    ) -> None:
+        """
+        Download the file, or only revalidate it if there is an ETag
+        """
+        task = self.downloads.get(local_file_path)
+        if task is None:
+            task = asyncio.create_task(
+                self.download(relative_path, local_file_path, etag)
+            )
+            self.downloads[local_file_path] = task
+            task.add_done_callback(
+                lambda done: self.download_done(local_file_path, done)
+            )
+        # a cancelled request must not cancel the download for the others
+        await asyncio.shield(task)
 
-        # Download the file
-        response = httpx.get(external_url)
+    def download_done(self, local_file_path: Path, task: asyncio.Task) -> None:
+        if self.downloads.get(local_file_path) is task:
+            del self.downloads[local_file_path]
+        if not task.cancelled():
+            # retrieved, in case all waiting requests were cancelled
+            task.exception()
 
+    async def download(
+        self, relative_path: str, local_file_path: Path, etag: str
+    ) -> None:
+        headers = {"If-None-Match": etag} if etag else {}
+        async with self.semaphore:
+            response = await self.client.get(
+                urllib.parse.quote(relative_path), headers=headers
+            )
+        index = get_mirror_index()
+        if etag and response.status_code == HTTPStatus.NOT_MODIFIED:
+            await asyncio.to_thread(index.revalidated, relative_path)
+            logger.info(f"Revalidated {response.url}")
+            return
         # Raise an error if the file wasn't successfully retrieved
         response.raise_for_status()
+        await asyncio.to_thread(
+            store_download, index, relative_path, local_file_path, response
+        )
+        logger.info(f"Downloaded {response.url}")
+
+
+def store_download(
+    index: MirrorIndex,
+    relative_path: str,
+    local_file_path: Path,
+    response: httpx.Response,
+) -> None:
+    write_atomic(local_file_path, response.content)
+    index.record(
+        relative_path,
+        str(response.url),
+        len(response.content),
+        response.headers.get("ETag", ""),
+    )
+    evicted = index.evict(
+        Path(settings.APP_STATIC_ROOT).resolve(),
+        settings.ROWO_MIRROR_MAX_BYTES,
+        keep=relative_path,
+    )
+    for entry in evicted:
+        logger.info(f"Evicted {entry.path} from the mirror")
+
+
+# Daphne runs a single event loop, but async_to_sync and tests create their own and
+# the connections and locks of a loop can't be used in another one
+mirror_clients: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, MirrorClient] = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_mirror_client() -> MirrorClient:
+    loop = asyncio.get_running_loop()
+    client = mirror_clients.get(loop)
+    if client is None:
+        client = mirror_clients[loop] = MirrorClient()
+    return client
+
+
+async def theme(request: HttpRequest, file_path: str) -> HttpResponse:
+    return await mirror(request, f"themes/{file_path}")
+
+
+async def mirror(request: HttpRequest, file_path: str) -> HttpResponse:
+    mirrored_file = await get_local_file(file_path)
+    return serve_local_file(request, mirrored_file)
 
-        # Ensure the directory exists
-        local_dir = local_file_path.parent
-        local_dir.mkdir(parents=True, exist_ok=True)
 
-        # Write the file to STATIC_ROOT
-        local_file_path.write_bytes(response.content)
+@dataclass
+class MirroredFile:
+    """
+    Open mirrored file, it can be served even if it's replaced or evicted meanwhile
+    """
 
-        # Serve the newly downloaded file
-        logger.info(f"Downloaded {external_url}")
-        return serve_local_file(local_file_path)
+    path: Path
+    file: BinaryIO
+    stat: os.stat_result
 
+    @classmethod
+    def open(cls, path: Path) -> "MirroredFile | None":
+        """
+        Open the file and take its size from the handle, None if it doesn't exist
+        """
+        try:
+            file = path.open("rb")
+        except FileNotFoundError:
+            return None
+        except IsADirectoryError:
+            raise Http404(f"{path.name} is a directory") from None
+        return cls(path, file, os.fstat(file.fileno()))
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def resolve_local_path(file_path: str) -> tuple[Path, str]:
+    """
+    Local path of the file and its path relative to APP_STATIC_ROOT
+    """
+    # Convert to Path object for easier path manipulation
+    static_root = Path(settings.APP_STATIC_ROOT).resolve()
+    local_file_path = (static_root / file_path).resolve()
+    # hidden files like the index are not served
+    if not local_file_path.is_relative_to(static_root) or any(
+        part.startswith(".") for part in Path(file_path).parts
+    ):
+        raise Http404(f"Invalid path {file_path}")
+    return local_file_path, local_file_path.relative_to(static_root).as_posix()
+
+
+async def get_local_file(file_path: str, count_hit: bool = True) -> MirroredFile:
+    """
+    The opened mirrored file, downloaded or revalidated if necessary
+    """
+    # Ignore query parameters (everything after the "?")
+    file_path = file_path.split("?")[0]
+    local_file_path, relative_path = await asyncio.to_thread(
+        resolve_local_path, file_path
+    )
+
+    index = get_mirror_index()
+    entry = await asyncio.to_thread(index.get, relative_path)
+    if count_hit and entry is not None:
+        index.count_hit(relative_path)
+    mirrored_file = await asyncio.to_thread(MirroredFile.open, local_file_path)
+    if mirrored_file is not None and (entry is None or not entry.expired()):
+        return mirrored_file
+
+    try:
+        # If not there yet, download the file from the external URL
+        await get_mirror_client().fetch(
+            relative_path,
+            local_file_path,
+            entry.etag if mirrored_file and entry else "",
+        )
     except httpx.HTTPError as e:
-        logger.error(f"Failed to download {external_url}: {e}")
-        raise Http404(f"Could not download file from {external_url}: {e}")
+        if mirrored_file is None:
+            logger.error(f"Failed to download {file_path}: {e}")
+            raise Http404(f"Could not download file {file_path}: {e}")
+        # the outdated file is better than none
+        logger.warning(f"Failed to revalidate {file_path}: {e}")
+        return mirrored_file
+    if mirrored_file is not None:
+        # the download replaced the file
+        await asyncio.to_thread(mirrored_file.close)
+    mirrored_file = await asyncio.to_thread(MirroredFile.open, local_file_path)
+    if mirrored_file is None:
+        # evicted by another process right after the download
+        raise Http404(f"Could not download file {file_path}")
+    return mirrored_file
 
 
-def serve_local_file(file_path: Path) -> HttpResponse:
+def guess_content_type(file_path: Path) -> str:
     # Guess content type based on file extension (optional)
-    logger.info(f"Serving {file_path}")
     content_type: str = (
         mimetypes.guess_type(str(file_path))[0] or "application/octet-stream"
     )
@@ -71,12 +255,45 @@ def serve_local_file(file_path: Path) -> HttpResponse:
     # ensure svg are shown correctly
     if "svg" in content_type:
         content_type = "image/svg+xml"
+    return content_type
+
 
-    # Serve the file
-    response = HttpResponse(file_path.read_bytes(), content_type=content_type)
+def set_cache_headers(response: HttpResponse, etag: str, last_modified: float) -> None:
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    patch_cache_control(response, public=True, max_age=settings.ROWO_MIRROR_MAX_AGE)
+
+
+def serve_local_file(request: HttpRequest, mirrored_file: MirroredFile) -> HttpResponse:
+    """
+    Serve the file without reading it into memory, 304 if the client has it already
+    """
+    file_path, stat = mirrored_file.path, mirrored_file.stat
+    etag = quote_etag(f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+    not_modified = get_conditional_response(
+        request, etag=etag, last_modified=int(stat.st_mtime)
+    )
+    if not_modified is not None:
+        mirrored_file.close()
+        set_cache_headers(not_modified, etag, stat.st_mtime)
+        return not_modified
+
+    logger.info(f"Serving {file_path}")
+    content_type = guess_content_type(file_path)
+    if settings.ROWO_MIRROR_ACCEL_REDIRECT:
+        mirrored_file.close()
+        # nginx sends the file from its internal location
+        relative_path = file_path.relative_to(Path(settings.APP_STATIC_ROOT).resolve())
+        response = HttpResponse(content_type=content_type)
+        response["X-Accel-Redirect"] = settings.ROWO_MIRROR_ACCEL_REDIRECT.rstrip(
+            "/"
+        ) + urllib.parse.quote(f"/{relative_path.as_posix()}")
+    else:
+        response = file_response(request, mirrored_file.file, content_type=content_type)
     if "svg" not in content_type:
         response["Content-Disposition"] = (
             f"inline; filename={smart_str(file_path.name)}"
         )
     response["X-Content-Type-Options"] = "nosniff"
+    set_cache_headers(response, etag, stat.st_mtime)
     return response
@@ -1,31 +1,23 @@
 import logging
-from typing import TYPE_CHECKING, Any, NoReturn
+from typing import Any, NoReturn
 
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, Row, Submit
 from django.conf import settings
-from django.db.models.query_utils import DeferredAttribute
 from django.forms import Form, ModelForm
 from django.forms import models as model_forms
-from django.http import HttpRequest, HttpResponse
+from django.http import Http404, HttpRequest, HttpResponse
 from django.shortcuts import get_object_or_404, render
 from django.utils import timezone
 from django.utils.safestring import SafeString
 from django.views.generic.edit import UpdateView
 
 from .field_helper import get_fill_status
-from .layouts import (
-    Alert,
-    LayoutElement,
-    PercentChecker,
-    Section,
-    State,
-)
+from .fragment_cache import FragmentLayout
+from .layouts import Alert, State
 from .models import Anbieter, CompanySurvey2024, SurveyAccess
-
-if TYPE_CHECKING:
-    from django.db.models import Field
-
+from .revisions import get_survey_revision, store_as_delta
+from .survey_layout import get_survey_layout_plan
 
 logger = logging.getLogger(__name__)
 
@@ -78,50 +70,28 @@ class FormHelperExpanded(FormHelper):
         return SafeString(result)
 
 
-def gen_survey_helper(  # noqa: PLR0912, PLR0915
-    form: ModelForm,  # noqa: ARG001
+def gen_survey_helper(
+    form: ModelForm,
     state: State,
     add_save_button: bool,
 ) -> FormHelper:
+    plan = get_survey_layout_plan(CompanySurvey2024)
     helper = FormHelperExpanded()
     helper.form_group_wrapper_class = "form-group"
     helper.form_class = "from form-horizontal"
     helper.field_class = "col-sm-6"
     helper.label_class = "col-sm-4"
     helper.form_action = "#content-start"
-    field_list = []
+    helper.field_to_section = plan.field_to_section
+    helper.field_to_name = plan.field_to_name
 
     if form.is_bound:
         data = form.cleaned_data
     else:
         data = form.initial
 
-    checks_failed: list[tuple[str, str]] = []
-    section = ""
-    section_id = ""
-    for field_name in CompanySurvey2024._field_order:
-        field = getattr(CompanySurvey2024, field_name)
-        if isinstance(field, PercentChecker):
-            layout, check_okay = field.check(data)
-            field_list.append(layout)
-            if not check_okay:
-                checks_failed.append((section, section_id))
-        elif isinstance(field, LayoutElement):
-            if isinstance(field, Section):
-                section = field.name
-                section_id = field_name
-            field.field_name = field_name
-            field_list.append(field)
-        else:
-            if isinstance(field, DeferredAttribute):
-                field: Field = field.field
-            if getattr(field, "name", False):
-                helper.field_to_section[field.name] = section
-                helper.field_to_name[field.name] = field.verbose_name
-            if hasattr(field, "bootstrap_field"):
-                field_list.append(field.bootstrap_field(field_name))
-            elif getattr(field, "editable", False):
-                field_list.append(field_name)
+    fragments = settings.SURVEY_FRAGMENT_CACHE
+    field_list, checks_failed = plan.layout_fields(data, fragments=fragments)
     if add_save_button:
         field_list.append(Row(Submit("Speichern", "Speichern", css_class="mb-5 mt-3")))
 
@@ -141,7 +111,10 @@ def gen_survey_helper(  # noqa: PLR0912, PLR0915
         )
         extra_content = f'<ul class="errorlist">{extra_content}</ul>'
         alerts.append(alert_gen(extra_content))
-    helper.add_layout(Layout(*alerts, *field_list))
+    if fragments:
+        helper.add_layout(FragmentLayout(*alerts, *field_list, version=plan.version))
+    else:
+        helper.add_layout(Layout(*alerts, *field_list))
     return helper
 
 
@@ -248,18 +221,24 @@ class SurveyView(UpdateView):
         self,
         queryset: CompanySurvey2024 | None = None,  # noqa: ARG002
     ) -> CompanySurvey2024:
-        # Retrieve survey via SurveyAccess code and increment access count
-        self.survey_access = get_object_or_404(SurveyAccess, code=self.kwargs["code"])
+        # Retrieve survey and anbieter together with the SurveyAccess code
+        # and increment access count
+        self.survey_access = get_object_or_404(
+            SurveyAccess.objects.select_related("survey", "anbieter"),
+            code=self.kwargs["code"],
+        )
+        anbieter = self.survey_access.anbieter
+        survey = self.survey_access.survey
         if self.view_mode:
             if self.rev:
-                return get_object_or_404(
-                    CompanySurvey2024,
-                    anbieter=self.survey_access.anbieter,
-                    revision=self.rev,
-                )
+                survey = get_survey_revision(anbieter, self.rev)
+                if survey is None:
+                    raise Http404("No such revision")
         else:
             self.survey_access.increment_access_count()
-        return self.survey_access.survey
+        # same row as the anbieter of the access, so don't fetch it again
+        survey.anbieter = anbieter
+        return survey
 
     def form_invalid(self, form: ModelForm) -> HttpResponse:
         logger.info(
@@ -273,6 +252,7 @@ class SurveyView(UpdateView):
             logger.info(f"Saved unchanged {self.object.log_info}")
             return self.render_to_response(self.get_context_data(form=form))
         # Increment revision and save a new CompanySurvey2024 instance
+        previous_pk = self.survey_access.survey_id
         new_revision = self.survey_access.current_revision + 1
         form.instance.revision = new_revision
         form.instance.anbieter = self.survey_access.anbieter
@@ -286,10 +266,12 @@ class SurveyView(UpdateView):
         self.survey_access.survey = new_survey
         self.survey_access.current_revision = new_revision
         self.survey_access.changed = timezone.now()
-        self.survey_access.save()
+        self.survey_access.save(update_fields=["survey", "current_revision", "changed"])
+        if settings.SURVEY_DELTA_REVISIONS:
+            store_as_delta(previous_pk, new_survey)
 
-        # recreate form, reset request
-        self.object = self.get_object()
+        # recreate form with the saved survey, reset request
+        self.object = new_survey
         self.reset_form = True
         form = self.get_form()
         # Render the form with additional context "status": "saved"
@@ -14,3 +14,9 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "oekostrom_db.settings")
 
 application = get_asgi_application()
+
+# needs the apps loaded by get_asgi_application
+from anbieter.mail_dispatch import resume_dispatch  # noqa: E402
+
+# the queue of the survey mails isn't sent by anybody after a restart
+resume_dispatch()
@@ -0,0 +1,62 @@
+"""
+Health check of the app and its database connection
+
+/health/ answers 200 if a query succeeds and 503 otherwise, for the container health
+check and the monitoring. With DB_POOL the response includes the statistics of the
+connection pool, above all how long the requests waited for a free connection.
+"""
+
+import logging
+import time
+from typing import Any
+
+from django.db import DatabaseError, connection
+from django.http import HttpRequest, JsonResponse
+from django.views.decorators.cache import never_cache
+
+logger = logging.getLogger(__name__)
+
+
+def pool_stats(pool) -> dict[str, Any]:
+    """
+    Size and wait times of a psycopg ConnectionPool, the counters are cumulative
+    """
+    # counters that are still 0 are missing in the statistics
+    stats = pool.get_stats()
+    requests = stats.get("requests_num", 0)
+    wait_ms = stats.get("requests_wait_ms", 0)
+    return {
+        "size": stats.get("pool_size", 0),
+        "available": stats.get("pool_available", 0),
+        "min_size": stats.get("pool_min", 0),
+        "max_size": stats.get("pool_max", 0),
+        "requests": requests,
+        "requests_waiting": stats.get("requests_waiting", 0),
+        "requests_queued": stats.get("requests_queued", 0),
+        "requests_errors": stats.get("requests_errors", 0),
+        "wait_ms_total": wait_ms,
+        "wait_ms_average": round(wait_ms / requests, 2) if requests else 0.0,
+        "connections_ms_total": stats.get("connections_ms", 0),
+    }
+
+
+@never_cache
+def health(request: HttpRequest) -> JsonResponse:  # noqa: ARG001
+    start = time.perf_counter()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+    except DatabaseError as e:
+        # the details are only logged, the response is public
+        logger.error(f"Health check failed: {type(e).__name__}: {e}")
+        return JsonResponse({"status": "error"}, status=503)
+    data: dict[str, Any] = {
+        "status": "ok",
+        "database_ms": round((time.perf_counter() - start) * 1000, 2),
+    }
+    # only the postgresql backend has a pool, and only with DB_POOL
+    pool = getattr(connection, "pool", None)
+    if pool is not None:
+        data["pool"] = pool_stats(pool)
+    return JsonResponse(data)
@@ -85,6 +85,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     "django.forms",
     "anbieter",
     "crispy_forms",
@@ -142,8 +143,29 @@ DATABASES = {
         "PASSWORD": os.environ.get("DB_PASSWORD"),
         "HOST": os.environ.get("DB_HOST"),
         "PORT": os.environ.get("DB_PORT"),
+        # seconds to keep a connection open, 0 closes it after every request
+        # under ASGI every request runs in its own thread, use DB_POOL there
+        "CONN_MAX_AGE": int(os.environ.get("DB_CONN_MAX_AGE", 0)),
+        # check reused connections before the request, instead of failing in it
+        "CONN_HEALTH_CHECKS": to_bool(os.environ.get("DB_CONN_HEALTH_CHECKS", True)),
     }
 }
+# connection pool of psycopg 3, shared by all threads of the process,
+# only for PostgreSQL
+DB_POOL = to_bool(os.environ.get("DB_POOL", False))
+if DB_POOL:
+    # the pool keeps the connections, Django refuses persistent ones with it
+    DATABASES["default"]["CONN_MAX_AGE"] = 0
+    DATABASES["default"]["OPTIONS"] = {
+        "pool": {
+            "min_size": int(os.environ.get("DB_POOL_MIN_SIZE", 2)),
+            "max_size": int(os.environ.get("DB_POOL_MAX_SIZE", 10)),
+            # seconds a request waits for a free connection before failing
+            "timeout": float(os.environ.get("DB_POOL_TIMEOUT", 10)),
+            # seconds after which idle connections above min_size are closed
+            "max_idle": float(os.environ.get("DB_POOL_MAX_IDLE", 10 * 60)),
+        }
+    }
 
 
 # Password validation
@@ -178,6 +200,26 @@ USE_L10N = True
 USE_TZ = True
 
 ROWO_MIRRORING = False
+# origin of the mirrored files, see anbieter/view_mirror.py
+ROWO_MIRROR_URL = os.environ.get("ROWO_MIRROR_URL", "https://www.robinwood.de")
+# downloads from the origin at the same time and their timeout in seconds
+ROWO_MIRROR_CONCURRENCY = int(os.environ.get("ROWO_MIRROR_CONCURRENCY", 4))
+ROWO_MIRROR_TIMEOUT = float(os.environ.get("ROWO_MIRROR_TIMEOUT", 10))
+# seconds the browsers may cache the mirrored files
+ROWO_MIRROR_MAX_AGE = int(os.environ.get("ROWO_MIRROR_MAX_AGE", 24 * 60 * 60))
+# URL of an internal nginx location aliased to APP_STATIC_ROOT, e.g. /_mirror/,
+# nginx sends the files then with X-Accel-Redirect
+ROWO_MIRROR_ACCEL_REDIRECT = os.environ.get("ROWO_MIRROR_ACCEL_REDIRECT", "")
+# index of the downloaded files, .mirror_index.sqlite3 in APP_STATIC_ROOT if empty
+ROWO_MIRROR_INDEX = os.environ.get("ROWO_MIRROR_INDEX", "")
+# downloaded files are revalidated after that many seconds
+ROWO_MIRROR_TTL = int(os.environ.get("ROWO_MIRROR_TTL", 7 * 24 * 60 * 60))
+# the least recently used files are deleted if the downloaded files get larger
+ROWO_MIRROR_MAX_BYTES = int(os.environ.get("ROWO_MIRROR_MAX_BYTES", 500 * 1024**2))
+# seconds between the writes of the hits of the mirrored files to the index
+ROWO_MIRROR_HIT_FLUSH_INTERVAL = int(
+    os.environ.get("ROWO_MIRROR_HIT_FLUSH_INTERVAL", 60)
+)
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.0/howto/static-files/
@@ -280,6 +322,71 @@ SESSION_SAVE_EVERY_REQUEST = True
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap5"
 CRISPY_TEMPLATE_PACK = "bootstrap5"
 
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "survey_fragments": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "survey_fragments",
+        "OPTIONS": {"MAX_ENTRIES": 5000},
+    },
+    # buffered access counts, see anbieter/access_counter.py
+    "survey_access": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "survey_access",
+        "OPTIONS": {"MAX_ENTRIES": 100000},
+    },
+    # compiled Jinja templates, see anbieter/templating.py
+    "jinja_bytecode": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "jinja_bytecode",
+        "TIMEOUT": None,
+    },
+    # facet counts of the admin list filters, see anbieter/facets.py
+    "admin_facets": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "admin_facets",
+    },
+}
+
+# Render the static parts of the survey form only once, see anbieter/fragment_cache.py
+SURVEY_FRAGMENT_CACHE = to_bool(os.environ.get("SURVEY_FRAGMENT_CACHE", True))
+SURVEY_FRAGMENT_CACHE_ALIAS = "survey_fragments"
+# fragments are keyed by the survey model version, so they never get outdated
+SURVEY_FRAGMENT_CACHE_TIMEOUT = None
+
+# Count survey accesses in the cache and write them in bulk in the background,
+# see anbieter/access_counter.py
+SURVEY_ACCESS_BUFFER = to_bool(os.environ.get("SURVEY_ACCESS_BUFFER", False))
+SURVEY_ACCESS_BUFFER_ALIAS = "survey_access"
+SURVEY_ACCESS_FLUSH_INTERVAL = int(os.environ.get("SURVEY_ACCESS_FLUSH_INTERVAL", 60))
+
+# Store old survey revisions as deltas, see anbieter/revisions.py
+SURVEY_DELTA_REVISIONS = to_bool(os.environ.get("SURVEY_DELTA_REVISIONS", False))
+# keep every n-th revision completely
+SURVEY_SNAPSHOT_INTERVAL = int(os.environ.get("SURVEY_SNAPSHOT_INTERVAL", 10))
+
+# Bytecode of the Jinja templates stored in the database, see anbieter/templating.py
+JINJA_BYTECODE_CACHE_ALIAS = "jinja_bytecode"
+# Render the homepage export in that many processes, see anbieter/export.py
+HOMEPAGE_EXPORT_WORKERS = int(os.environ.get("HOMEPAGE_EXPORT_WORKERS", 1))
+
+# Cached facet counts of the admin list filters, see anbieter/facets.py
+ADMIN_FACET_CACHE_ALIAS = "admin_facets"
+# bulk updates don't invalidate the counts, they are recomputed after that many seconds
+ADMIN_FACET_CACHE_TIMEOUT = int(os.environ.get("ADMIN_FACET_CACHE_TIMEOUT", 600))
+
+# Queued survey mails, see anbieter/mail_dispatch.py
+# send them in a thread of the server process, otherwise `manage.py send_survey_emails`
+SURVEY_MAIL_BACKGROUND = to_bool(os.environ.get("SURVEY_MAIL_BACKGROUND", True))
+# mails sent and written back to the database at once
+SURVEY_MAIL_BATCH_SIZE = int(os.environ.get("SURVEY_MAIL_BATCH_SIZE", 50))
+# mails per second, 0 for no limit
+SURVEY_MAIL_RATE = float(os.environ.get("SURVEY_MAIL_RATE", 0))
+# seconds after which the mails claimed by a stopped dispatcher are sent by another one
+SURVEY_MAIL_CLAIM_TIMEOUT = int(os.environ.get("SURVEY_MAIL_CLAIM_TIMEOUT", 10 * 60))
+
 EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
 EMAIL_HOST = os.environ.get("EMAIL_HOST")  # Replace with your SMTP server address
 EMAIL_PORT = int(
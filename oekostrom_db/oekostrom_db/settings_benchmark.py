@@ -0,0 +1,26 @@
+"""
+Settings for running benchmarks against a throw away in-memory SQLite database
+
+    python manage.py benchmark_survey --settings=oekostrom_db.settings_benchmark
+"""
+
+import os
+
+os.environ.setdefault("SECRET_KEY", "benchmark")
+
+from .settings import *  # noqa: E402, F403
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": ":memory:",
+    }
+}
+
+# the data migrations need the scraped data, the benchmark creates its own data
+MIGRATION_MODULES = {"anbieter": None}
+
+EMAIL_BACKEND = "django.core.mail.backends.locmem.EmailBackend"
+
+# every request logs, which would spoil the output and the timings
+LOGGING["loggers"]["anbieter"] = {"handlers": ["console"], "level": "WARNING"}  # noqa: F405
@@ -0,0 +1,149 @@
+"use strict";
+/*
+ * Virtual scrolling for the admin changelist, see anbieter/keyset.py
+ *
+ * The rows after the first page are loaded as JSON while scrolling.
+ * Only the rows around the visible part of the page are kept in the table,
+ * the others are replaced by spacer rows of the same height.
+ */
+{
+    // rows rendered above and below the visible ones
+    const BUFFER_ROWS = 60;
+    // load the next rows when less than this are left below the visible ones
+    const LOAD_AHEAD = 200;
+    const VALUE_PATTERN = /name="_selected_action" value="([^"]*)"/;
+
+    function init() {
+        const data = document.getElementById("keyset-changelist");
+        const tbody = document.querySelector("#result_list tbody");
+        if (!data || !tbody || !tbody.rows.length) {
+            return;
+        }
+        const keyset = JSON.parse(data.textContent);
+        const form = document.getElementById("changelist-form");
+        const toggle = document.getElementById("action-toggle");
+        const rows = Array.from(tbody.rows, (row) => row.outerHTML);
+        // selected rows, the checkboxes of rows outside the table are lost otherwise
+        const selected = new Set();
+        const rowHeight = tbody.getBoundingClientRect().height / tbody.rows.length;
+        let after = keyset.after;
+        let loading = false;
+        let first = 0;
+        let last = rows.length;
+
+        function rowValue(html) {
+            const match = VALUE_PATTERN.exec(html);
+            return match ? match[1] : null;
+        }
+
+        function spacer(count) {
+            if (!count) {
+                return "";
+            }
+            return `<tr class="keyset-spacer" style="height: ${count * rowHeight}px"></tr>`;
+        }
+
+        function render(force) {
+            const offset = Math.max(0, -tbody.getBoundingClientRect().top);
+            const visibleFirst = Math.floor(offset / rowHeight);
+            const visibleLast = visibleFirst + Math.ceil(window.innerHeight / rowHeight);
+            const outside = (
+                (first > 0 && visibleFirst - first < BUFFER_ROWS / 2)
+                || (last < rows.length && last - visibleLast < BUFFER_ROWS / 2)
+            );
+            if (force || outside) {
+                first = Math.max(0, visibleFirst - BUFFER_ROWS);
+                last = Math.min(rows.length, visibleLast + BUFFER_ROWS);
+                tbody.innerHTML = spacer(first) + rows.slice(first, last).join("")
+                    + spacer(rows.length - last);
+                tbody.querySelectorAll("input.action-select").forEach((input) => {
+                    input.checked = selected.has(input.value);
+                    input.closest("tr").classList.toggle("selected", input.checked);
+                });
+            }
+            if (after && !loading && rows.length - visibleLast < LOAD_AHEAD) {
+                load();
+            }
+        }
+
+        async function load() {
+            loading = true;
+            try {
+                const response = await fetch(
+                    `${keyset.url}&${new URLSearchParams({after: after})}`,
+                    {headers: {Accept: "application/json"}, credentials: "same-origin"},
+                );
+                if (!response.ok) {
+                    throw new Error(`${response.status} ${response.statusText}`);
+                }
+                const page = await response.json();
+                rows.push(...page.rows);
+                after = page.after;
+                if (toggle && toggle.checked) {
+                    page.rows.forEach((html) => selected.add(rowValue(html)));
+                }
+            } catch (error) {
+                console.error("Loading the changelist rows failed", error);
+                after = null;
+            } finally {
+                loading = false;
+            }
+            render(true);
+        }
+
+        tbody.addEventListener("change", (event) => {
+            if (event.target.matches("input.action-select")) {
+                if (event.target.checked) {
+                    selected.add(event.target.value);
+                } else {
+                    selected.delete(event.target.value);
+                }
+            }
+        });
+        if (toggle) {
+            toggle.addEventListener("click", () => {
+                selected.clear();
+                if (toggle.checked) {
+                    rows.forEach((html) => selected.add(rowValue(html)));
+                }
+            });
+        }
+        if (form) {
+            // submit the selected rows that aren't in the table
+            form.addEventListener("submit", () => {
+                const present = new Set(
+                    Array.from(tbody.querySelectorAll("input.action-select"), (input) => input.value)
+                );
+                selected.forEach((value) => {
+                    if (!present.has(value)) {
+                        const input = document.createElement("input");
+                        input.type = "hidden";
+                        input.name = "_selected_action";
+                        input.value = value;
+                        form.appendChild(input);
+                    }
+                });
+            });
+        }
+
+        let scheduled = false;
+        function schedule() {
+            if (!scheduled) {
+                scheduled = true;
+                window.requestAnimationFrame(() => {
+                    scheduled = false;
+                    render(false);
+                });
+            }
+        }
+        window.addEventListener("scroll", schedule, {passive: true});
+        window.addEventListener("resize", schedule);
+        render(false);
+    }
+
+    if (document.readyState === "loading") {
+        document.addEventListener("DOMContentLoaded", init);
+    } else {
+        init();
+    }
+}